@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compare point get latency of file object reads and memory mapped reads
+
+Usage: python benchmarks/get_latency.py [documents] [gets]
+'''
+# Import python libs
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+# Import maras libs
+from maras.database import Database
+from maras.hash_index import UniqueHashIndex
+
+
+class MmapIdIndex(UniqueHashIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['use_mmap'] = True
+        super(MmapIdIndex, self).__init__(*args, **kwargs)
+
+
+def fill(path, id_index, documents):
+    '''
+    Create database in path and insert documents into it
+    '''
+    db = Database(path)
+    db.set_indexes([id_index(path, 'id')])
+    db.create()
+    ids = []
+    for num in xrange(documents):
+        ids.append(db.insert(dict(num=num, data='x' * 100))['_id'])
+    db.close()
+    return ids
+
+
+def run(path, ids, gets):
+    '''
+    Return average latency of random get in microseconds
+    '''
+    db = Database(path)
+    db.open()
+    keys = [random.choice(ids) for _ in xrange(gets)]
+    get = db.get
+    start = time.time()
+    for key in keys:
+        get('id', key)
+    took = time.time() - start
+    db.close()
+    return took / gets * 1000000
+
+
+def main(documents=20000, gets=50000):
+    root = tempfile.mkdtemp(prefix='maras_bench_')
+    try:
+        for name, id_index in (('file', UniqueHashIndex),
+                               ('mmap', MmapIdIndex)):
+            path = os.path.join(root, name)
+            ids = fill(path, id_index, documents)
+            print('{0}: {1:.2f} us per get'.format(name, run(path, ids, gets)))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class BatchFile(object):
+    """
+    Wraps file object and keeps all writes in memory (as dirty pages)
+    until :py:meth:`release` is called. Reads see the buffered writes.
+
+    Used by :py:meth:`maras.database.Database.batch`, all pages are
+    written back in offset order as one group.
+    """
+
+    page_size = 4096
+
+    def __init__(self, f):
+        self._f = f
+        self._pages = {}
+        self._f.seek(0, 2)
+        self._disk_size = self._f.tell()
+        self._size = self._disk_size
+        self._pos = 0
+
+    def _page(self, num):
+        try:
+            return self._pages[num]
+        except KeyError:
+            page = bytearray(self.page_size)
+            start = num * self.page_size
+            if start < self._disk_size:
+                self._f.seek(start)
+                data = self._f.read(self.page_size)
+                page[:len(data)] = data
+            self._pages[num] = page
+            return page
+
+    def _read_disk(self, start, end):
+        self._f.seek(start)
+        data = self._f.read(end - start)
+        if len(data) < end - start:
+            # hole left by seek behind the end of file
+            data += b'\x00' * (end - start - len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self._pos = offset
+        elif whence == 1:
+            self._pos += offset
+        else:
+            self._pos = self._size + offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        pos = self._pos
+        if size < 0:
+            end = self._size
+        else:
+            end = min(pos + size, self._size)
+        if end <= pos:
+            return b''
+        page_size = self.page_size
+        pages = self._pages
+        num = pos // page_size
+        if end <= (num + 1) * page_size:  # fits in single page
+            page = pages.get(num)
+            self._pos = end
+            if page is None:
+                return self._read_disk(pos, end)
+            offset = pos - num * page_size
+            return bytes(page[offset:offset + end - pos])
+        chunks = []
+        curr = pos
+        disk_start = None
+        while curr < end:
+            num = curr // page_size
+            page_end = min((num + 1) * page_size, end)
+            page = pages.get(num)
+            if page is None:
+                if disk_start is None:
+                    disk_start = curr
+            else:
+                if disk_start is not None:
+                    chunks.append(self._read_disk(disk_start, curr))
+                    disk_start = None
+                offset = curr - num * page_size
+                chunks.append(bytes(page[offset:offset + page_end - curr]))
+            curr = page_end
+        if disk_start is not None:
+            chunks.append(self._read_disk(disk_start, end))
+        self._pos = end
+        return b''.join(chunks)
+
+    def write(self, data):
+        page_size = self.page_size
+        curr = self._pos
+        end = curr + len(data)
+        written = 0
+        num = curr // page_size
+        if end <= (num + 1) * page_size:  # fits in single page
+            offset = curr - num * page_size
+            self._page(num)[offset:offset + end - curr] = data
+            written = end - curr
+            curr = end
+        while curr < end:
+            num = curr // page_size
+            offset = curr - num * page_size
+            chunk = min(page_size - offset, end - curr)
+            self._page(num)[offset:offset + chunk] = \
+                data[written:written + chunk]
+            written += chunk
+            curr += chunk
+        self._pos = end
+        if end > self._size:
+            self._size = end
+        return written
+
+    def flush(self):
+        # deferred until release
+        pass
+
+    def fileno(self):
+        return self._f.fileno()
+
+    @property
+    def closed(self):
+        return self._f.closed
+
+    def release(self, commit=True):
+        """
+        Writes dirty pages back (when ``commit``), drops them and returns
+        the wrapped file object.
+        """
+        if commit and self._pages:
+            run_start = None
+            run = []
+            for num in sorted(self._pages):
+                if run and num != run_start + len(run):
+                    self._write_run(run_start, run)
+                    run = []
+                if not run:
+                    run_start = num
+                run.append(self._pages[num])
+            self._write_run(run_start, run)
+            self._f.flush()
+        self._pages = {}
+        return self._f
+
+    def _write_run(self, run_start, run):
+        start = run_start * self.page_size
+        data = b''.join(bytes(page) for page in run)
+        data = data[:max(self._size - start, 0)]
+        self._f.seek(start)
+        self._f.write(data)
+
+    def close(self):
+        self.release().close()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Bloom filters used by indexes to answer lookups of missing keys without
+reading bucket file.
+'''
+# Import python libs
+from hashlib import md5
+
+# Import third party libs
+import msgpack
+
+
+class BloomFilter(object):
+    '''
+    Set of keys which can give false positives but no false negatives.
+    Sized for ``capacity`` keys with ``bits_per_key`` bits each (10 bits
+    give about 1% of false positives), :py:attr:`count` tells how many
+    keys were added.
+    '''
+
+    def __init__(self, capacity, bits_per_key=10):
+        self.capacity = capacity
+        self.bits_per_key = bits_per_key
+        self.size = max(capacity * bits_per_key, 64)
+        self.hashes = max(int(round(bits_per_key * 0.69)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = int(md5(msgpack.dumps(key)).hexdigest(), 16)
+        first = digest & 0xffffffffffffffff
+        step = (digest >> 64) | 1
+        size = self.size
+        return [(first + i * step) % size for i in xrange(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def dumps(self):
+        return msgpack.dumps((self.capacity, self.bits_per_key, self.count,
+                              str(self.bits)))
+
+    @classmethod
+    def loads(cls, data):
+        capacity, bits_per_key, count, bits = msgpack.loads(data)
+        bloom = cls(capacity, bits_per_key)
+        bloom.bits = bytearray(bits)
+        bloom.count = count
+        return bloom
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Codecs used by storages to compress single records.
+
+Compressed record is :py:data:`MARKER` (byte never used by msgpack), codec
+tag and compressed msgpack data. Records stored without compression (too
+small ones, or written before compression was set) stay plain msgpack.
+
+Codecs are chosen by name (:py:data:`codecs`), tags are stored with
+records so they can't change. Register own codec in both dicts.
+'''
+# Import python libs
+import zlib
+
+# Import third party libs
+try:
+    import lzma
+    HAS_LZMA = True
+except ImportError:
+    try:
+        from backports import lzma
+        HAS_LZMA = True
+    except ImportError:
+        HAS_LZMA = False
+try:
+    import lz4.frame
+    HAS_LZ4 = True
+except ImportError:
+    HAS_LZ4 = False
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+MARKER = '\xc1'
+
+
+class Codec(object):
+    '''
+    Base codec, ``dict_tag`` is used instead of ``tag`` when the codec
+    compresses with dictionary (``None`` when it can't use one)
+    '''
+
+    tag = None
+    dict_tag = None
+
+    def __init__(self, dictionary=None):
+        if dictionary is not None and self.dict_tag is None:
+            dictionary = None
+        self.dictionary = dictionary
+        if dictionary is not None:
+            self.tag = self.dict_tag
+
+    @classmethod
+    def train(cls, samples, size):
+        '''
+        Builds dictionary of up to ``size`` bytes from serialized sample
+        records, the most recent samples are the closest to compressed data
+        '''
+        return ''.join(samples)[-size:]
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+
+class ZlibCodec(Codec):
+    '''
+    Deflate, with dictionary the stream is primed with it (compressor and
+    decompressor states after the dictionary are copied for every record)
+    '''
+
+    tag = 'z'
+    dict_tag = 'Z'
+    level = 6
+
+    def __init__(self, dictionary=None):
+        super(ZlibCodec, self).__init__(dictionary)
+        self._compressor = None
+        self._decompressor = None
+        if self.dictionary is not None:
+            comp = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            primed = comp.compress(self.dictionary) + \
+                comp.flush(zlib.Z_SYNC_FLUSH)
+            decomp = zlib.decompressobj(-15)
+            decomp.decompress(primed)
+            self._compressor = comp
+            self._decompressor = decomp
+
+    @classmethod
+    def train(cls, samples, size):
+        # deflate window
+        return super(ZlibCodec, cls).train(samples, min(size, 32 * 1024))
+
+    def compress(self, data):
+        if self._compressor is None:
+            comp = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        else:
+            comp = self._compressor.copy()
+        return comp.compress(data) + comp.flush()
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            decomp = zlib.decompressobj(-15)
+        else:
+            decomp = self._decompressor.copy()
+        return decomp.decompress(data) + decomp.flush()
+
+
+class LzmaCodec(Codec):
+
+    tag = 'x'
+
+    def compress(self, data):
+        return lzma.compress(data, format=lzma.FORMAT_RAW,
+                             filters=[{'id': lzma.FILTER_LZMA2}])
+
+    def decompress(self, data):
+        return lzma.decompress(data, format=lzma.FORMAT_RAW,
+                               filters=[{'id': lzma.FILTER_LZMA2}])
+
+
+class Lz4Codec(Codec):
+
+    tag = '4'
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+
+class ZstdCodec(Codec):
+
+    tag = 's'
+    dict_tag = 'S'
+    level = 3
+
+    def __init__(self, dictionary=None):
+        super(ZstdCodec, self).__init__(dictionary)
+        zdict = None
+        if self.dictionary is not None:
+            zdict = zstandard.ZstdCompressionDict(self.dictionary)
+        self._compressor = zstandard.ZstdCompressor(level=self.level,
+                                                    dict_data=zdict)
+        self._decompressor = zstandard.ZstdDecompressor(dict_data=zdict)
+
+    @classmethod
+    def train(cls, samples, size):
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            # not enough samples
+            return super(ZstdCodec, cls).train(samples, size)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+codecs = {'zlib': ZlibCodec}
+if HAS_LZMA:
+    codecs['lzma'] = LzmaCodec
+if HAS_LZ4:
+    codecs['lz4'] = Lz4Codec
+if HAS_ZSTD:
+    codecs['zstd'] = ZstdCodec
+
+#: tag -> (codec class, uses dictionary)
+codec_tags = {}
+for _cls in codecs.itervalues():
+    codec_tags[_cls.tag] = (_cls, False)
+    if _cls.dict_tag:
+        codec_tags[_cls.dict_tag] = (_cls, True)
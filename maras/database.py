@@ -17,11 +17,17 @@
 
 import os
 import io
+import sys
 from inspect import getsource
+from contextlib import contextmanager
+from collections import deque
+from itertools import izip, islice
 
 # for custom indexes
 import maras
 from maras.storage import Storage, IU_Storage
+from maras.page_cache import PageCache
+from maras.online_compaction import OnlineCompaction
 from maras.hash_index import (IU_UniqueHashIndex,
                                     IU_HashIndex,
                                     HashIndex,
@@ -38,6 +44,7 @@ from maras.index import (ElemNotFound,
                                IndexConflict)
 
 from maras.misc import NONE
+from maras.lazy import LazyDocument
 
 from maras.env import menv
 
@@ -115,13 +122,26 @@ class Database(object):
 
     custom_header = ""  # : use it for imports required by your database
 
-    def __init__(self, path):
+    read_batch = 64  # : index records which values (and ``with_doc`` documents) are read together by get_many and all
+
+    positional_files = False  # : every thread gets its own position in index and storage files (readers-writer mode)
+
+    def __init__(self, path, page_cache_size=0):
+        """
+        :param path: database path
+        :param page_cache_size: memory budget (in bytes) of page cache shared by all indexes, 0 (default) disables it
+        """
         self.path = path
+        if page_cache_size:
+            self.page_cache = PageCache(page_cache_size)
+        else:
+            self.page_cache = None
         self.storage = None
         self.indexes = []
         self.id_ind = None
         self.indexes_names = {}
         self.opened = False
+        self.in_batch = False
 
     def create_new_rev(self, old_rev=None):
         """
@@ -305,6 +325,9 @@ class Database(object):
             name = ind_obj.name
         else:
             raise PreconditionsException("Argument must be Index instance, path to index_file or valid string index format")
+        for curr in getattr(ind_obj, 'shards', {0: ind_obj}).itervalues():
+            curr.page_cache = self.page_cache
+            curr.positional_files = self.positional_files
         return ind_obj, name
 
     def add_index(self, new_index, create=True, ind_kwargs=None):
@@ -725,6 +748,22 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         for index in self.indexes[1:]:
             self._single_insert_index(index, data, _id)
 
+    def _insert_many_entries(self, index, docs):
+        """
+        Yields ``(doc_id, key, value)`` entries of inserted documents for
+        :py:meth:`maras.index.Index.bulk_load_with_storage`
+        """
+        for data in docs:
+            try:
+                should_index = index.make_key_value(data)
+            except Exception as ex:
+                warnings.warn("""Problem during insert for `%s`, ex = `%r`, \
+you should check index code.""" % (index.name, ex), RuntimeWarning)
+                should_index = None
+            if should_index:
+                key, value = should_index
+                yield data['_id'], key, value
+
     def _single_delete_index(self, index, data, doc_id, old_data):
         """
         Performs single delete operation on single index.
@@ -788,14 +827,32 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         del self.indexes_names[index.name]
         self.indexes.remove(index)
 
-    def compact_index(self, index):
+    def compact_index(self, index, online=False, **kwargs):
         """
         Compacts index
         Used for better utilization of index metadata.
         The deleted documents will be not more in structure.
 
+        With ``online`` the index stays usable (from other threads) during
+        compaction, see :py:class:`maras.online_compaction.OnlineCompaction`.
+        That needs thread safe database
+        (:py:class:`maras.database_thread_safe.ThreadSafeDatabase` or
+        :py:class:`maras.database_rw_thread_safe.RWThreadSafeDatabase`),
+        which locks the index for the short start and finish steps.
+        :py:class:`Database` has no lock, there ``online`` compaction must
+        not run alongside other operations.
+
+        .. code-block:: python
+
+            db = ThreadSafeDatabase('/tmp/db')
+            ...
+            Thread(target=db.compact_index, args=('x',),
+                   kwargs={'online': True}).start()
+
         :param index: the index to destroy
         :type index: :py:class:`maras.index.Index`` instance, or string
+        :param online: keep the index usable while it's compacted
+        :param kwargs: passed to index ``compact`` (like ``node_capacity`` or ``page_size`` of tree indexes)
         """
         if isinstance(index, basestring):
             if not index in self.indexes_names:
@@ -807,22 +864,76 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         if getattr(index, 'compacting', False):
             raise ReindexException(
                 "The index=%s is still compacting" % index.name)
+        if online and self.in_batch:
+            raise PreconditionsException(
+                "Can't compact online inside batch")
         index.compacting = True
-        index.compact()
+        if online:
+            for curr in getattr(index, 'shards', {0: index}).itervalues():
+                OnlineCompaction(curr, self._index_lock(index), **kwargs).run()
+        else:
+            index.compact(**kwargs)
         del index.compacting
 
-    def _compact_indexes(self):
+    def train_dictionary(self, index, samples=1000, size=32 * 1024):
+        """
+        Trains compression dictionary of index storage on its first
+        ``samples`` records (see :py:meth:`maras.storage.IU_Storage.train_dictionary`).
+        The index has to use compression.
+
+        :param index: the index to train dictionary for
+        :type index: :py:class:`maras.index.Index`` instance, or string
+        :param samples: how many records to sample
+        :param size: maximum dictionary size
+        """
+        if isinstance(index, basestring):
+            if not index in self.indexes_names:
+                raise PreconditionsException("No index named %s" % index)
+            index = self.indexes_names[index]
+        elif not index in self.indexes:
+            self.__not_opened()
+            raise PreconditionsException("Argument must be Index instance or valid string index format")
+        for curr in getattr(index, 'shards', {0: index}).itervalues():
+            storage = curr.storage
+            values = []
+            for doc_id, key, start, _size, status in curr.all(samples):
+                if _size:
+                    values.append(storage.get(start, _size, status))
+            storage.train_dictionary(values, size)
+
+    def _index_lock(self, index):
+        """
+        Returns lock held by all operations on ``index``, ``None`` when
+        database is not thread safe
+        """
+        return None
+
+    def _compact_indexes(self, online=False):
         """
         Runs compact on all indexes
         """
         for index in self.indexes:
-            self.compact_index(index)
+            self.compact_index(index, online)
 
-    def _single_reindex_index(self, index, data):
-        doc_id, rev, start, size, status = self.id_ind.get(
-            data['_id'])  # it's cached so it's ok
-        if status != 'd' and status != 'u':
-            self._single_insert_index(index, data, doc_id)
+    def _reindex_entries(self, index, all_iter):
+        """
+        Yields ``(doc_id, key, value)`` entries of all documents for
+        :py:meth:`maras.index.Index.bulk_load_with_storage`
+        """
+        for data in all_iter:
+            doc_id, rev, start, size, status = self.id_ind.get(
+                data['_id'])  # it's cached so it's ok
+            if status == 'd' or status == 'u':
+                continue
+            try:
+                should_index = index.make_key_value(data)
+            except Exception as ex:
+                warnings.warn("""Problem during insert for `%s`, ex = `%r`, \
+you should check index code.""" % (index.name, ex), RuntimeWarning)
+                should_index = None
+            if should_index:
+                key, value = should_index
+                yield doc_id, key, value
 
     def reindex_index(self, index):
         """
@@ -851,14 +962,7 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         index.reindexing = True
         index.destroy()
         index.create_index()
-
-        while True:
-            try:
-                curr = all_iter.next()
-            except StopIteration:
-                break
-            else:
-                self._single_reindex_index(index, curr)
+        index.bulk_load_with_storage(self._reindex_entries(index, all_iter))
         del index.reindexing
 
     def _reindex_indexes(self):
@@ -896,6 +1000,45 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         data.update(ret)
         return ret
 
+    def insert_many(self, docs):
+        """
+        Inserts many documents at once, like :py:meth:`.insert` it's using
+        **references** on given dicts.
+
+        All writes are grouped as in :py:meth:`.batch`, **id** index is
+        filled first and then every other index gets all its entries in one
+        go (tree indexes get them sorted by key). When anything fails,
+        none of the documents is inserted.
+
+        :param docs: iterable of dicts to insert
+        :returns: list of ``{'_id': ..., '_rev': ...}`` dicts in ``docs`` order
+        """
+        self.__not_opened()
+        docs = list(docs)
+        for data in docs:
+            if '_rev' in data:
+                raise PreconditionsException(
+                    "Can't add record with forbidden fields")
+        ret = []
+        with self.batch():
+            for data in docs:
+                _rev = self.create_new_rev()
+                if not '_id' in data:
+                    try:
+                        data['_id'] = self.id_ind.create_key()
+                    except:
+                        raise DatabaseException("No id?")
+                assert data['_id'] is not None
+                data['_rev'] = _rev
+                data['_id'] = self._insert_id_index(_rev, data)
+                ret.append({'_id': data['_id'], '_rev': _rev})
+            for index in self.indexes[1:]:
+                index.bulk_load_with_storage(
+                    self._insert_many_entries(index, docs))
+        for data, curr in izip(docs, ret):
+            data.update(curr)
+        return ret
+
     def update(self, data):
         """
         It's using **reference** on the given data dict object,
@@ -920,7 +1063,7 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         data.update(ret)
         return ret
 
-    def get(self, index_name, key, with_doc=False, with_storage=True):
+    def get(self, index_name, key, with_doc=False, with_storage=True, lazy=False, fields=None):
         """
         Get single data from Database by ``key``.
 
@@ -928,6 +1071,8 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         :param key: key to get
         :param with_doc: if ``True`` data from **id** index will be included in output
         :param with_storage: if ``True`` data from index storage will be included, otherwise just metadata.
+        :param lazy: if ``True`` records are :py:class:`maras.lazy.LazyDocument` objects, decoded on field access
+        :param fields: if set only these fields of records are decoded and returned (applies to documents joined with ``with_doc`` too, they are made of index values without ``_rev`` when index includes all the fields)
         """
         # if not self.indexes_names.has_key(index_name):
         #     raise DatabaseException, "Invalid index name"
@@ -945,15 +1090,23 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             raise RecordNotFound("Not found")
         elif status == 'd':
             raise RecordDeleted("Deleted")
-        if with_storage and size:
+        if fields is not None:
+            fields = frozenset(fields)
+        covering = self._covering(ind, with_doc, fields)
+        if (with_storage or covering) and size:
             storage = ind.storage
-            data = storage.get(start, size, status)
+            data = self._record(storage.get(start, size, status, lazy=lazy,
+                                            fields=fields))
         else:
 
             data = {}
         if with_doc and index_name != 'id':
-            storage = ind.storage
-            doc = self.get('id', l_key, False)
+            if covering:
+                doc = self._covered_doc(l_key, data, fields)
+                if not with_storage:
+                    data = {}
+            else:
+                doc = self.get('id', l_key, False, lazy=lazy, fields=fields)
             if data:
                 data['doc'] = doc
             else:
@@ -965,7 +1118,163 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             data['key'] = _unk
         return data
 
-    def get_many(self, index_name, key=None, limit=-1, offset=0, with_doc=False, with_storage=True, start=None, end=None, **kwargs):
+    def get_multi(self, index_name, keys, with_doc=False, with_storage=True, lazy=False, fields=None):
+        """
+        Get data for many ``keys`` at once. All keys are looked up in
+        index first, then storage is read in offset order (records close
+        to each other are read together). The same is done for ``with_doc``.
+
+        :param index_name: index to get data from
+        :param keys: keys to get
+        :param with_doc: if ``True`` data from **id** index will be included in output
+        :param with_storage: if ``True`` data from index storage will be included, otherwise just metadata.
+
+        :param lazy: if ``True`` records are :py:class:`maras.lazy.LazyDocument` objects, decoded on field access
+        :param fields: if set only these fields of records are decoded and returned (applies to documents joined with ``with_doc`` too, they are made of index values without ``_rev`` when index includes all the fields)
+
+        :returns: list of records in ``keys`` order, ``None`` for keys that were not found or are deleted
+        """
+        try:
+            ind = self.indexes_names[index_name]
+        except KeyError:
+            self.__not_opened()
+            raise IndexNotFoundException(
+                "Index `%s` doesn't exists" % index_name)
+        if fields is not None:
+            fields = frozenset(fields)
+        covering = self._covering(ind, with_doc, fields)
+        found = []
+        reads = {}  # storage id -> (storage, positions, found indexes)
+        for key in keys:
+            try:
+                l_key, _unk, start, size, status = ind.get(key)
+            except ElemNotFound:
+                found.append(None)
+                continue
+            if (not start and not size) or status == 'd':
+                found.append(None)
+                continue
+            if (with_storage or covering) and size:
+                storage = ind.storage  # sharded index points at last used
+                try:
+                    read = reads[id(storage)]
+                except KeyError:
+                    read = reads[id(storage)] = (storage, [], [])
+                read[1].append((start, size, status))
+                read[2].append(len(found))
+            found.append((l_key, _unk))
+        datas = [None] * len(found)
+        for storage, positions, idxs in reads.itervalues():
+            datas_read = storage.get_multi(positions, lazy=lazy, fields=fields)
+            for i, data in izip(idxs, datas_read):
+                datas[i] = data
+        if with_doc and index_name != 'id' and not covering:
+            docs = self.get_multi(
+                'id', [curr[0] for curr in found if curr is not None],
+                lazy=lazy, fields=fields)
+            docs = iter(docs)
+        res = []
+        for curr, data in izip(found, datas):
+            if curr is None:
+                res.append(None)
+                continue
+            l_key, _unk = curr
+            data = self._record(data)
+            if with_doc and index_name != 'id':
+                if covering:
+                    doc = self._covered_doc(l_key, data, fields)
+                    if not with_storage:
+                        data = {}
+                    data['doc'] = doc
+                else:
+                    data['doc'] = next(docs)
+            data['_id'] = l_key
+            if index_name == 'id':
+                data['_rev'] = _unk
+            else:
+                data['key'] = _unk
+            res.append(data)
+        return res
+
+    def _covering(self, ind, with_doc, fields):
+        """
+        Tells if documents joined with ``with_doc`` can be made of index
+        values, when all requested ``fields`` are included in them
+        (see :py:attr:`maras.index.Index.included_fields`)
+        """
+        return bool(with_doc) and fields is not None and \
+            fields <= frozenset(ind.included_fields)
+
+    def _record(self, value):
+        """
+        Returns record for index ``value`` read from storage. Values which
+        aren't dicts (lists, numbers...) are put under ``value`` key, like
+        :py:meth:`all` does.
+        """
+        if value is None:
+            return {}
+        if isinstance(value, (dict, LazyDocument)):
+            return value
+        return {'value': value}
+
+    def _covered_doc(self, doc_id, value, fields):
+        """
+        Returns joined document made of index ``value``, without ``_rev``
+        (it's not known to index)
+        """
+        doc = dict((field, value[field]) for field in fields if field in value)
+        doc['_id'] = doc_id
+        return doc
+
+    def _read_values(self, gen, storage, with_storage, lazy, fields,
+                     with_doc=False):
+        """
+        Yields ``(index record, value, document)`` for index records from
+        ``gen``. Values and documents of ``read_batch`` records are read
+        together, in storage offset order (``None`` without
+        ``with_storage`` or value, and without ``with_doc``). Storage
+        is pinned while records are read, so their space isn't reused by
+        writes made in the meantime.
+        """
+        storage.pin()
+        try:
+            for res in self._read_batches(gen, storage, with_storage, lazy,
+                                          fields, with_doc):
+                yield res
+        finally:
+            storage.unpin()
+
+    def _read_batches(self, gen, storage, with_storage, lazy, fields,
+                      with_doc):
+        while True:
+            batch = list(islice(gen, self.read_batch))
+            if not batch:
+                return
+            if with_storage:
+                values = storage.get_multi([ind_data[-3:] for ind_data in batch],
+                                           lazy=lazy, fields=fields)
+            else:
+                values = [None] * len(batch)
+            if with_doc:
+                docs = self.get_multi('id', [ind_data[0] for ind_data in batch],
+                                      lazy=lazy, fields=fields)
+            else:
+                docs = [None] * len(batch)
+            for ind_data, value, doc in izip(batch, values, docs):
+                if with_doc and doc is None:
+                    raise RecordNotFound("Not found")
+                yield ind_data, value, doc
+
+    def _split_cursors(self, gen, cursors):
+        """
+        Yields index records of ``(record, cursor)`` pairs from ``gen``,
+        cursors are appended to ``cursors`` deque in the same order
+        """
+        for record, cursor in gen:
+            cursors.append(cursor)
+            yield record
+
+    def get_many(self, index_name, key=None, limit=-1, offset=0, with_doc=False, with_storage=True, start=None, end=None, lazy=False, fields=None, cursor=None, **kwargs):
         """
         Allows to get **multiple** data for given ``key`` for *Hash based indexes*.
         Also allows get **range** queries for *Tree based indexes* with ``start`` and ``end`` arguments.
@@ -978,6 +1287,9 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         :param with_storage: if ``True`` data from index storage will be included, otherwise just metadata.
         :param start: ``start`` parameter for range queries
         :param end: ``end`` parameter for range queries
+        :param lazy: if ``True`` records are :py:class:`maras.lazy.LazyDocument` objects, decoded on field access
+        :param fields: if set only these fields of records are decoded and returned (applies to documents joined with ``with_doc`` too, they are made of index values without ``_rev`` when index includes all the fields)
+        :param cursor: if set records get ``_cursor`` token, passing ``_cursor`` of the last record returns records following it (``''`` starts from beginning, range queries have to be ascending)
 
         :returns: iterator over records
         """
@@ -990,35 +1302,41 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             self.__not_opened()
             raise IndexNotFoundException(
                 "Index `%s` doesn't exists" % index_name)
+        if fields is not None:
+            fields = frozenset(fields)
         storage = ind.storage
+        if cursor is not None:
+            kwargs['cursor'] = cursor
         if start is None and end is None:
-            gen = ind.get_many(key, limit, offset)
+            gen = ind.get_many(key, limit, offset, **kwargs)
         else:
             gen = ind.get_between(start, end, limit, offset, **kwargs)
-        while True:
-            try:
-#                l_key, start, size, status = gen.next()
-                ind_data = gen.next()
-            except StopIteration:
-                break
-            else:
-                if with_storage and ind_data[-2]:
-                    data = storage.get(*ind_data[-3:])
+        if cursor is not None:
+            cursors = deque()
+            gen = self._split_cursors(gen, cursors)
+        covering = self._covering(ind, with_doc, fields)
+        for ind_data, data, doc in self._read_values(
+                gen, storage, with_storage or covering, lazy, fields,
+                with_doc and not covering):
+            data = self._record(data)
+            doc_id = ind_data[0]
+            if with_doc:
+                if covering:
+                    doc = self._covered_doc(doc_id, data, fields)
+                    if not with_storage:
+                        data = {}
+                if data:
+                    data['doc'] = doc
                 else:
-                    data = {}
-                doc_id = ind_data[0]
-                if with_doc:
-                    doc = self.get('id', doc_id, False)
-                    if data:
-                        data['doc'] = doc
-                    else:
-                        data = {'doc': doc}
-                data['_id'] = doc_id
-                if key is None:
-                    data['key'] = ind_data[1]
-                yield data
+                    data = {'doc': doc}
+            data['_id'] = doc_id
+            if key is None:
+                data['key'] = ind_data[1]
+            if cursor is not None:
+                data['_cursor'] = cursors.popleft()
+            yield data
 
-    def all(self, index_name, limit=-1, offset=0, with_doc=False, with_storage=True):
+    def all(self, index_name, limit=-1, offset=0, with_doc=False, with_storage=True, lazy=False, fields=None, cursor=None):
         """
         Alows to get all records for given index
 
@@ -1027,6 +1345,9 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         :param offset: defines offset (how many records from start it will ignore)
         :param with_doc: if ``True`` data from **id** index will be included in output
         :param with_storage: if ``True`` data from index storage will be included, otherwise just metadata
+        :param lazy: if ``True`` records are :py:class:`maras.lazy.LazyDocument` objects, decoded on field access
+        :param fields: if set only these fields of records are decoded and returned (applies to documents joined with ``with_doc`` too, they are made of index values without ``_rev`` when index includes all the fields)
+        :param cursor: if set records get ``_cursor`` token, passing ``_cursor`` of the last record returns records following it (``''`` starts from beginning)
         """
         try:
             ind = self.indexes_names[index_name]
@@ -1034,31 +1355,39 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             self.__not_opened()
             raise IndexNotFoundException(
                 "Index `%s` doesn't exists" % index_name)
+        if fields is not None:
+            fields = frozenset(fields)
         storage = ind.storage
-        gen = ind.all(limit, offset)
-        while True:
-            try:
-                doc_id, unk, start, size, status = gen.next()
-            except StopIteration:
-                break
-            else:
-                if index_name == 'id':
-                    if with_storage and size:
-                        data = storage.get(start, size, status)
-                    else:
-                        data = {}
-                    data['_id'] = doc_id
-                    data['_rev'] = unk
+        if cursor is None:
+            gen = ind.all(limit, offset)
+        else:
+            cursors = deque()
+            gen = self._split_cursors(ind.all(limit, offset, cursor), cursors)
+        covering = index_name != 'id' and self._covering(ind, with_doc, fields)
+        for ind_data, value, doc in self._read_values(
+                gen, storage, with_storage or covering, lazy, fields,
+                with_doc and index_name != 'id' and not covering):
+            doc_id, unk, start, size, status = ind_data
+            if index_name == 'id':
+                if value is not None:
+                    data = value
                 else:
                     data = {}
-                    if with_storage and size:
-                        data['value'] = storage.get(start, size, status)
-                    data['key'] = unk
-                    data['_id'] = doc_id
-                    if with_doc:
-                        doc = self.get('id', doc_id, False)
-                        data['doc'] = doc
-                yield data
+                data['_id'] = doc_id
+                data['_rev'] = unk
+            else:
+                data = {}
+                if value is not None and with_storage:
+                    data['value'] = value
+                data['key'] = unk
+                data['_id'] = doc_id
+                if with_doc:
+                    if covering:
+                        doc = self._covered_doc(doc_id, value or {}, fields)
+                    data['doc'] = doc
+            if cursor is not None:
+                data['_cursor'] = cursors.popleft()
+            yield data
 
     def run(self, index_name, target_funct, *args, **kwargs):
         """
@@ -1094,12 +1423,23 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
             db.count(db.all, 'id')
 
         And it will return then how much records are in your ``id`` index.
+        Whole index counts are taken from index ``count`` method when it
+        has one (hash indexes count entries without decoding them).
 
         .. warning::
             It sets ``kwargs['with_storage'] = False`` and ``kwargs['with_doc'] = False``
 
 
         """
+        if target_funct == self.all and len(args) == 1 and not kwargs:
+            try:
+                ind = self.indexes_names[args[0]]
+            except KeyError:
+                pass
+            else:
+                shards = getattr(ind, 'shards', {0: ind}).values()
+                if all(hasattr(curr, 'count') for curr in shards):
+                    return sum(curr.count() for curr in shards)
         kwargs['with_storage'] = False
         kwargs['with_doc'] = False
         iter_ = target_funct(*args, **kwargs)
@@ -1134,12 +1474,14 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         self._delete_indexes(_id, _rev, data)
         return True
 
-    def compact(self):
+    def compact(self, online=False):
         """
         Compact all indexes. Runs :py:meth:`._compact_indexes` behind.
+
+        :param online: keep indexes usable while they are compacted, see :py:meth:`.compact_index`
         """
         self.__not_opened()
-        self._compact_indexes()
+        self._compact_indexes(online)
 
     def reindex(self):
         """
@@ -1148,6 +1490,52 @@ you should check index code.""" % (index.name, ex), RuntimeWarning)
         self.__not_opened()
         self._reindex_indexes()
 
+    @contextmanager
+    def batch(self, fsync=False):
+        """
+        Groups many write operations together. Writes to all indexes and
+        their storages are kept in memory until the block ends, then they
+        are written back at once with single flush.
+
+        When the block raises, the buffered writes are dropped.
+
+        .. code-block:: python
+
+            with db.batch():
+                for doc in docs:
+                    db.insert(doc)
+
+        :param fsync: if ``True`` call :py:meth:`.fsync` after write back
+        """
+        self.__not_opened()
+        if any(getattr(index, 'compacting', False) for index in self.indexes):
+            raise PreconditionsException(
+                "Can't start batch during compaction")
+        if self.in_batch:  # nested batch joins the outer one
+            yield self
+            return
+        self.in_batch = True
+        for index in self.indexes:
+            index.begin_batch()
+        commit = False
+        try:
+            yield self
+            commit = True
+        finally:
+            self.in_batch = False
+            # every index is released even when write back of one fails,
+            # otherwise their next writes would stay buffered
+            exc_info = None
+            for index in self.indexes:
+                try:
+                    index.end_batch(commit)
+                except Exception:
+                    exc_info = exc_info or sys.exc_info()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        if fsync:
+            self.fsync()
+
     def flush_indexes(self):
         """
         Flushes all indexes
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from threading import RLock
+from contextlib import contextmanager
+
+from maras.env import menv
+
+menv['mode'] = 'threads'
+menv['rlock_obj'] = RLock
+
+from maras.rw_lock import RWLock
+from database_safe_shared import SafeDatabase
+
+
+class RWThreadSafeDatabase(SafeDatabase):
+    '''
+    Thread safe version of maras with readers-writer lock per index.
+    Reads of an index (``get``, ``get_many``, ``all``...) run at once in
+    many threads, writes take the index lock exclusively.
+
+    Index and storage files get separate file position for every thread
+    (see :py:class:`maras.positional_file.PositionalFile`), so readers
+    don't share ``seek`` + ``read`` state.
+    '''
+
+    positional_files = True
+
+    def _new_lock(self):
+        return RWLock()
+
+    def _read_lock(self, name):
+        return self.indexes_locks[name].shared
+
+    @contextmanager
+    def batch(self, fsync=False):
+        # batched writes are buffered in memory with single file position,
+        # no reads while the batch lasts. Locks are taken in the order
+        # readers take them (index before `id` for ``with_doc``).
+        locks = [self.indexes_locks[index.name]
+                 for index in self.indexes[1:] + self.indexes[:1]]
+        for lock in locks:
+            lock.acquire()
+        try:
+            with super(RWThreadSafeDatabase, self).batch(fsync) as db:
+                yield db
+        finally:
+            for lock in reversed(locks):
+                lock.release()
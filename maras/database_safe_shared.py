@@ -57,36 +57,51 @@ def safe_wrapper(method, lock):
 
 class SafeDatabase(Database):
 
+    # index and storage methods which don't change them
+    shared_methods = frozenset(('get', 'get_many', 'get_between', 'get_multi',
+                                'all', 'all_batches', 'count', 'make_key',
+                                'make_key_value', 'include_fields',
+                                'data_from', 'data_to', 'segment_stats',
+                                'pin', 'unpin'))
+
     def __init__(self, path, *args, **kwargs):
         super(SafeDatabase, self).__init__(path, *args, **kwargs)
-        self.indexes_locks = defaultdict(
-            lambda: menv['rlock_obj']())
+        self.indexes_locks = defaultdict(self._new_lock)
         self.close_open_lock = menv['rlock_obj']()
         self.main_lock = menv['rlock_obj']()
         self.id_revs = {}
 
+    def _new_lock(self):
+        return menv['rlock_obj']()
+
+    def _read_lock(self, name):
+        """
+        Lock held by reads of index ``name``
+        """
+        return self.indexes_locks[name]
+
     def __patch_index_gens(self, name):
         ind = self.indexes_names[name]
         for c in ('all', 'get_many'):
             m = getattr(ind, c)
             if getattr(ind, c + "_orig", None):
                 return
-            m_fixed = th_safe_gen.wrapper(m, name, c, self.indexes_locks[name])
+            m_fixed = th_safe_gen.wrapper(m, name, c, self._read_lock(name))
             setattr(ind, c, m_fixed)
             setattr(ind, c + '_orig', m)
 
     def __patch_index_methods(self, name):
         ind = self.indexes_names[name]
         lock = self.indexes_locks[name]
-        for curr in dir(ind):
-            meth = getattr(ind, curr)
-            if not curr.startswith('_') and isinstance(meth, MethodType):
-                setattr(ind, curr, safe_wrapper(meth, lock))
-        stor = ind.storage
-        for curr in dir(stor):
-            meth = getattr(stor, curr)
-            if not curr.startswith('_') and isinstance(meth, MethodType):
-                setattr(stor, curr, safe_wrapper(meth, lock))
+        read_lock = self._read_lock(name)
+        for obj in (ind, ind.storage):
+            for curr in dir(obj):
+                meth = getattr(obj, curr)
+                if not curr.startswith('_') and isinstance(meth, MethodType):
+                    if curr in self.shared_methods:
+                        setattr(obj, curr, safe_wrapper(meth, read_lock))
+                    else:
+                        setattr(obj, curr, safe_wrapper(meth, lock))
 
     def __patch_index(self, name):
         self.__patch_index_methods(name)
@@ -97,14 +112,14 @@ class SafeDatabase(Database):
             self.close_open_lock.acquire()
             res = super(SafeDatabase, self).initialize(*args, **kwargs)
             for name in self.indexes_names.iterkeys():
-                self.indexes_locks[name] = menv['rlock_obj']()
+                self.indexes_locks[name] = self._new_lock()
             return res
 
     def open(self, *args, **kwargs):
         with self.close_open_lock:
             res = super(SafeDatabase, self).open(*args, **kwargs)
             for name in self.indexes_names.iterkeys():
-                self.indexes_locks[name] = menv['rlock_obj']()
+                self.indexes_locks[name] = self._new_lock()
                 self.__patch_index(name)
             return res
 
@@ -112,7 +127,7 @@ class SafeDatabase(Database):
         with self.close_open_lock:
             res = super(SafeDatabase, self).create(*args, **kwargs)
             for name in self.indexes_names.iterkeys():
-                self.indexes_locks[name] = menv['rlock_obj']()
+                self.indexes_locks[name] = self._new_lock()
                 self.__patch_index(name)
             return res
 
@@ -128,7 +143,7 @@ class SafeDatabase(Database):
         with self.main_lock:
             res = super(SafeDatabase, self).add_index(*args, **kwargs)
             if self.opened:
-                self.indexes_locks[res] = menv['rlock_obj']()
+                self.indexes_locks[res] = self._new_lock()
                 self.__patch_index(res)
             return res
 
@@ -146,7 +161,7 @@ class SafeDatabase(Database):
         with self.main_lock:
             res = super(SafeDatabase, self).edit_index(*args, **kwargs)
             if self.opened:
-                self.indexes_locks[res] = menv['rlock_obj']()
+                self.indexes_locks[res] = self._new_lock()
                 self.__patch_index(res)
             return res
 
@@ -168,7 +183,7 @@ class SafeDatabase(Database):
             lock = self.indexes_locks[index.name + "reind"]
         else:
             self.indexes_locks[index.name +
-                               "reind"] = menv['rlock_obj']()
+                               "reind"] = self._new_lock()
             lock = self.indexes_locks[index.name + "reind"]
         self.main_lock.release()
         try:
@@ -192,6 +207,30 @@ class SafeDatabase(Database):
         finally:
             self.main_lock.release()
 
+    def _index_lock(self, index):
+        return self.indexes_locks[index.name]
+
+    # index lookup and storage read are done under one lock, storage
+    # space of replaced values is reused by next writes
+
+    def get(self, index_name, *args, **kwargs):
+        with self._read_lock(index_name):
+            return super(SafeDatabase, self).get(index_name, *args, **kwargs)
+
+    def get_multi(self, index_name, *args, **kwargs):
+        with self._read_lock(index_name):
+            return super(SafeDatabase, self).get_multi(index_name, *args, **kwargs)
+
+    def get_many(self, index_name, *args, **kwargs):
+        gen = super(SafeDatabase, self).get_many(index_name, *args, **kwargs)
+        return th_safe_gen(index_name + "_get_many", gen,
+                           self._read_lock(index_name))
+
+    def all(self, index_name, *args, **kwargs):
+        gen = super(SafeDatabase, self).all(index_name, *args, **kwargs)
+        return th_safe_gen(index_name + "_all", gen,
+                           self._read_lock(index_name))
+
     def _update_id_index(self, _rev, data):
         with self.indexes_locks['id']:
             return super(SafeDatabase, self)._update_id_index(_rev, data)
@@ -28,14 +28,20 @@ from maras.index import (Index,
                          DocIdNotFound,
                          ElemNotFound,
                          TryReindexException,
-                         IndexPreconditionsException)
-from maras.storage import IU_Storage, DummyStorage
+                         IndexPreconditionsException,
+                         encode_cursor,
+                         decode_cursor)
+from maras.storage import IU_Storage, DummyStorage, SegmentedStorage
+from maras.storage import storage_offset_format
 from maras.env import menv
 if menv.get('rlock_obj'):
     from maras import patch
     patch.patch_cache_rr(menv['rlock_obj'])
 from maras.rr_cache import cache1lvl
-from maras.misc import random_hex_40
+from maras.misc import random_hex_40, random_hex_32
+from maras.batch_file import BatchFile
+from maras.positional_file import positional
+from maras.hashing import hash_functions, default_hash_func
 
 
 class IU_HashIndex(Index):
@@ -46,6 +52,11 @@ class IU_HashIndex(Index):
     That design is because main index logic should be always in database
     not in custom user indexes.
     '''
+
+    entry_key_index = 1  # : position of key in unpacked entry
+
+    scan_entries = 1024  # : entries read and decoded at once by scans
+
     def __init__(
             self,
             db_path,
@@ -53,9 +64,16 @@ class IU_HashIndex(Index):
             entry_line_format='<40s{key}IIcI',
             hash_lim=0xfffff,
             storage_class=None,
-            key_format='c'):
+            key_format='c',
+            use_mmap=False,
+            max_load=2,
+            hash_func=None,
+            offset_format=None,
+            compression=None):
         '''
-        The index is capable to solve conflicts by `Separate chaining`
+        The index is capable to solve conflicts by `Separate chaining`.
+        Bucket table grows one bucket at time (linear hashing) when there
+        is more than ``max_load`` entries per bucket.
         :param db_path: database path
         :type db_path: string
         :param name: index name
@@ -67,19 +85,41 @@ class IU_HashIndex(Index):
         :param storage_class: Storage class by default it will open standard :py:class:`maras.storage.Storage` (if string has to be accesible by globals()[storage_class])
         :type storage_class: class name which will be instance of maras.storage.Storage instance or None
         :param key_format: a index key format
+        :param use_mmap: serve bucket and storage reads from memory mapped files
+        :type use_mmap: bool
+        :param max_load: entries per bucket that trigger bucket split, 0 disables growth (it's also disabled when `hash_lim` + 1 is not power of 2)
+        :type max_load: number
+        :param hash_func: name of function from :py:data:`maras.hashing.hash_functions` used to place keys in buckets, stored in index props
+        :type hash_func: string or None (:py:data:`maras.hashing.default_hash_func`)
+        :param offset_format: format of start, size and next entry fields (when `line_format` ends with `IIcI`) and of bucket pointers, `Q` lets files grow past 4 GB
+        :type offset_format: `I` or `Q` (by default the one `storage_class` needs, see :py:func:`maras.storage.storage_offset_format`)
+        :param compression: name of codec from :py:data:`maras.compression.codecs` used for storage records, stored in index props
+        :type compression: string or None
         '''
+        if offset_format is None:
+            offset_format = storage_offset_format(storage_class)
         if key_format and '{key}' in entry_line_format:
             entry_line_format = entry_line_format.replace('{key}', key_format)
+        if offset_format != 'I' and entry_line_format.endswith('IIcI'):
+            entry_line_format = entry_line_format[:-4] + \
+                '{0}{0}c{0}'.format(offset_format)
         super(IU_HashIndex, self).__init__(db_path, name)
         self.hash_lim = hash_lim
+        self.use_mmap = use_mmap
+        self.max_load = max_load
+        self.hash_func = hash_func or default_hash_func
+        self._hash = hash_functions[self.hash_func]
+        self.buckets_ext = None
         if not storage_class:
             storage_class = IU_Storage
         if storage_class and not isinstance(storage_class, basestring):
             storage_class = storage_class.__name__
         self.storage_class = storage_class
         self.storage = None
+        self.compression = compression
 
-        self.bucket_line_format = '<I'
+        # buckets point to entries as next field of entry does
+        self.bucket_line_format = '<' + entry_line_format[-1]
         self.bucket_line_size = struct.calcsize(self.bucket_line_format)
         self.entry_line_format = entry_line_format
         self.entry_line_size = struct.calcsize(self.entry_line_format)
@@ -89,15 +129,27 @@ class IU_HashIndex(Index):
         self._locate_doc_id = cache(self._locate_doc_id)
         self.bucket_struct = struct.Struct(self.bucket_line_format)
         self.entry_struct = struct.Struct(self.entry_line_format)
+        self.status_offset = struct.calcsize(
+            self.entry_line_format[:self.entry_line_format.rindex('c')])
+        self._scan_structs = {}
         self.data_start = (
             self.hash_lim + 1) * self.bucket_line_size + self._start_ind + 2
+        self.buckets_nr = self.hash_lim + 1
+        self._count_buckets()
 
     def _fix_params(self):
+        # indexes created without hash_func in props used builtin hash
+        self.hash_func = 'python'
+        self.generation = ''  # : new for every created (or compacted) bucket file
         super(IU_HashIndex, self)._fix_params()
+        self._hash = hash_functions[self.hash_func]
         self.bucket_line_size = struct.calcsize(self.bucket_line_format)
         self.entry_line_size = struct.calcsize(self.entry_line_format)
         self.bucket_struct = struct.Struct(self.bucket_line_format)
         self.entry_struct = struct.Struct(self.entry_line_format)
+        self.status_offset = struct.calcsize(
+            self.entry_line_format[:self.entry_line_format.rindex('c')])
+        self._scan_structs = {}
         self.data_start = (
             self.hash_lim + 1) * self.bucket_line_size + self._start_ind + 2
 
@@ -107,37 +159,116 @@ class IU_HashIndex(Index):
         self.buckets = io.open(
             os.path.join(self.db_path, self.name + '_buck'), 'r+b', buffering=0)
         self._fix_params()
+        self._map_buckets()
+        self._open_buckets_ext()
         self._open_storage()
+        self._open_bloom()
+
+    def _open_buckets_ext(self):
+        '''
+        Opens file with buckets added by splits (if there were any)
+        '''
+        path = os.path.join(self.db_path, self.name + '_buck_ext')
+        self.buckets_ext = None
+        self.buckets_nr = self.hash_lim + 1
+        if os.path.isfile(path):
+            self.buckets_ext = positional(io.open(path, 'r+b', buffering=0),
+                                          self.positional_files)
+            self.buckets_ext.seek(0, 2)
+            self.buckets_nr += self.buckets_ext.tell() // self.bucket_line_size
+        self._count_buckets()
+
+    def _count_buckets(self):
+        '''
+        Sets linear hashing level mask and next bucket to split
+        '''
+        low = self.hash_lim + 1
+        while low * 2 <= self.buckets_nr:
+            low *= 2
+        self._hash_mask = low - 1
+        self._hash_split = self.buckets_nr - low
+
+    @property
+    def offset_format(self):
+        '''
+        Format of pointers to bucket file, saved props decide for opened index
+        '''
+        return self.bucket_line_format[-1]
+
+    @property
+    def load_factor(self):
+        '''
+        Entries (with deleted ones) per bucket
+        '''
+        self.buckets.seek(0, 2)
+        entries = max(self.buckets.tell() - self.data_start, 0) // self.entry_line_size
+        return float(entries) / self.buckets_nr
 
     def create_index(self):
         if os.path.isfile(os.path.join(self.db_path, self.name + '_buck')):
             raise IndexException('Already exists')
+        # entry ends with start, size, status and next fields
+        self._check_start_format(globals()[self.storage_class],
+                                 self.entry_line_format[-4])
         with io.open(os.path.join(self.db_path, self.name + '_buck'), 'w+b') as f:
             props = dict(name=self.name,
                          bucket_line_format=self.bucket_line_format,
                          entry_line_format=self.entry_line_format,
                          hash_lim=self.hash_lim,
                          version=self.__version__,
-                         storage_class=self.storage_class)
+                         storage_class=self.storage_class,
+                         use_mmap=self.use_mmap,
+                         max_load=self.max_load,
+                         hash_func=self.hash_func,
+                         compression=self.compression,
+                         generation=random_hex_32())
             f.write(msgpack.dumps(props))
+        self.generation = props['generation']
         self.buckets = io.open(
             os.path.join(self.db_path, self.name + '_buck'), 'r+b', buffering=0)
+        self._map_buckets()
+        self._destroy_buckets_ext()
+        self._open_buckets_ext()
         self._create_storage()
+        self._create_bloom()
 
     def destroy(self):
         super(IU_HashIndex, self).destroy()
+        self._destroy_buckets_ext()
         self._clear_cache()
 
+    def _destroy_buckets_ext(self):
+        path = os.path.join(self.db_path, self.name + '_buck_ext')
+        if os.path.isfile(path):
+            os.unlink(path)
+
+    def _close(self):
+        super(IU_HashIndex, self)._close()
+        if self.buckets_ext is not None:
+            self.buckets_ext.close()
+            self.buckets_ext = None
+
+    def fsync(self):
+        super(IU_HashIndex, self).fsync()
+        if self.buckets_ext is not None:
+            os.fsync(self.buckets_ext.fileno())
+
     def _open_storage(self):
         s = globals()[self.storage_class]
         if not self.storage:
-            self.storage = s(self.db_path, self.name)
+            self.storage = s(self.db_path, self.name, use_mmap=self.use_mmap,
+                               page_cache=self.page_cache,
+                               compression=self.compression,
+                               positional_files=self.positional_files)
         self.storage.open()
 
     def _create_storage(self):
         s = globals()[self.storage_class]
         if not self.storage:
-            self.storage = s(self.db_path, self.name)
+            self.storage = s(self.db_path, self.name, use_mmap=self.use_mmap,
+                               page_cache=self.page_cache,
+                               compression=self.compression,
+                               positional_files=self.positional_files)
         self.storage.create()
 
     # def close_index(self):
@@ -151,11 +282,8 @@ class IU_HashIndex(Index):
 
         :param key: the key to find
         '''
-        start_position = self._calculate_position(key)
-        self.buckets.seek(start_position)
-        curr_data = self.buckets.read(self.bucket_line_size)
-        if curr_data:
-            location = self.bucket_struct.unpack(curr_data)[0]
+        location = self._read_bucket(self._calculate_bucket(key))
+        if location is not None:
             if not location:
                 return None, None, 0, 0, 'u'
             found_at, doc_id, l_key, start, size, status, _next = self._locate_key(
@@ -170,13 +298,16 @@ class IU_HashIndex(Index):
         else:
             return None, None, 0, 0, 'u'
 
-    def _find_key_many(self, key, limit=1, offset=0):
-        location = None
-        start_position = self._calculate_position(key)
-        self.buckets.seek(start_position)
-        curr_data = self.buckets.read(self.bucket_line_size)
-        if curr_data:
-            location = self.bucket_struct.unpack(curr_data)[0]
+    def _find_key_many(self, key, limit=1, offset=0, cursor=None):
+        if cursor:
+            # continue along the chain of the last returned entry
+            self.buckets.seek(self._cursor_entry(cursor, 'hc'))
+            data = self.buckets.read(self.entry_line_size)
+            if len(data) != self.entry_line_size:
+                raise IndexException("Invalid cursor")
+            location = self.entry_struct.unpack(data)[-1]
+        else:
+            location = self._read_bucket(self._calculate_bucket(key))
         while offset:
             if not location:
                 break
@@ -201,12 +332,115 @@ class IU_HashIndex(Index):
             else:
                 if status != 'd':
                     if l_key == key:  # in case of hash function conflicts
-                        yield doc_id, start, size, status
+                        if cursor is None:
+                            yield doc_id, start, size, status
+                        else:
+                            yield ((doc_id, start, size, status),
+                                   encode_cursor('hc', self.generation, found_at))
                         limit -= 1
                 location = _next
 
-    def _calculate_position(self, key):
-        return abs(hash(key) & self.hash_lim) * self.bucket_line_size + self._start_ind
+    def _cursor_entry(self, cursor, kind):
+        '''
+        Returns position of entry which ``cursor`` points at. Cursors hold
+        :py:attr:`generation` of bucket file too, compaction replaces the
+        file and moves entries, so older cursors are refused.
+        '''
+        parts = decode_cursor(cursor, kind)
+        if len(parts) != 2:
+            raise IndexException("Invalid cursor")
+        generation, pos = parts
+        if not isinstance(pos, (int, long)) or pos < self.data_start or \
+                (pos - self.data_start) % self.entry_line_size:
+            raise IndexException("Invalid cursor")
+        if generation != self.generation:
+            raise IndexException("Cursor made before index compaction")
+        return pos
+
+    def _calculate_bucket(self, key):
+        h = self._hash(key)
+        bucket = h & self._hash_mask
+        if bucket < self._hash_split:  # already split in this level
+            bucket = h & (self._hash_mask << 1 | 1)
+        return bucket
+
+    def _read_bucket(self, bucket):
+        '''
+        Returns location of first entry in bucket, None when bucket
+        was never written
+        '''
+        if bucket <= self.hash_lim:
+            f = self.buckets
+            f.seek(bucket * self.bucket_line_size + self._start_ind)
+        else:
+            f = self.buckets_ext
+            f.seek((bucket - self.hash_lim - 1) * self.bucket_line_size)
+        curr_data = f.read(self.bucket_line_size)
+        if curr_data:
+            return self.bucket_struct.unpack(curr_data)[0]
+        return None
+
+    def _write_bucket(self, bucket, location):
+        if bucket <= self.hash_lim:
+            f = self.buckets
+            f.seek(bucket * self.bucket_line_size + self._start_ind)
+        else:
+            if self.buckets_ext is None:
+                self._create_buckets_ext()
+            f = self.buckets_ext
+            f.seek((bucket - self.hash_lim - 1) * self.bucket_line_size)
+        f.write(self.bucket_struct.pack(location))
+
+    def _create_buckets_ext(self):
+        self.buckets_ext = positional(io.open(
+            os.path.join(self.db_path, self.name + '_buck_ext'), 'w+b', buffering=0),
+            self.positional_files)
+        if isinstance(self.buckets, BatchFile):
+            self.buckets_ext = BatchFile(self.buckets_ext)
+
+    def _check_load(self, wrote_at):
+        '''
+        Splits next bucket when there is too many entries per bucket,
+        `wrote_at` is position of the last entry
+        '''
+        if not self.max_load or self.hash_lim & (self.hash_lim + 1):
+            return
+        entries = (wrote_at - self.data_start) // self.entry_line_size + 1
+        if entries > self.max_load * self.buckets_nr:
+            self._split_bucket()
+
+    def _split_bucket(self):
+        '''
+        Splits next bucket in linear hashing order. Entries stay where
+        they are, they're just relinked between the old bucket and the new
+        one (appended to `_buck_ext` file).
+        '''
+        old = self._hash_split
+        new_mask = self._hash_mask << 1 | 1
+        chains = ([], [])
+        location = self._read_bucket(old)
+        while location:
+            self.buckets.seek(location)
+            entry = self.entry_struct.unpack(
+                self.buckets.read(self.entry_line_size))
+            moved = self._hash(entry[self.entry_key_index]) & new_mask != old
+            chains[moved].append((location, entry))
+            location = entry[-1]
+        for chain in chains:
+            for i, (location, entry) in enumerate(chain):
+                if i + 1 < len(chain):
+                    _next = chain[i + 1][0]
+                else:
+                    _next = 0
+                if entry[-1] != _next:
+                    self.buckets.seek(location)
+                    self.buckets.write(
+                        self.entry_struct.pack(*entry[:-1] + (_next,)))
+                    self._locate_doc_id.delete(entry[0])
+        self._write_bucket(old, chains[0][0][0] if chains[0] else 0)
+        self._write_bucket(self.buckets_nr, chains[1][0][0] if chains[1] else 0)
+        self.buckets_nr += 1
+        self._count_buckets()
 
     # TODO add cache!
     def _locate_key(self, key, start):
@@ -286,13 +520,9 @@ class IU_HashIndex(Index):
                 location = _next  # go to next record
 
     def update(self, doc_id, key, u_start=0, u_size=0, u_status='o'):
-        start_position = self._calculate_position(key)
-        self.buckets.seek(start_position)
-        curr_data = self.buckets.read(self.bucket_line_size)
+        location = self._read_bucket(self._calculate_bucket(key))
         # test if it's unique or not really unique hash
-        if curr_data:
-            location = self.bucket_struct.unpack(curr_data)[0]
-        else:
+        if location is None:
             raise ElemNotFound("Location '%s' not found" % doc_id)
         found_at, _doc_id, _key, start, size, status, _next = self._locate_doc_id(doc_id, key, location)
         self.buckets.seek(found_at)
@@ -303,22 +533,21 @@ class IU_HashIndex(Index):
                                                   u_status,
                                                   _next))
         self.flush()
+        if u_status == 'd' or (u_start, u_size) != (start, size):
+            self._free_value(start, size, status)
         self._find_key.delete(key)
         self._locate_doc_id.delete(doc_id)
         return True
 
     def insert(self, doc_id, key, start, size, status='o'):
-        start_position = self._calculate_position(key)
-        self.buckets.seek(start_position)
-        curr_data = self.buckets.read(self.bucket_line_size)
+        self._bloom_add(key)
+        bucket = self._calculate_bucket(key)
+        location = self._read_bucket(bucket)
 
         # conflict occurs?
-        if curr_data:
-            location = self.bucket_struct.unpack(curr_data)[0]
-        else:
-            location = 0
         if location:
             # last key with that hash
+            wrote_at = None
             try:
                 found_at, _doc_id, _key, _start, _size, _status, _next = self._locate_doc_id(doc_id, key, location)
             except DocIdNotFound:
@@ -352,6 +581,8 @@ class IU_HashIndex(Index):
             self._find_key.delete(_key)
             # self._find_key.delete(key)
             # self._locate_key.delete(_key)
+            if wrote_at is not None:
+                self._check_load(wrote_at)
             return True
             # raise NotImplementedError
         else:
@@ -371,42 +602,146 @@ class IU_HashIndex(Index):
                                                       0))
 #            self.flush()
             self._find_key.delete(key)
-            self.buckets.seek(start_position)
-            self.buckets.write(self.bucket_struct.pack(wrote_at))
+            self._write_bucket(bucket, wrote_at)
             self.flush()
+            self._check_load(wrote_at)
             return True
 
     def get(self, key):
-        return self._find_key(self.make_key(key))
+        key = self.make_key(key)
+        if self._bloom_miss(key):
+            return None, None, 0, 0, 'u'
+        return self._find_key(key)
 
-    def get_many(self, key, limit=1, offset=0):
-        return self._find_key_many(self.make_key(key), limit, offset)
+    def get_many(self, key, limit=1, offset=0, cursor=None):
+        key = self.make_key(key)
+        if self._bloom_miss(key):
+            return iter(())
+        return self._find_key_many(key, limit, offset, cursor)
 
-    def all(self, limit=-1, offset=0):
-        self.buckets.seek(self.data_start)
-        while offset:
-            curr_data = self.buckets.read(self.entry_line_size)
-            if not curr_data:
-                break
-            try:
-                doc_id, key, start, size, status, _next = self.entry_struct.unpack(curr_data)
-            except IndexException:
+    def _scan(self, pos=None):
+        '''
+        Yields entry area read in chunks of :py:attr:`scan_entries`
+        entries (whole entries only), from ``pos`` when given
+        '''
+        chunk = self.scan_entries * self.entry_line_size
+        if pos is None:
+            pos = self.data_start
+        while True:
+            self.buckets.seek(pos)
+            data = self.buckets.read(chunk)
+            data = data[:len(data) - len(data) % self.entry_line_size]
+            if not data:
                 break
+            pos += len(data)
+            yield data
+
+    def _scan_struct(self, entries):
+        '''
+        Struct unpacking ``entries`` entries at once, ``None`` when native
+        alignment pads repeated format differently than single entries
+        '''
+        try:
+            return self._scan_structs[entries]
+        except KeyError:
+            fmt = self.entry_line_format
+            if fmt[0] in '<>!=@':
+                fmt = fmt[0] + fmt[1:] * entries
             else:
-                if status != 'd':
-                    offset -= 1
-        while limit:
-            curr_data = self.buckets.read(self.entry_line_size)
-            if not curr_data:
-                break
-            try:
-                doc_id, key, start, size, status, _next = self.entry_struct.unpack(curr_data)
-            except IndexException:
-                break
+                fmt = fmt * entries
+            res = struct.Struct(fmt)
+            if res.size != entries * self.entry_line_size:
+                res = None
+            self._scan_structs[entries] = res
+            return res
+
+    def _decode_entries(self, data):
+        '''
+        Unpacks all entries of ``data`` chunk
+        '''
+        entries = len(data) // self.entry_line_size
+        bulk = self._scan_struct(entries)
+        if bulk is None:
+            unpack_from = self.entry_struct.unpack_from
+            return [unpack_from(data, pos)
+                    for pos in xrange(0, len(data), self.entry_line_size)]
+        fields = bulk.unpack(data)
+        return zip(*[iter(fields)] * (len(fields) // entries))
+
+    def _live_entries(self, data):
+        '''
+        Number of not deleted entries in ``data`` chunk
+        '''
+        return len(data) // self.entry_line_size - \
+            data[self.status_offset::self.entry_line_size].count('d')
+
+    def all_batches(self, limit=-1, offset=0):
+        '''
+        Like :py:meth:`all` but yields lists of entries. Every chunk of
+        entry area is decoded with single ``unpack`` call, chunks skipped
+        by ``offset`` are not decoded at all.
+        '''
+        if not limit:
+            return
+        for data in self._scan():
+            if offset:
+                live = self._live_entries(data)
+                if offset >= live:
+                    offset -= live
+                    continue
+            lines = self._decode_entries(data)
+            if 'd' in data[self.status_offset::self.entry_line_size]:
+                batch = [line[:5] for line in lines if line[4] != 'd']
             else:
-                if status != 'd':
-                    yield doc_id, key, start, size, status
-                    limit -= 1
+                batch = [line[:5] for line in lines]
+            if offset:
+                batch = batch[offset:]
+                offset = 0
+            if limit > 0:
+                batch = batch[:limit]
+                limit -= len(batch)
+            if batch:
+                yield batch
+            if not limit:
+                break
+
+    def all(self, limit=-1, offset=0, cursor=None):
+        if cursor is not None:
+            for entry in self._all_with_cursor(limit, offset, cursor):
+                yield entry
+            return
+        for batch in self.all_batches(limit, offset):
+            for entry in batch:
+                yield entry
+
+    def _all_with_cursor(self, limit, offset, cursor):
+        '''
+        Like :py:meth:`all` from entry ``cursor`` points at, yields
+        entries with tokens holding position of the following entry.
+        Entries are appended and never moved until compaction (which
+        makes older cursors invalid).
+        '''
+        if not limit:
+            return
+        pos = self._cursor_entry(cursor, 'ha') if cursor else self.data_start
+        for data in self._scan(pos):
+            for line in self._decode_entries(data):
+                pos += self.entry_line_size
+                if line[4] == 'd':
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                yield line[:5], encode_cursor('ha', self.generation, pos)
+                limit -= 1
+                if not limit:
+                    return
+
+    def count(self):
+        '''
+        Number of not deleted entries, counted without decoding them
+        '''
+        return sum(self._live_entries(data) for data in self._scan())
 
     def _fix_link(self, key, pos_prev, pos_next):
         # CHECKIT why I need that hack
@@ -439,12 +774,8 @@ class IU_HashIndex(Index):
         return
 
     def delete(self, doc_id, key, start=0, size=0):
-        start_position = self._calculate_position(key)
-        self.buckets.seek(start_position)
-        curr_data = self.buckets.read(self.bucket_line_size)
-        if curr_data:
-            location = self.bucket_struct.unpack(curr_data)[0]
-        else:
+        location = self._read_bucket(self._calculate_bucket(key))
+        if location is None:
             # case happens when trying to delete element with new index key in data
             # after adding new index to database without reindex
             raise TryReindexException()
@@ -457,47 +788,65 @@ class IU_HashIndex(Index):
                                                   'd',
                                                   _next))
         self.flush()
+        self._free_value(start, size, status)
         # self._fix_link(_key, _prev, _next)
         self._find_key.delete(key)
         self._locate_doc_id.delete(doc_id)
         return True
 
-    def compact(self, hash_lim=None):
+    def compact(self, hash_lim=None, hash_func=None, offset_format=None):
+        compact_ind = self._new_compact_index(hash_lim, hash_func, offset_format)
+        compact_ind.bulk_load(self._compact_entries(compact_ind))
+        compact_ind.close_index()
+        self._swap_compacted(compact_ind)
+        return True
 
+    def _new_compact_index(self, hash_lim=None, hash_func=None, offset_format=None):
+        """
+        Creates empty index to copy live elements to
+        """
         if not hash_lim:
             hash_lim = self.hash_lim
+        if not hash_func:
+            hash_func = self.hash_func
+        if not offset_format:
+            offset_format = self.offset_format
 
         compact_ind = self.__class__(
-            self.db_path, self.name + '_compact', hash_lim=hash_lim)
+            self.db_path, self.name + '_compact', hash_lim=hash_lim,
+            use_mmap=self.use_mmap, max_load=self.max_load,
+            hash_func=hash_func, offset_format=offset_format)
+        # same storage (with its options) as this index
+        compact_ind.storage_class = self.storage_class
+        compact_ind.compression = self.compression
+        compact_ind.storage = self.storage._like(compact_ind.name)
         compact_ind.create_index()
+        return compact_ind
 
-        gen = self.all()
-        while True:
-            try:
-                doc_id, key, start, size, status = gen.next()
-            except StopIteration:
-                break
-            self.storage._f.seek(start)
-            value = self.storage._f.read(size)
-            start_ = compact_ind.storage._f.tell()
-            compact_ind.storage._f.write(value)
-            compact_ind.insert(doc_id, key, start_, size, status)
-
-        compact_ind.close_index()
+    def _swap_compacted(self, compact_ind):
+        """
+        Replaces index files with (closed) ``compact_ind`` ones and
+        reopens the index
+        """
         original_name = self.name
         # os.unlink(os.path.join(self.db_path, self.name + "_buck"))
         self.close_index()
         shutil.move(os.path.join(compact_ind.db_path, compact_ind.
                                  name + "_buck"), os.path.join(self.db_path, self.name + "_buck"))
-        shutil.move(os.path.join(compact_ind.db_path, compact_ind.
-                                 name + "_stor"), os.path.join(self.db_path, self.name + "_stor"))
+        self.storage.destroy()
+        compact_ind.storage.move(self.name)
+        compact_ind._destroy_bloom()
+        self._destroy_buckets_ext()
+        if compact_ind.buckets_nr > compact_ind.hash_lim + 1:
+            shutil.move(os.path.join(compact_ind.db_path, compact_ind.
+                                     name + "_buck_ext"), os.path.join(self.db_path, self.name + "_buck_ext"))
         # self.name = original_name
         self.open_index()  # reload...
         self.name = original_name
         self._save_params(dict(name=original_name))
         self._fix_params()
+        self._open_buckets_ext()  # opened with compact_ind name before
         self._clear_cache()
-        return True
 
     def make_key(self, key):
         return key
@@ -513,6 +862,25 @@ class IU_HashIndex(Index):
         super(IU_HashIndex, self).close_index()
         self._clear_cache()
 
+    def begin_batch(self):
+        super(IU_HashIndex, self).begin_batch()
+        if self.buckets_ext is not None and \
+                not isinstance(self.buckets_ext, BatchFile):
+            self.buckets_ext = BatchFile(self.buckets_ext)
+
+    def end_batch(self, commit=True):
+        super(IU_HashIndex, self).end_batch(commit)
+        if isinstance(self.buckets_ext, BatchFile):
+            self.buckets_ext = self.buckets_ext.release(commit)
+        if not commit:
+            self._clear_cache()
+            # drop buckets split in rolled back batch
+            self.buckets_nr = self.hash_lim + 1
+            if self.buckets_ext is not None:
+                self.buckets_ext.seek(0, 2)
+                self.buckets_nr += self.buckets_ext.tell() // self.bucket_line_size
+            self._count_buckets()
+
 
 class IU_UniqueHashIndex(IU_HashIndex):
     """
@@ -523,6 +891,8 @@ class IU_UniqueHashIndex(IU_HashIndex):
     That design is because main index logic should be always in database not in custom user indexes.
     """
 
+    entry_key_index = 0
+
     def __init__(self, db_path, name, entry_line_format="<40s8sIIcI", *args, **kwargs):
         if 'key' in kwargs:
             raise IndexPreconditionsException(
@@ -539,11 +909,8 @@ class IU_UniqueHashIndex(IU_HashIndex):
 
         :param key: the key to find
         """
-        start_position = self._calculate_position(key)
-        self.buckets.seek(start_position)
-        curr_data = self.buckets.read(self.bucket_line_size)
-        if curr_data:
-            location = self.bucket_struct.unpack(curr_data)[0]
+        location = self._read_bucket(self._calculate_bucket(key))
+        if location is not None:
             found_at, l_key, rev, start, size, status, _next = self._locate_key(
                 key, location)
             return l_key, rev, start, size, status
@@ -603,14 +970,10 @@ class IU_UniqueHashIndex(IU_HashIndex):
         return self.buckets.tell() - self.entry_line_size, l_key, rev, start, size, status, _next
 
     def update(self, key, rev, u_start=0, u_size=0, u_status='o'):
-        start_position = self._calculate_position(key)
-        self.buckets.seek(start_position)
-        curr_data = self.buckets.read(self.bucket_line_size)
+        location = self._read_bucket(self._calculate_bucket(key))
         # test if it's unique or not really unique hash
 
-        if curr_data:
-            location = self.bucket_struct.unpack(curr_data)[0]
-        else:
+        if location is None:
             raise ElemNotFound("Location '%s' not found" % key)
         found_at, _key, _rev, start, size, status, _next = self._locate_key(
             key, location)
@@ -626,19 +989,17 @@ class IU_UniqueHashIndex(IU_HashIndex):
                                                   u_status,
                                                   _next))
         self.flush()
+        if u_status == 'd' or (u_start, u_size) != (start, size):
+            self._free_value(start, size, status)
         self._find_key.delete(key)
         return True
 
     def insert(self, key, rev, start, size, status='o'):
-        start_position = self._calculate_position(key)
-        self.buckets.seek(start_position)
-        curr_data = self.buckets.read(self.bucket_line_size)
+        self._bloom_add(key)
+        bucket = self._calculate_bucket(key)
+        location = self._read_bucket(bucket)
 
         # conflict occurs?
-        if curr_data:
-            location = self.bucket_struct.unpack(curr_data)[0]
-        else:
-            location = 0
         if location:
             # last key with that hash
             found_at, _key, _rev, _start, _size, _status, _next = self._find_place(
@@ -669,6 +1030,7 @@ class IU_UniqueHashIndex(IU_HashIndex):
             self.flush()
             self._find_key.delete(_key)
             # self._locate_key.delete(_key)
+            self._check_load(wrote_at)
             return True
             # raise NotImplementedError
         else:
@@ -687,39 +1049,12 @@ class IU_UniqueHashIndex(IU_HashIndex):
                                                       status,
                                                       0))
 #            self.flush()
-            self.buckets.seek(start_position)
-            self.buckets.write(self.bucket_struct.pack(wrote_at))
+            self._write_bucket(bucket, wrote_at)
             self.flush()
             self._find_key.delete(key)
+            self._check_load(wrote_at)
             return True
 
-    def all(self, limit=-1, offset=0):
-        self.buckets.seek(self.data_start)
-        while offset:
-            curr_data = self.buckets.read(self.entry_line_size)
-            if not curr_data:
-                break
-            try:
-                doc_id, rev, start, size, status, next = self.entry_struct.unpack(curr_data)
-            except IndexException:
-                break
-            else:
-                if status != 'd':
-                    offset -= 1
-
-        while limit:
-            curr_data = self.buckets.read(self.entry_line_size)
-            if not curr_data:
-                break
-            try:
-                doc_id, rev, start, size, status, next = self.entry_struct.unpack(curr_data)
-            except IndexException:
-                break
-            else:
-                if status != 'd':
-                    yield doc_id, rev, start, size, status
-                    limit -= 1
-
     def get_many(self, *args, **kwargs):
         raise NotImplementedError()
 
@@ -741,8 +1076,13 @@ class IU_UniqueHashIndex(IU_HashIndex):
 
     def destroy(self):
         Index.destroy(self)
+        self._destroy_buckets_ext()
         self._clear_cache()
 
+    def _bloom_keys(self):
+        for entry in self.all():
+            yield entry[0]
+
     def _clear_cache(self):
         self._find_key.clear()
 
@@ -779,6 +1119,9 @@ class DummyHashIndex(IU_HashIndex):
     def all(self, *args, **kwargs):
         raise StopIteration
 
+    def count(self):
+        return 0
+
     def get(self, *args, **kwargs):
         raise ElemNotFound
 
@@ -816,6 +1159,8 @@ class IU_MultiHashIndex(IU_HashIndex):
     UPDATE operations (will always readd everything)
     """
 
+    shared_values = True
+
     def __init__(self, *args, **kwargs):
         super(IU_MultiHashIndex, self).__init__(*args, **kwargs)
 
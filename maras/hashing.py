@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''
+Hash functions used to place keys in hash index buckets.
+
+Name of the function is stored in index props, so it has to give the same
+results everywhere. Register own one in :py:data:`hash_functions`.
+'''
+# Import python libs
+import zlib
+import struct
+
+# Import third party libs
+try:
+    import xxhash
+    HAS_XXHASH = True
+except ImportError:
+    HAS_XXHASH = False
+
+MASK64 = 0xffffffffffffffff
+PRIME64_1 = 11400714785074694791
+PRIME64_2 = 14029467366897019727
+PRIME64_3 = 1609587929392839161
+PRIME64_4 = 9650029242287828579
+PRIME64_5 = 2870177450012600261
+
+_lanes = struct.Struct('<4Q')
+_lane = struct.Struct('<Q')
+_half_lane = struct.Struct('<I')
+
+
+def key_bytes(key):
+    '''
+    Returns key as string of bytes
+    '''
+    if isinstance(key, str):
+        return key
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return str(key)
+
+
+def _rotl(val, bits):
+    return ((val << bits) | (val >> (64 - bits))) & MASK64
+
+
+def _round(acc, lane):
+    acc = (acc + lane * PRIME64_2) & MASK64
+    return (_rotl(acc, 31) * PRIME64_1) & MASK64
+
+
+def _merge_round(acc, val):
+    acc ^= _round(0, val)
+    return (acc * PRIME64_1 + PRIME64_4) & MASK64
+
+
+def xxh64_py(data, seed=0):
+    '''
+    Pure python XXH64, used when xxhash module is not installed
+    '''
+    length = len(data)
+    pos = 0
+    if length >= 32:
+        v1 = (seed + PRIME64_1 + PRIME64_2) & MASK64
+        v2 = (seed + PRIME64_2) & MASK64
+        v3 = seed
+        v4 = (seed - PRIME64_1) & MASK64
+        while pos <= length - 32:
+            l1, l2, l3, l4 = _lanes.unpack_from(data, pos)
+            v1 = _round(v1, l1)
+            v2 = _round(v2, l2)
+            v3 = _round(v3, l3)
+            v4 = _round(v4, l4)
+            pos += 32
+        h = (_rotl(v1, 1) + _rotl(v2, 7) + _rotl(v3, 12) +
+             _rotl(v4, 18)) & MASK64
+        h = _merge_round(h, v1)
+        h = _merge_round(h, v2)
+        h = _merge_round(h, v3)
+        h = _merge_round(h, v4)
+    else:
+        h = (seed + PRIME64_5) & MASK64
+    h = (h + length) & MASK64
+    while pos + 8 <= length:
+        h ^= _round(0, _lane.unpack_from(data, pos)[0])
+        h = (_rotl(h, 27) * PRIME64_1 + PRIME64_4) & MASK64
+        pos += 8
+    if pos + 4 <= length:
+        h ^= (_half_lane.unpack_from(data, pos)[0] * PRIME64_1) & MASK64
+        h = (_rotl(h, 23) * PRIME64_2 + PRIME64_3) & MASK64
+        pos += 4
+    while pos < length:
+        h ^= (ord(data[pos]) * PRIME64_5) & MASK64
+        h = (_rotl(h, 11) * PRIME64_1) & MASK64
+        pos += 1
+    h ^= h >> 33
+    h = (h * PRIME64_2) & MASK64
+    h ^= h >> 29
+    h = (h * PRIME64_3) & MASK64
+    h ^= h >> 32
+    return h
+
+
+if HAS_XXHASH:
+    def xxh64(key):
+        return xxhash.xxh64_intdigest(key_bytes(key))
+else:
+    def xxh64(key):
+        return xxh64_py(key_bytes(key))
+
+
+def crc32(key):
+    return zlib.crc32(key_bytes(key)) & 0xffffffff
+
+
+hash_functions = {
+    'python': hash,  # : interpreter dependent, only for indexes created before
+    'crc32': crc32,
+    'xxh64': xxh64,
+}
+
+#: used for new indexes when not given, the C xxhash when it's installed
+default_hash_func = 'xxh64' if HAS_XXHASH else 'crc32'
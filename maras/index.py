@@ -18,6 +18,8 @@
 # Import python libs
 import os
 import io
+import base64
+import struct
 
 # Import maras libs
 try:
@@ -28,6 +30,12 @@ except ImportError:
 # Import third party libs
 import msgpack
 
+from maras.mapped_file import MappedFile
+from maras.batch_file import BatchFile
+from maras.page_cache import CachedFile
+from maras.positional_file import positional
+from maras.bloom import BloomFilter
+
 
 class IndexException(Exception):
     pass
@@ -61,18 +69,51 @@ class IndexPreconditionsException(IndexException):
     pass
 
 
+def encode_cursor(*parts):
+    """
+    Returns opaque cursor token made of ``parts`` (position of last
+    returned element in index)
+    """
+    return base64.urlsafe_b64encode(msgpack.dumps(parts))
+
+
+def decode_cursor(cursor, kind):
+    """
+    Returns parts of ``cursor`` token made by index of ``kind``
+    """
+    try:
+        parts = msgpack.loads(base64.urlsafe_b64decode(str(cursor)))
+    except Exception:
+        raise IndexException("Invalid cursor")
+    if not isinstance(parts, (list, tuple)) or not parts or parts[0] != kind:
+        raise IndexException("Invalid cursor")
+    return tuple(parts[1:])
+
+
 class Index(object):
 
     __version__ = __version__
 
     custom_header = ''  # : use it for imports required by your index
 
+    shared_values = False  # : many elements point to single value (multi key indexes)
+
+    bloom_bits = 0  # : bits per key of Bloom filter answering lookups of missing keys, 0 disables it
+
+    bloom_min_capacity = 1024  # : keys the smallest Bloom filter is sized for
+
+    included_fields = ()  # : document fields kept in index values (see :py:meth:`include_fields`), reads of only these fields skip **id** index
+
     def __init__(self,
                  db_path,
                  name):
         self.name = name
         self._start_ind = 500
         self.db_path = db_path
+        self.use_mmap = False
+        self.page_cache = None  # : set by database, shared by all indexes
+        self.positional_files = False  # : set by database, file position per thread
+        self.bloom = None
 
     def open_index(self):
         if not os.path.isfile(os.path.join(self.db_path, self.name + '_buck')):
@@ -80,8 +121,23 @@ class Index(object):
         self.buckets = io.open(
             os.path.join(self.db_path, self.name + "_buck"), 'r+b', buffering=0)
         self._fix_params()
+        self._map_buckets()
         self._open_storage()
 
+    def _map_buckets(self):
+        """
+        Switches bucket file reads to memory map when ``use_mmap`` is set,
+        or to database page cache when there is one, gives threads their
+        own file positions in readers-writer mode
+        """
+        if self.use_mmap:
+            if not isinstance(self.buckets, MappedFile):
+                self.buckets = MappedFile(self.buckets)
+        elif self.page_cache is not None:
+            if not isinstance(self.buckets, CachedFile):
+                self.buckets = CachedFile(self.buckets, self.page_cache)
+        self.buckets = positional(self.buckets, self.positional_files)
+
     def _close(self):
         self.buckets.close()
         self.storage.close()
@@ -89,6 +145,7 @@ class Index(object):
     def close_index(self):
         self.flush()
         self.fsync()
+        self._save_bloom()
         self._close()
 
     def create_index(self):
@@ -123,6 +180,17 @@ class Index(object):
         self.buckets.seek(0, 2)
         self.__dict__.update(props)
 
+    def _check_start_format(self, storage_class, start_format):
+        """
+        Raises :py:class:`IndexException` when ``start_format`` field of
+        elements can't hold all record starts of ``storage_class``
+        """
+        needed = getattr(storage_class, 'offset_format', 'I')
+        if struct.calcsize('<' + start_format) < struct.calcsize('<' + needed):
+            raise IndexException(
+                "%s needs `%s` start field of elements (offset_format)" %
+                (storage_class.__name__, needed))
+
     def _open_storage(self, *args, **kwargs):
         pass
 
@@ -132,6 +200,82 @@ class Index(object):
     def _destroy_storage(self, *args, **kwargs):
         self.storage.destroy()
 
+    def _bloom_path(self):
+        return os.path.join(self.db_path, self.name + '_bloom')
+
+    def _buckets_stat(self):
+        stat = os.fstat(self.buckets.fileno())
+        return [stat.st_size, stat.st_ino]
+
+    def _create_bloom(self):
+        self.bloom = None
+        if self.bloom_bits:
+            self.bloom = BloomFilter(self.bloom_min_capacity, self.bloom_bits)
+
+    def _open_bloom(self):
+        """
+        Reads Bloom filter saved on close, it's built from index elements
+        when there is none (or index was changed in the meantime)
+        """
+        self.bloom = None
+        if not self.bloom_bits:
+            return
+        path = self._bloom_path()
+        if os.path.exists(path):
+            with io.open(path, 'rb') as f:
+                stat, data = msgpack.loads(f.read())
+            # removed, so it can't be used again after crash
+            os.unlink(path)
+            if stat == self._buckets_stat():
+                self.bloom = BloomFilter.loads(data)
+                if self.bloom.bits_per_key == self.bloom_bits:
+                    return
+        self._build_bloom()
+
+    def _build_bloom(self, capacity=0):
+        """
+        Fills new Bloom filter with keys of all elements, it's sized for
+        at least ``capacity`` keys
+        """
+        keys = list(self._bloom_keys())
+        bloom = BloomFilter(max(capacity, 2 * len(keys),
+                                self.bloom_min_capacity), self.bloom_bits)
+        for key in keys:
+            bloom.add(key)
+        self.bloom = bloom
+
+    def _bloom_keys(self):
+        for entry in self.all():
+            yield entry[1]
+
+    def _save_bloom(self):
+        if self.bloom is not None and not self.buckets.closed:
+            with io.open(self._bloom_path(), 'wb') as f:
+                f.write(msgpack.dumps((self._buckets_stat(),
+                                       self.bloom.dumps())))
+
+    def _destroy_bloom(self):
+        if os.path.exists(self._bloom_path()):
+            os.unlink(self._bloom_path())
+
+    def _bloom_add(self, key):
+        """
+        Adds inserted key to Bloom filter, it's rebuilt twice as big when
+        it gets more keys than it was sized for
+        """
+        bloom = self.bloom
+        if bloom is not None:
+            bloom.add(key)
+            if bloom.count > bloom.capacity:
+                self._build_bloom(2 * bloom.capacity)
+                self.bloom.add(key)
+
+    def _bloom_miss(self, key):
+        """
+        Tells if ``key`` is surely not in index
+        """
+        return self.bloom is not None and key not in self.bloom
+
     def _find_key(self, key):
         raise NotImplementedError()
 
@@ -141,6 +285,31 @@ class Index(object):
     def insert(self, doc_id, key, start, size):
         raise NotImplementedError()
 
+    def bulk_load(self, entries):
+        """
+        Inserts all ``(doc_id, key, start, size)`` entries, indexes that
+        can build their structure faster from the whole input override it.
+        """
+        for entry in entries:
+            self.insert(*entry)
+
+    def _compact_entries(self, compact_ind):
+        """
+        Copies values of all elements to ``compact_ind`` storage and yields
+        elements pointing to them (in :py:meth:`all` order)
+        """
+        read = self.storage._read
+        write = compact_ind.storage._write
+        for doc_id, key, start, size, status in self.all():
+            yield doc_id, key, write(None, read(start, size)), size, status
+
+    def _free_value(self, start, size, status):
+        """
+        Gives space of replaced or deleted element value back to storage
+        """
+        if status != 'd' and not self.shared_values:
+            self.storage.free(start, size)
+
     def get(self, key):
         raise NotImplementedError()
 
@@ -159,6 +328,19 @@ class Index(object):
     def make_key(self, data):
         raise NotImplementedError()
 
+    def include_fields(self, data, value=None):
+        """
+        Returns ``value`` dict with :py:attr:`included_fields` of document
+        ``data`` added, to be returned as index value by
+        :py:meth:`make_key_value`. Database then answers ``with_doc``
+        reads of these fields from index values only.
+        """
+        value = dict(value or {})
+        for field in self.included_fields:
+            if field in data:
+                value[field] = data[field]
+        return value
+
     def compact(self, *args, **kwargs):
         raise NotImplementedError()
 
@@ -167,6 +349,7 @@ class Index(object):
         bucket_file = os.path.join(self.db_path, self.name + '_buck')
         os.unlink(bucket_file)
         self._destroy_storage()
+        self._destroy_bloom()
         self._find_key.clear()
 
     def flush(self):
@@ -183,6 +366,32 @@ class Index(object):
         except:
             pass
 
+    def begin_batch(self):
+        """
+        Buffers all bucket and storage writes in memory until
+        :py:meth:`end_batch`
+        """
+        if not isinstance(self.buckets, BatchFile):
+            self.buckets = BatchFile(self.buckets)
+        self.storage.begin_batch()
+
+    def end_batch(self, commit=True):
+        """
+        Writes buffered data back, or drops it when ``commit`` is False
+        """
+        try:
+            if isinstance(self.buckets, BatchFile):
+                self.buckets = self.buckets.release(commit)
+        finally:
+            self.storage.end_batch(commit)
+
+    def bulk_load_with_storage(self, entries):
+        """
+        Like :py:meth:`bulk_load` but for ``(doc_id, key, value)`` entries
+        """
+        for doc_id, key, value in entries:
+            self.insert_with_storage(doc_id, key, value)
+
     def update_with_storage(self, doc_id, key, value):
         if value:
             start, size = self.storage.insert(value)
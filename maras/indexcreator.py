@@ -56,10 +56,10 @@ class Parser(object):
         self.stage = 0
         self.logic = ['and', 'or', 'in']
         self.logic2 = ['&', '|']
-        self.allowed_props = {'TreeBasedIndex': ['type', 'name', 'key_format', 'node_capacity', 'pointer_format', 'meta_format'],
-                              'HashIndex': ['type', 'name', 'key_format', 'hash_lim', 'entry_line_format'],
-                              'MultiHashIndex': ['type', 'name', 'key_format', 'hash_lim', 'entry_line_format'],
-                              'MultiTreeBasedIndex': ['type', 'name', 'key_format', 'node_capacity', 'pointer_format', 'meta_format']
+        self.allowed_props = {'TreeBasedIndex': ['type', 'name', 'key_format', 'node_capacity', 'pointer_format', 'meta_format', 'offset_format', 'page_size', 'leaf_prefix'],
+                              'HashIndex': ['type', 'name', 'key_format', 'hash_lim', 'entry_line_format', 'offset_format'],
+                              'MultiHashIndex': ['type', 'name', 'key_format', 'hash_lim', 'entry_line_format', 'offset_format'],
+                              'MultiTreeBasedIndex': ['type', 'name', 'key_format', 'node_capacity', 'pointer_format', 'meta_format', 'offset_format', 'page_size', 'leaf_prefix']
                               }
         self.funcs = {'sha1': (['sha1'], ['.digest()']),
                       'len': (['len'], []),
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Import python libs
+from collections import MutableMapping
+
+# Import third party libs
+import msgpack
+
+
+class LazyDocument(MutableMapping):
+    """
+    Document record decoded on demand. Single fields are read straight
+    from raw msgpack map (values of other fields are skipped, not decoded)
+    until the whole document is needed (iteration, ``len``, comparison,
+    ``del``). Set fields are kept on top of the raw record.
+
+    Returned by database reads with ``lazy=True``, :py:meth:`decode`
+    gives plain dict.
+    """
+
+    def __init__(self, raw, prepare=None):
+        """
+        :param raw: stored record
+        :param prepare: function turning ``raw`` into msgpack data (like decompression), called on first access
+        """
+        self._raw = raw
+        self._prepare = prepare
+        self._fields = {}  # decoded or set fields
+        self._data = None  # whole document
+
+    def _msgpack(self):
+        if self._prepare is not None:
+            self._raw = self._prepare(self._raw)
+            self._prepare = None
+        return self._raw
+
+    def _unpacker(self):
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(self._msgpack())
+        return unpacker
+
+    def _find(self, key):
+        unpacker = self._unpacker()
+        for _ in xrange(unpacker.read_map_header()):
+            if unpacker.unpack() == key:
+                return unpacker.unpack()
+            unpacker.skip()
+        raise KeyError(key)
+
+    def decode(self):
+        """
+        Returns the whole document as dict
+        """
+        if self._data is None:
+            data = msgpack.loads(self._msgpack())
+            data.update(self._fields)
+            self._data = data
+            self._raw = self._fields = None
+        return self._data
+
+    def __getitem__(self, key):
+        if self._data is not None:
+            return self._data[key]
+        try:
+            return self._fields[key]
+        except KeyError:
+            value = self._fields[key] = self._find(key)
+            return value
+
+    def __setitem__(self, key, value):
+        if self._data is not None:
+            self._data[key] = value
+        else:
+            self._fields[key] = value
+
+    def __delitem__(self, key):
+        del self.decode()[key]
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __nonzero__(self):
+        if self._data is not None:
+            return bool(self._data)
+        return bool(self._fields) or \
+            self._unpacker().read_map_header() > 0
+
+    def __eq__(self, other):
+        if isinstance(other, LazyDocument):
+            other = other.decode()
+        return self.decode() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.decode())
+
+    def copy(self):
+        return dict(self.decode())
+
+
+def is_map(raw):
+    """
+    Tells if ``raw`` is msgpack map (fixmap, map 16 or map 32)
+    """
+    first = raw[:1]
+    return '\x80' <= first <= '\x8f' or first == '\xde' or first == '\xdf'
+
+
+def project(raw, fields):
+    """
+    Decodes only ``fields`` of msgpack map ``raw`` (values of other fields
+    are skipped), returns dict with the found ones. Other values (index
+    values don't have to be dicts) are decoded whole.
+    """
+    if not isinstance(fields, (set, frozenset)):
+        fields = frozenset(fields)
+    if not is_map(raw):
+        return msgpack.loads(raw)
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(raw)
+    res = {}
+    left = len(fields)
+    for _ in xrange(unpacker.read_map_header()):
+        if not left:
+            break
+        key = unpacker.unpack()
+        if key in fields:
+            res[key] = unpacker.unpack()
+            left -= 1
+        else:
+            unpacker.skip()
+    return res
+
+
+def msgpack_default(obj):
+    """
+    ``default`` for msgpack packing, lazy documents are packed as dicts
+    """
+    if isinstance(obj, LazyDocument):
+        return obj.decode()
+    raise TypeError("can't serialize %r" % (obj, ))
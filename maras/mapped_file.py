@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Import python libs
+import os
+import mmap
+
+
+class MappedFile(object):
+    """
+    Wraps unbuffered file object, reads are served from shared memory map
+    of the file instead of ``seek`` + ``read`` syscalls pair.
+
+    Writes still go through the wrapped file object, the mapping is shared
+    so it sees them. When read reaches behind the mapped area the file
+    is mapped again (it has grown since).
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._map = None
+        self._map_size = 0
+        self._pos = 0
+        self._remap()
+
+    def _remap(self):
+        size = os.fstat(self._f.fileno()).st_size
+        if size == self._map_size:
+            return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._map_size = 0
+        if size:
+            self._map = mmap.mmap(self._f.fileno(),
+                                  size,
+                                  access=mmap.ACCESS_READ)
+            self._map_size = size
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self._pos = offset
+        elif whence == 1:
+            self._pos += offset
+        else:
+            self._f.seek(offset, whence)
+            self._pos = self._f.tell()
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        pos = self._pos
+        if size < 0:
+            self._remap()
+            end = self._map_size
+        else:
+            end = pos + size
+            if end > self._map_size:
+                self._remap()
+        if self._map is None:
+            return b''
+        data = self._map[pos:end]
+        self._pos = pos + len(data)
+        return data
+
+    def write(self, data):
+        self._f.seek(self._pos)
+        written = self._f.write(data)
+        self._pos += len(data)
+        return written
+
+    def flush(self):
+        self._f.flush()
+
+    def fileno(self):
+        return self._f.fileno()
+
+    @property
+    def closed(self):
+        return self._f.closed
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._map_size = 0
+        self._f.close()
@@ -16,6 +16,9 @@
 # limitations under the License.
 
 from maras.database import Database
+from maras.hash_index import IU_HashIndex
+from maras.tree_index import IU_TreeBasedIndex
+from maras.hashing import default_hash_func
 import shutil
 import os
 
@@ -40,6 +43,39 @@ def migrate(source, destination):
     return True
 
 
+def rehash(path, hash_func=None):
+    """
+    Rebuilds hash indexes placed by interpreter ``hash()`` (created before
+    ``hash_func`` was stored in props) with stable hash function
+    """
+    if not hash_func:
+        hash_func = default_hash_func
+    db = Database(path)
+    db.open()
+    for index in db.indexes:
+        for curr in getattr(index, 'shards', {0: index}).itervalues():
+            if isinstance(curr, IU_HashIndex) and curr.hash_func == 'python':
+                curr.compact(hash_func=hash_func)
+    db.close()
+    return True
+
+
+def widen_offsets(path, offset_format='Q'):
+    """
+    Rebuilds hash and tree indexes with 32 bit offsets and sizes (files
+    limited to 4 GB) with ``offset_format`` ones
+    """
+    db = Database(path)
+    db.open()
+    for index in db.indexes:
+        for curr in getattr(index, 'shards', {0: index}).itervalues():
+            if isinstance(curr, (IU_HashIndex, IU_TreeBasedIndex)) and \
+                    curr.offset_format != offset_format:
+                curr.compact(offset_format=offset_format)
+    db.close()
+    return True
+
+
 if __name__ == '__main__':
     import sys
     migrate(sys.argv[1], sys.argv[2])
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Import python libs
+import os
+import io
+import shutil
+
+# Import third party libs
+import msgpack
+
+# Import maras libs
+from maras.index import ElemNotFound, TryReindexException
+
+
+class _NoLock(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def _plain(args):
+    # multi indexes take sets of keys
+    return [list(arg) if isinstance(arg, (set, frozenset)) else arg
+            for arg in args]
+
+
+class OnlineCompaction(object):
+    """
+    Compacts index while it's still used for reads and writes.
+
+    1. :py:meth:`start` copies bucket file to a snapshot and from now on
+       logs every ``insert``, ``update`` and ``delete`` on the index to
+       a side log file
+    2. :py:meth:`copy` streams live elements from the snapshot to new
+       index (space of values is not reused until :py:meth:`finish`, so
+       they are still there)
+    3. :py:meth:`catch_up` replays what was logged so far
+    4. :py:meth:`finish` replays the rest, swaps files and stops logging
+
+    Only :py:meth:`start` and :py:meth:`finish` hold ``lock`` (the one
+    guarding the index in thread safe databases). :py:meth:`run` does all
+    the steps.
+    """
+
+    logged_methods = ('insert', 'update', 'delete')
+
+    def __init__(self, index, lock=None, **kwargs):
+        """
+        :param index: index to compact
+        :param lock: lock held by all index operations, ``None`` when database is not thread safe
+        :param kwargs: passed to index ``compact`` (like ``hash_lim`` or ``node_capacity``)
+        """
+        self.index = index
+        self.lock = lock or _NoLock()
+        self.kwargs = kwargs
+        path = os.path.join(index.db_path, index.name)
+        self._buck_path = path + '_buck'
+        self._snap_path = path + '_snap_buck'
+        self._log_path = path + '_compact_log'
+        self._log = None
+        self._log_reader = None
+        self._unpacker = msgpack.Unpacker()
+        self._orig = {}
+        self.source = None
+        self.compact_ind = None
+
+    def start(self):
+        with self.lock:
+            index = self.index
+            index.flush()
+            shutil.copyfile(self._buck_path, self._snap_path)
+            self._log = io.open(self._log_path, 'w+b', buffering=0)
+            self._log_reader = io.open(self._log_path, 'rb')
+            for name in self.logged_methods:
+                self._orig[name] = index.__dict__.get(name)
+                setattr(index, name, self._logged(name, getattr(index, name)))
+            # bulk loads have to go through logged insert
+            self._orig['bulk_load'] = index.__dict__.get('bulk_load')
+            index.bulk_load = self._bulk_insert
+            # values referenced by snapshot and log have to stay in place,
+            # old storage is dropped on finish anyway
+            self._orig['_free_value'] = index.__dict__.get('_free_value')
+            index._free_value = self._keep_value
+        self.compact_ind = self.index._new_compact_index(**self.kwargs)
+
+    def _logged(self, op, method):
+        lock = self.lock
+        log = self._log
+
+        def _inner(*args, **kwargs):
+            with lock:
+                res = method(*args, **kwargs)
+                log.write(msgpack.dumps((op, _plain(args), kwargs)))
+            return res
+        return _inner
+
+    def _bulk_insert(self, entries, *args, **kwargs):
+        insert = self.index.insert
+        for entry in entries:
+            insert(*entry)
+
+    def _keep_value(self, *args, **kwargs):
+        pass
+
+    def copy(self):
+        """
+        Copies live elements from the snapshot
+        """
+        index = self.index
+        # opens snapshot buckets, storage is the one of index
+        self.source = index.__class__(index.db_path, index.name + '_snap')
+        self.source.open_index()
+        self.compact_ind.bulk_load(
+            self.source._compact_entries(self.compact_ind))
+
+    def catch_up(self):
+        """
+        Replays writes logged until now
+        """
+        with self.lock:
+            end = self._log.tell()
+        self._replay(end)
+
+    def _replay(self, end):
+        reader = self._log_reader
+        while reader.tell() < end:
+            self._unpacker.feed(reader.read(min(end - reader.tell(), 65536)))
+            for op, args, kwargs in self._unpacker:
+                self._apply(op, args, kwargs)
+
+    def _apply(self, op, args, kwargs):
+        compact_ind = self.compact_ind
+        if op != 'delete' and len(args) > 3 and args[3]:
+            # value has to be copied from index storage
+            value = self.source.storage._read(args[2], args[3])
+            args[2] = compact_ind.storage._write(None, value)
+        try:
+            getattr(compact_ind, op)(*args, **kwargs)
+        except (ElemNotFound, TryReindexException):
+            if op == 'insert':
+                raise
+
+    def finish(self):
+        """
+        Replays the rest of log and replaces index files
+        """
+        with self.lock:
+            self._replay(self._log.tell())
+            self._restore()
+            self.compact_ind.close_index()
+            self.index._swap_compacted(self.compact_ind)
+        self._cleanup()
+
+    def abort(self):
+        """
+        Stops logging and removes all compaction files, index stays as it was
+        """
+        with self.lock:
+            self._restore()
+        self._cleanup()
+        if self.compact_ind is not None:
+            self.compact_ind.destroy()
+
+    def run(self):
+        self.start()
+        try:
+            self.copy()
+            self.catch_up()
+            self.finish()
+        except:
+            self.abort()
+            raise
+        return True
+
+    def _restore(self):
+        for name, orig in self._orig.iteritems():
+            if orig is None:
+                delattr(self.index, name)
+            else:
+                setattr(self.index, name, orig)
+        self._orig = {}
+
+    def _cleanup(self):
+        if self.source is not None:
+            self.source._close()
+            self.source = None
+        for f in (self._log, self._log_reader):
+            if f is not None:
+                f.close()
+        self._log = self._log_reader = None
+        for path in (self._snap_path, self._log_path):
+            if os.path.exists(path):
+                os.unlink(path)
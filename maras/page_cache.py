@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Import python libs
+import os
+from itertools import count
+
+# Import maras libs
+from maras.env import menv
+
+
+def _locked(method, lock):
+    def _inner(*args, **kwargs):
+        with lock:
+            return method(*args, **kwargs)
+    return _inner
+
+
+class PageCache(object):
+    """
+    Pool of fixed size file pages shared by all files of a database,
+    pages are evicted with CLOCK (second chance) algorithm when the pool
+    reaches its memory budget.
+
+    Pages are identified by ``file_id << 32 | page number``.
+    """
+
+    def __init__(self, size=16 * 1024 * 1024, page_size=4096):
+        self.page_size = page_size
+        self.max_pages = max(size // page_size, 1)
+        self._file_ids = count(1)
+        if menv.get('rlock_obj'):
+            lock = menv['rlock_obj']()
+            for name in ('clear', 'get', 'put', 'patch', 'drop_file'):
+                setattr(self, name, _locked(getattr(self, name), lock))
+        self.clear()
+
+    def clear(self):
+        self._pages = {}  # page key -> slot
+        self._keys = [None] * self.max_pages
+        self._data = [None] * self.max_pages
+        self._ref = [False] * self.max_pages
+        self._free = range(self.max_pages - 1, -1, -1)
+        self._hand = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def new_file_id(self):
+        return next(self._file_ids)
+
+    def get(self, key):
+        slot = self._pages.get(key)
+        if slot is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._ref[slot] = True
+        return self._data[slot]
+
+    def put(self, key, data):
+        slot = self._pages.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = self._evict()
+            self._pages[key] = slot
+            self._keys[slot] = key
+        self._data[slot] = data
+        self._ref[slot] = True
+
+    def patch(self, key, offset, data):
+        """
+        Writes data into the page at offset, only when the page is cached
+        """
+        slot = self._pages.get(key)
+        if slot is not None:
+            page = self._data[slot]
+            if len(page) < offset:  # hole behind the end of file
+                page += b'\x00' * (offset - len(page))
+            self._data[slot] = page[:offset] + data + \
+                page[offset + len(data):]
+
+    def _evict(self):
+        ref = self._ref
+        while True:
+            hand = self._hand
+            self._hand = (hand + 1) % self.max_pages
+            if ref[hand]:
+                ref[hand] = False
+            else:
+                del self._pages[self._keys[hand]]
+                self.evictions += 1
+                return hand
+
+    def drop_file(self, file_id):
+        for key in [key for key in self._pages if key >> 32 == file_id]:
+            slot = self._pages.pop(key)
+            self._keys[slot] = None
+            self._data[slot] = None
+            self._ref[slot] = False
+            self._free.append(slot)
+
+    @property
+    def size(self):
+        return len(self._pages) * self.page_size
+
+    def stats(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    pages=len(self._pages),
+                    max_pages=self.max_pages)
+
+
+class CachedFile(object):
+    """
+    Wraps unbuffered file object, reads are served from pages kept in
+    :py:class:`PageCache`. Writes go straight to the file and patch the
+    cached pages they touch.
+    """
+
+    def __init__(self, f, cache):
+        self._f = f
+        self._cache = cache
+        self._page_size = cache.page_size
+        self._key = cache.new_file_id() << 32
+        self._size = os.fstat(f.fileno()).st_size
+        self._pos = 0
+
+    def _page(self, num):
+        page_size = self._page_size
+        data = self._cache.get(self._key | num)
+        if data is None:
+            self._f.seek(num * page_size)
+            data = self._f.read(page_size)
+            self._cache.put(self._key | num, data)
+        if len(data) < page_size:
+            missing = min(page_size, self._size - num * page_size) - len(data)
+            if missing > 0:
+                # file was extended behind this page, hole reads as zeros
+                data += b'\x00' * missing
+                self._cache.put(self._key | num, data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self._pos = offset
+        elif whence == 1:
+            self._pos += offset
+        else:
+            self._pos = self._size + offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        pos = self._pos
+        if size < 0:
+            end = self._size
+        else:
+            end = min(pos + size, self._size)
+        if end <= pos:
+            return b''
+        page_size = self._page_size
+        num = pos // page_size
+        offset = pos - num * page_size
+        if end <= (num + 1) * page_size:  # fits in single page
+            data = self._page(num)[offset:offset + end - pos]
+        else:
+            chunks = [self._page(num)[offset:]]
+            num += 1
+            while num * page_size < end:
+                chunks.append(self._page(num))
+                num += 1
+            data = b''.join(chunks)[:end - pos]
+        self._pos = pos + len(data)
+        return data
+
+    def write(self, data):
+        pos = self._pos
+        self._f.seek(pos)
+        written = self._f.write(data)
+        end = pos + len(data)
+        page_size = self._page_size
+        num = pos // page_size
+        while num * page_size < end:
+            start = num * page_size
+            offset = max(pos - start, 0)
+            done = max(start - pos, 0)
+            self._cache.patch(self._key | num, offset,
+                              data[done:done + page_size - offset])
+            num += 1
+        self._pos = end
+        if end > self._size:
+            self._size = end
+        return written
+
+    def flush(self):
+        self._f.flush()
+
+    def fileno(self):
+        return self._f.fileno()
+
+    @property
+    def closed(self):
+        return self._f.closed
+
+    def close(self):
+        self._cache.drop_file(self._key >> 32)
+        self._f.close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Import python libs
+import io
+import os
+from threading import Lock, local
+
+
+class PositionalFile(object):
+    """
+    Wraps file object (or other wrapper like
+    :py:class:`maras.mapped_file.MappedFile`) so every thread has its own
+    file position, threads can read the same file at once.
+
+    Reads of plain files use ``os.pread`` where it's available, otherwise
+    ``seek`` + ``read`` pair runs under short lock of the file, the same
+    is done for writes.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._lock = Lock()
+        self._local = local()
+        self._pread = getattr(os, 'pread', None)
+        if not isinstance(f, io.FileIO):
+            self._pread = None
+
+    def _get_pos(self):
+        return getattr(self._local, 'pos', 0)
+
+    def _set_pos(self, pos):
+        self._local.pos = pos
+
+    _pos = property(_get_pos, _set_pos)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self._pos = offset
+        elif whence == 1:
+            self._pos += offset
+        else:
+            with self._lock:
+                self._pos = self._f.seek(offset, whence)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        pos = self._pos
+        if size >= 0 and self._pread is not None:
+            data = self._pread(self._f.fileno(), size, pos)
+        else:
+            with self._lock:
+                self._f.seek(pos)
+                data = self._f.read(size)
+        self._pos = pos + len(data)
+        return data
+
+    def write(self, data):
+        pos = self._pos
+        with self._lock:
+            self._f.seek(pos)
+            written = self._f.write(data)
+        self._pos = pos + len(data)
+        return written
+
+    def flush(self):
+        self._f.flush()
+
+    def fileno(self):
+        return self._f.fileno()
+
+    @property
+    def closed(self):
+        return self._f.closed
+
+    def close(self):
+        self._f.close()
+
+
+def positional(f, enabled=True):
+    """
+    Returns ``f`` wrapped in :py:class:`PositionalFile` when ``enabled``
+    (indexes and storages of
+    :py:class:`maras.database_rw_thread_safe.RWThreadSafeDatabase`)
+    """
+    if enabled and not isinstance(f, PositionalFile):
+        return PositionalFile(f)
+    return f
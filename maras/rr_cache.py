@@ -17,34 +17,41 @@
 
 import functools
 from random import choice
+from threading import Lock
 
 
 def cache1lvl(maxsize=100):
     def decorating_function(user_function):
         cache1lvl = {}
+        lock = Lock()
 
         @functools.wraps(user_function)
         def wrapper(key, *args, **kwargs):
             try:
                 result = cache1lvl[key]
             except KeyError:
-                if len(cache1lvl) == maxsize:
-                    for i in xrange(maxsize // 10 or 1):
-                        del cache1lvl[choice(cache1lvl.keys())]
-                cache1lvl[key] = user_function(key, *args, **kwargs)
-                result = cache1lvl[key]
+                # not under the lock, readers of RWThreadSafeDatabase
+                # miss at once
+                result = user_function(key, *args, **kwargs)
+                with lock:
+                    if len(cache1lvl) >= maxsize:
+                        for i in xrange(maxsize // 10 or 1):
+                            del cache1lvl[choice(cache1lvl.keys())]
+                    cache1lvl[key] = result
 #                result = user_function(obj, key, *args, **kwargs)
             return result
 
         def clear():
-            cache1lvl.clear()
+            with lock:
+                cache1lvl.clear()
 
         def delete(key):
-            try:
-                del cache1lvl[key]
-                return True
-            except KeyError:
-                return False
+            with lock:
+                try:
+                    del cache1lvl[key]
+                    return True
+                except KeyError:
+                    return False
 
         wrapper.clear = clear
         wrapper.cache = cache1lvl
@@ -56,6 +63,7 @@ def cache1lvl(maxsize=100):
 def cache2lvl(maxsize=100):
     def decorating_function(user_function):
         cache = {}
+        lock = Lock()
 
         @functools.wraps(user_function)
         def wrapper(*args, **kwargs):
@@ -63,46 +71,52 @@ def cache2lvl(maxsize=100):
             try:
                 result = cache[args[0]][args[1]]
             except KeyError:
-#                print wrapper.cache_size
-                if wrapper.cache_size == maxsize:
-                    to_delete = maxsize // 10 or 1
-                    for i in xrange(to_delete):
-                        key1 = choice(cache.keys())
-                        key2 = choice(cache[key1].keys())
-                        del cache[key1][key2]
-                        if not cache[key1]:
-                            del cache[key1]
-                    wrapper.cache_size -= to_delete
-#                print wrapper.cache_size
                 result = user_function(*args, **kwargs)
-                try:
-                    cache[args[0]][args[1]] = result
-                except KeyError:
-                    cache[args[0]] = {args[1]: result}
-                wrapper.cache_size += 1
+                with lock:
+#                    print wrapper.cache_size
+                    if wrapper.cache_size >= maxsize:
+                        to_delete = maxsize // 10 or 1
+                        for i in xrange(to_delete):
+                            key1 = choice(cache.keys())
+                            key2 = choice(cache[key1].keys())
+                            del cache[key1][key2]
+                            if not cache[key1]:
+                                del cache[key1]
+                        wrapper.cache_size -= to_delete
+#                    print wrapper.cache_size
+                    try:
+                        inner = cache[args[0]]
+                    except KeyError:
+                        inner = cache[args[0]] = {}
+                    # other thread could miss the same key
+                    if args[1] not in inner:
+                        wrapper.cache_size += 1
+                    inner[args[1]] = result
             return result
 
         def clear():
-            cache.clear()
-            wrapper.cache_size = 0
+            with lock:
+                cache.clear()
+                wrapper.cache_size = 0
 
         def delete(key, inner_key=None):
-            if inner_key:
-                try:
-                    del cache[key][inner_key]
-                    if not cache[key]:
+            with lock:
+                if inner_key:
+                    try:
+                        del cache[key][inner_key]
+                        if not cache[key]:
+                            del cache[key]
+                        wrapper.cache_size -= 1
+                        return True
+                    except KeyError:
+                        return False
+                else:
+                    try:
+                        wrapper.cache_size -= len(cache[key])
                         del cache[key]
-                    wrapper.cache_size -= 1
-                    return True
-                except KeyError:
-                    return False
-            else:
-                try:
-                    wrapper.cache_size -= len(cache[key])
-                    del cache[key]
-                    return True
-                except KeyError:
-                    return False
+                        return True
+                    except KeyError:
+                        return False
 
         wrapper.clear = clear
         wrapper.cache = cache
@@ -31,23 +31,27 @@ def create_cache1lvl(lock_obj):
                 try:
                     result = cache[key]
                 except KeyError:
+                    # not under the lock, readers of RWThreadSafeDatabase
+                    # miss at once
+                    result = user_function(key, *args, **kwargs)
                     with lock:
-                        if len(cache) == maxsize:
+                        if len(cache) >= maxsize:
                             for i in xrange(maxsize // 10 or 1):
                                 del cache[choice(cache.keys())]
-                        cache[key] = user_function(key, *args, **kwargs)
-                        result = cache[key]
+                        cache[key] = result
                 return result
 
             def clear():
-                cache.clear()
+                with lock:
+                    cache.clear()
 
             def delete(key):
-                try:
-                    del cache[key]
-                    return True
-                except KeyError:
-                    return False
+                with lock:
+                    try:
+                        del cache[key]
+                        return True
+                    except KeyError:
+                        return False
 
             wrapper.clear = clear
             wrapper.cache = cache
@@ -68,8 +72,9 @@ def create_cache2lvl(lock_obj):
                 try:
                     result = cache[args[0]][args[1]]
                 except KeyError:
+                    result = user_function(*args, **kwargs)
                     with lock:
-                        if wrapper.cache_size == maxsize:
+                        if wrapper.cache_size >= maxsize:
                             to_delete = maxsize // 10 or 1
                             for i in xrange(to_delete):
                                 key1 = choice(cache.keys())
@@ -78,35 +83,39 @@ def create_cache2lvl(lock_obj):
                                 if not cache[key1]:
                                     del cache[key1]
                             wrapper.cache_size -= to_delete
-                        result = user_function(*args, **kwargs)
                         try:
-                            cache[args[0]][args[1]] = result
+                            inner = cache[args[0]]
                         except KeyError:
-                            cache[args[0]] = {args[1]: result}
-                        wrapper.cache_size += 1
+                            inner = cache[args[0]] = {}
+                        # other thread could miss the same key
+                        if args[1] not in inner:
+                            wrapper.cache_size += 1
+                        inner[args[1]] = result
                 return result
 
             def clear():
-                cache.clear()
-                wrapper.cache_size = 0
+                with lock:
+                    cache.clear()
+                    wrapper.cache_size = 0
 
             def delete(key, *args):
-                if args:
-                    try:
-                        del cache[key][args[0]]
-                        if not cache[key]:
+                with lock:
+                    if args:
+                        try:
+                            del cache[key][args[0]]
+                            if not cache[key]:
+                                del cache[key]
+                            wrapper.cache_size -= 1
+                            return True
+                        except KeyError:
+                            return False
+                    else:
+                        try:
+                            wrapper.cache_size -= len(cache[key])
                             del cache[key]
-                        wrapper.cache_size -= 1
-                        return True
-                    except KeyError:
-                        return False
-                else:
-                    try:
-                        wrapper.cache_size -= len(cache[key])
-                        del cache[key]
-                        return True
-                    except KeyError:
-                        return False
+                            return True
+                        except KeyError:
+                            return False
 
             wrapper.clear = clear
             wrapper.cache = cache
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Import python libs
+from threading import Condition, Lock
+from thread import get_ident
+
+
+class RWLock(object):
+    """
+    Reentrant readers-writer lock. Taken with ``acquire`` / ``release`` or
+    as context manager it's exclusive (so it can replace ``RLock``), its
+    :py:attr:`shared` side can be held by many readers at once.
+
+    Waiting writers go before new readers, readers already holding the
+    lock take it again without waiting. Writer can take shared side too,
+    reader can't take exclusive one (it would wait for itself).
+    """
+
+    def __init__(self):
+        lock = Lock()
+        self._read_ok = Condition(lock)
+        self._write_ok = Condition(lock)
+        self._readers = {}  # thread -> depth
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        self.shared = _SharedLock(self)
+
+    def acquire(self):
+        me = get_ident()
+        with self._write_ok:
+            if self._writer == me:
+                self._writer_depth += 1
+                return True
+            if me in self._readers:
+                raise RuntimeError("Can't upgrade shared lock to exclusive")
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._write_ok.wait()
+            except:
+                self._writers_waiting -= 1
+                self._wake()
+                raise
+            self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+            return True
+
+    def release(self):
+        with self._write_ok:
+            if self._writer != get_ident():
+                raise RuntimeError("Cannot release un-acquired lock")
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._wake()
+
+    def _wake(self):
+        # next writer goes first, readers when there is none
+        if self._writer is not None or self._readers:
+            return
+        if self._writers_waiting:
+            self._write_ok.notify()
+        else:
+            self._read_ok.notify_all()
+
+    def acquire_shared(self):
+        me = get_ident()
+        depth = self._readers.get(me)
+        if depth:
+            # only this thread changes its own depth
+            self._readers[me] = depth + 1
+            return True
+        with self._read_ok:
+            if self._writer == me:
+                self._readers[me] = 1
+                return True
+            while self._writer is not None or self._writers_waiting:
+                self._read_ok.wait()
+            self._readers[me] = 1
+            return True
+
+    def release_shared(self):
+        me = get_ident()
+        depth = self._readers.get(me)
+        if not depth:
+            raise RuntimeError("Cannot release un-acquired lock")
+        if depth > 1:
+            self._readers[me] = depth - 1
+            return
+        with self._read_ok:
+            del self._readers[me]
+            self._wake()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class _SharedLock(object):
+    """
+    Shared side of :py:class:`RWLock`, used the same way as the lock
+    """
+
+    def __init__(self, lock):
+        self.acquire = lock.acquire_shared
+        self.release = lock.release_shared
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -15,8 +15,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
 
-from maras.index import Index
+from maras.index import Index, IndexException
 
 
 class ShardedIndex(Index):
@@ -91,20 +92,44 @@ class ShardedIndex(Index):
         for curr in self.shards.itervalues():
             curr.destroy()
 
-    def compact(self):
+    def compact(self, *args, **kwargs):
         for curr in self.shards.itervalues():
-            curr.compact()
+            curr.compact(*args, **kwargs)
 
     def reindex(self):
         for curr in self.shards.itervalues():
             curr.reindex()
 
+    def begin_batch(self):
+        for curr in self.shards.itervalues():
+            curr.begin_batch()
+
+    def end_batch(self, commit=True):
+        # like Database.batch, all shards are released before raising
+        exc_info = None
+        for curr in self.shards.itervalues():
+            try:
+                curr.end_batch(commit)
+            except Exception:
+                exc_info = exc_info or sys.exc_info()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _no_cursor(self, args, kwargs, pos):
+        # shards are read one after another, position in single shard
+        # doesn't tell where to continue
+        if kwargs.get('cursor') is not None or \
+                (len(args) > pos and args[pos] is not None):
+            raise IndexException("Cursors are not supported by sharded indexes")
+
     def all(self, *args, **kwargs):
+        self._no_cursor(args, kwargs, 2)
         for curr in self.shards.itervalues():
             for now in curr.all(*args, **kwargs):
                 yield now
 
     def get_many(self, *args, **kwargs):
+        self._no_cursor(args, kwargs, 3)
         for curr in self.shards.itervalues():
             for now in curr.get_many(*args, **kwargs):
                 yield now
@@ -16,15 +16,26 @@
 # limitations under the License.
 
 import os
+import re
 import struct
+import shutil
 import msgpack
 import io
+from collections import defaultdict
+from itertools import islice
+from threading import Lock
 
 
 try:
     from maras import __version__
 except ImportError:
     from __init__ import __version__
+from maras.mapped_file import MappedFile
+from maras.batch_file import BatchFile
+from maras.page_cache import CachedFile
+from maras.positional_file import positional
+from maras.compression import codecs, codec_tags, MARKER
+from maras.lazy import LazyDocument, msgpack_default, project, is_map
 
 
 class StorageException(Exception):
@@ -63,6 +74,18 @@ class DummyStorage(object):
     def get(self, *args, **kwargs):
         return None
 
+    def get_multi(self, positions, *args, **kwargs):
+        return [None] * len(positions)
+
+    def free(self, *args, **kwargs):
+        pass
+
+    def pin(self, *args, **kwargs):
+        pass
+
+    def unpin(self, *args, **kwargs):
+        pass
+
     # def compact(self, *args, **kwargs):
     #     pass
 
@@ -72,15 +95,94 @@ class DummyStorage(object):
     def flush(self, *args, **kwargs):
         pass
 
+    def begin_batch(self, *args, **kwargs):
+        pass
+
+    def end_batch(self, *args, **kwargs):
+        pass
+
 
 class IU_Storage(object):
+    """
+    File of msgpack records. Space of records that are not used anymore
+    (reported by indexes with :py:meth:`free`) is kept in free lists by
+    size class and reused by next saves, adjacent free extents are merged.
+    Records are appended only when no free extent is big enough.
+
+    Free lists are written to ``<name>_stor_free`` on close and read back
+    on open (only when storage file wasn't changed in the meantime).
+    While storage is pinned by scans (:py:meth:`pin`) freed space isn't
+    reused, positions of records they hold stay valid.
+
+    Records of at least ``compress_min_size`` bytes are compressed with
+    ``compression`` codec (see :py:mod:`maras.compression`) when it
+    makes them smaller. Dictionary made by :py:meth:`train_dictionary`
+    is kept in ``<name>_stor_dict``.
+    """
 
     __version__ = __version__
 
-    def __init__(self, db_path, name='main'):
+    compress_min_size = 64
+
+    offset_format = 'I'  # : smallest start field of index elements pointing to records
+
+    def __init__(self, db_path, name='main', use_mmap=False, page_cache=None,
+                 compression=None, positional_files=False):
         self.db_path = db_path
         self.name = name
+        self.use_mmap = use_mmap
+        self.page_cache = page_cache
+        self.positional_files = positional_files
+        self.compression = compression
         self._header_size = 100
+        self._dictionary = None
+        self._set_codec()
+        self._clear_free()
+        self._pins = 0
+        self._deferred = []  # (start, size) freed while pinned
+        self._pin_lock = Lock()
+
+    def _set_codec(self):
+        self._codec = None
+        self._codecs = {}  # tag -> codec, for reads
+        if self.compression:
+            try:
+                codec = codecs[self.compression]
+            except KeyError:
+                raise StorageException(
+                    "Unknown compression `%s`" % self.compression)
+            self._codec = codec(self._dictionary)
+            self._codecs[self._codec.tag] = self._codec
+
+    def _decoder(self, tag):
+        try:
+            return self._codecs[tag]
+        except KeyError:
+            try:
+                codec, with_dict = codec_tags[tag]
+            except KeyError:
+                raise StorageException("Unknown codec tag `%s`" % tag)
+            if with_dict and self._dictionary is None:
+                raise StorageException("Missing compression dictionary")
+            decoder = codec(self._dictionary if with_dict else None)
+            self._codecs[tag] = decoder
+            return decoder
+
+    def _clear_free(self):
+        self._free = {}  # start -> size
+        self._free_ends = {}  # end -> start
+        self._free_classes = [set() for _ in xrange(64)]  # by size.bit_length()
+        self._free_backup = None
+        self.free_space = 0
+
+    def _open_file(self, path=None):
+        f = io.open(path or os.path.join(
+            self.db_path, self.name + "_stor"), 'r+b', buffering=0)
+        if self.use_mmap:
+            f = MappedFile(f)
+        elif self.page_cache is not None:
+            f = CachedFile(f, self.page_cache)
+        return positional(f, self.positional_files)
 
     def create(self):
         if os.path.exists(os.path.join(self.db_path, self.name + "_stor")):
@@ -88,30 +190,110 @@ class IU_Storage(object):
         with io.open(os.path.join(self.db_path, self.name + "_stor"), 'wb') as f:
             f.write(struct.pack("10s90s", self.__version__, '|||||'))
             f.close()
-        self._f = io.open(os.path.join(
-            self.db_path, self.name + "_stor"), 'r+b', buffering=0)
+        self._f = self._open_file()
+        self._clear_free()
+        self._save_dictionary()
         self.flush()
         self._f.seek(0, 2)
 
     def open(self):
         if not os.path.exists(os.path.join(self.db_path, self.name + "_stor")):
             raise IOError("Storage doesn't exists!")
-        self._f = io.open(os.path.join(
-            self.db_path, self.name + "_stor"), 'r+b', buffering=0)
+        self._f = self._open_file()
+        self._load_free()
+        self._load_dictionary()
         self.flush()
         self._f.seek(0, 2)
 
     def destroy(self):
-        os.unlink(os.path.join(self.db_path, self.name + '_stor'))
+        for path in self._files():
+            os.unlink(path)
+
+    def _files(self):
+        """
+        Returns paths of all existing storage files
+        """
+        paths = [os.path.join(self.db_path, self.name + '_stor')]
+        for path in (self._free_path(), self._dictionary_path()):
+            if os.path.exists(path):
+                paths.append(path)
+        return paths
+
+    def move(self, name):
+        """
+        Renames files of (closed) storage to ones of storage ``name``
+        """
+        prefix = len(os.path.join(self.db_path, self.name))
+        for path in self._files():
+            shutil.move(path, os.path.join(self.db_path, name + path[prefix:]))
+        self.name = name
+
+    def _like(self, name):
+        """
+        Returns new (not created) storage ``name`` with the same options
+        (and compression dictionary)
+        """
+        storage = self.__class__(self.db_path, name, use_mmap=self.use_mmap,
+                                 page_cache=self.page_cache,
+                                 compression=self.compression,
+                                 positional_files=self.positional_files)
+        storage._dictionary = self._dictionary
+        storage._set_codec()
+        return storage
+
+    def _dictionary_path(self):
+        return os.path.join(self.db_path, self.name + '_stor_dict')
+
+    def _save_dictionary(self):
+        if self._dictionary is not None:
+            with io.open(self._dictionary_path(), 'wb') as f:
+                f.write(self._dictionary)
+
+    def _load_dictionary(self):
+        self._dictionary = None
+        if os.path.exists(self._dictionary_path()):
+            with io.open(self._dictionary_path(), 'rb') as f:
+                self._dictionary = f.read()
+        self._set_codec()
+
+    def train_dictionary(self, samples, size=32 * 1024):
+        """
+        Builds compression dictionary (helps with small records) from
+        sample records, used for all next saves. Storage can have only
+        one dictionary, records compressed with it need it for reads.
+        """
+        if not self.compression:
+            raise StorageException("Storage without compression")
+        if self._dictionary is not None:
+            raise StorageException("Storage has dictionary already")
+        samples = [msgpack.dumps(sample) for sample in samples]
+        self._dictionary = codecs[self.compression].train(samples, size)
+        self._save_dictionary()
+        self._set_codec()
 
     def close(self):
+        self._free_deferred()
+        self._save_free()
         self._f.close()
         # self.flush()
         # self.fsync()
 
-    def data_from(self, data):
-        try:
+    def _decompress(self, data):
+        if data[:1] == MARKER:
+            return self._decoder(data[1]).decompress(data[2:])
+        return data
+
+    def data_from(self, data, lazy=False, fields=None):
+        if fields is not None:
+            return project(self._decompress(data), fields)
+        if lazy:
+            # only maps are documents, index values can be anything
+            data = self._decompress(data)
+            if is_map(data):
+                return LazyDocument(data)
             return msgpack.loads(data)
+        try:
+            return msgpack.loads(self._decompress(data))
         except:
             with open('/tmp/msgpack.p', 'w+b') as fp_:
                 fp_.write(data)
@@ -119,29 +301,199 @@ class IU_Storage(object):
         raise
 
     def data_to(self, data):
-        return msgpack.dumps(data)
+        s_data = msgpack.dumps(data, default=msgpack_default)
+        codec = self._codec
+        if codec is not None and len(s_data) >= self.compress_min_size:
+            packed = codec.compress(s_data)
+            if len(packed) + 2 < len(s_data):
+                return MARKER + codec.tag + packed
+        return s_data
 
     def save(self, data):
         s_data = self.data_to(data)
-        self._f.seek(0, 2)
-        start = self._f.tell()
         size = len(s_data)
-        self._f.write(s_data)
+        start = self._write(self._alloc(size), s_data)
         self.flush()
         return start, size
 
+    def _read(self, start, size):
+        self._f.seek(start)
+        return self._f.read(size)
+
+    def _write(self, start, data):
+        """
+        Writes raw ``data`` at ``start`` (appends when it's ``None``),
+        returns start of written data
+        """
+        if start is None:
+            self._f.seek(0, 2)
+            start = self._f.tell()
+        else:
+            self._f.seek(start)
+        self._f.write(data)
+        return start
+
+    def free(self, start, size):
+        """
+        Marks ``size`` bytes at ``start`` as not used by any record,
+        next saves may overwrite them
+        """
+        if not size or start < self._header_size or start in self._free:
+            return
+        if self._pins:
+            with self._pin_lock:
+                if self._pins:
+                    self._deferred.append((start, size))
+                    return
+        end = start + size
+        prev_start = self._free_ends.get(start)
+        if prev_start is not None:
+            self._unlink_free(prev_start)
+            start = prev_start
+        if end in self._free:
+            end += self._unlink_free(end)
+        self._link_free(start, end - start)
+
+    def _link_free(self, start, size):
+        self._free[start] = size
+        self._free_ends[start + size] = start
+        self._free_classes[size.bit_length()].add(start)
+        self.free_space += size
+
+    def _unlink_free(self, start):
+        size = self._free.pop(start)
+        del self._free_ends[start + size]
+        self._free_classes[size.bit_length()].discard(start)
+        self.free_space -= size
+        return size
+
+    def pin(self):
+        """
+        Defers reuse of freed space until matching :py:meth:`unpin`, used
+        by scans which read records later than they found them
+        """
+        with self._pin_lock:
+            self._pins += 1
+
+    def unpin(self):
+        with self._pin_lock:
+            self._pins -= 1
+            if self._pins:
+                return
+        self._free_deferred()
+
+    def _free_deferred(self):
+        with self._pin_lock:
+            deferred, self._deferred = self._deferred, []
+        # not through database lock wrappers, last reader can be the one
+        free = self.__class__.free
+        for start, size in deferred:
+            free(self, start, size)
+
+    def _alloc(self, size):
+        """
+        Returns start of free extent for ``size`` bytes (rest of the extent
+        stays free) or ``None`` when there is no big enough one
+        """
+        if not self.free_space:
+            return None
+        classes = self._free_classes
+        num = size.bit_length()
+        for start in islice(classes[num], 8):
+            if self._free[start] >= size:
+                break
+        else:
+            # every extent in bigger class fits
+            for num in xrange(num + 1, len(classes)):
+                if classes[num]:
+                    start = next(iter(classes[num]))
+                    break
+            else:
+                return None
+        extent = self._unlink_free(start)
+        if extent > size:
+            self._link_free(start + size, extent - size)
+        return start
+
+    def _free_path(self):
+        return os.path.join(self.db_path, self.name + '_stor_free')
+
+    def _stat(self):
+        stat = os.fstat(self._f.fileno())
+        return [stat.st_size, stat.st_ino]
+
+    def _save_free(self):
+        if self._free and not self._f.closed:
+            with io.open(self._free_path(), 'wb') as f:
+                f.write(msgpack.dumps((self._stat(), self._free.items())))
+
+    def _load_free(self):
+        self._clear_free()
+        path = self._free_path()
+        if not os.path.exists(path):
+            return
+        with io.open(path, 'rb') as f:
+            stat, extents = msgpack.loads(f.read())
+        # removed, so they can't be used again after crash
+        os.unlink(path)
+        if stat == self._stat():
+            for start, size in extents:
+                self._link_free(start, size)
+
     def insert(self, data):
         return self.save(data)
 
     def update(self, data):
         return self.save(data)
 
-    def get(self, start, size, status='c'):
+    def get(self, start, size, status='c', lazy=False, fields=None):
+        """
+        Returns record data, :py:class:`maras.lazy.LazyDocument` with ``lazy``,
+        only the given ``fields`` of it when set
+        """
         if status == 'd':
             return None
         else:
-            self._f.seek(start)
-            return self.data_from(self._f.read(size))
+            return self.data_from(self._read(start, size), lazy, fields)
+
+    def get_multi(self, positions, max_gap=4096, max_read=1024 * 1024,
+                  lazy=False, fields=None):
+        """
+        Returns data for many ``(start, size, status)`` positions, in the
+        given order. Positions are read in offset order, records closer
+        than ``max_gap`` bytes to each other are fetched with single read
+        (of up to ``max_read`` bytes).
+        """
+        res = [None] * len(positions)
+        order = sorted((pos[0], i) for i, pos in enumerate(positions)
+                       if pos[1] and pos[2] != 'd')
+        run = []
+        run_start = run_end = 0
+        for start, i in order:
+            end = start + positions[i][1]
+            if run and (start - run_end > max_gap or
+                        max(end, run_end) - run_start > max_read):
+                self._read_run(run_start, run_end, run, positions, res, lazy,
+                               fields)
+                run = []
+            if not run:
+                run_start = start
+                run_end = end
+            elif end > run_end:
+                run_end = end
+            run.append(i)
+        if run:
+            self._read_run(run_start, run_end, run, positions, res, lazy,
+                           fields)
+        return res
+
+    def _read_run(self, run_start, run_end, run, positions, res, lazy=False,
+                  fields=None):
+        buf = self._read(run_start, run_end - run_start)
+        for i in run:
+            offset = positions[i][0] - run_start
+            res[i] = self.data_from(buf[offset:offset + positions[i][1]],
+                                    lazy, fields)
 
     def flush(self):
         self._f.flush()
@@ -149,6 +501,252 @@ class IU_Storage(object):
     def fsync(self):
         os.fsync(self._f.fileno())
 
+    def begin_batch(self):
+        if not isinstance(self._f, BatchFile):
+            self._f = BatchFile(self._f)
+            self._free_backup = dict(self._free)
+
+    def end_batch(self, commit=True):
+        if isinstance(self._f, BatchFile):
+            self._f = self._f.release(commit)
+            self._release_free(commit)
+
+    def _release_free(self, commit):
+        backup = self._free_backup
+        self._free_backup = None
+        if not commit:
+            self._clear_free()
+            for start, size in backup.iteritems():
+                self._link_free(start, size)
+
+
+class SegmentedStorage(IU_Storage):
+    """
+    Storage with records in segment files ``<name>_stor_<n>`` of up to
+    ``segment_size`` bytes, ``<name>_stor`` keeps only the header with
+    segment size. New segment is started when record doesn't fit in the
+    last one, record start is ``n * segment_size + offset in segment``.
+
+    Segment (other than the last one) is removed as soon as all its
+    records are freed, other segments are not touched. Segment numbers
+    are not reused, so starts grow with all data ever written, indexes
+    need 64 bit start field (``offset_format='Q'``, their default with
+    this storage).
+    """
+
+    segment_size = 64 * 1024 * 1024
+    offset_format = 'Q'
+    _header_format = '<10sQ82s'
+
+    def __init__(self, db_path, name='main', use_mmap=False, page_cache=None,
+                 compression=None, segment_size=None, positional_files=False):
+        super(SegmentedStorage, self).__init__(db_path, name, use_mmap,
+                                               page_cache, compression,
+                                               positional_files)
+        self.segment_size = segment_size or self.segment_size
+        self._segs = {}  # segment number -> file
+        self._active = None
+        self._batch = False
+
+    def _like(self, name):
+        storage = super(SegmentedStorage, self)._like(name)
+        storage.segment_size = self.segment_size
+        return storage
+
+    def _segment_path(self, num):
+        return os.path.join(self.db_path, '%s_stor_%d' % (self.name, num))
+
+    def _segment_nums(self):
+        pattern = re.compile(re.escape(self.name) + r'_stor_(\d+)$')
+        nums = []
+        for fname in os.listdir(self.db_path):
+            match = pattern.match(fname)
+            if match:
+                nums.append(int(match.group(1)))
+        return sorted(nums)
+
+    def _files(self):
+        paths = [os.path.join(self.db_path, self.name + '_stor')]
+        paths.extend(self._segment_path(num) for num in self._segment_nums())
+        for path in (self._free_path(), self._dictionary_path()):
+            if os.path.exists(path):
+                paths.append(path)
+        return paths
+
+    def create(self):
+        path = os.path.join(self.db_path, self.name + "_stor")
+        if os.path.exists(path):
+            raise IOError("Storage already exists!")
+        with io.open(path, 'wb') as f:
+            f.write(struct.pack(self._header_format, self.__version__,
+                                self.segment_size, '|||||'))
+        self._clear_free()
+        self._save_dictionary()
+        self._segs = {}
+        self._new_segment(1)
+
+    def open(self):
+        path = os.path.join(self.db_path, self.name + "_stor")
+        if not os.path.exists(path):
+            raise IOError("Storage doesn't exists!")
+        with io.open(path, 'rb') as f:
+            self.segment_size = struct.unpack(
+                self._header_format, f.read(self._header_size))[1]
+        self._segs = {}
+        for num in self._segment_nums():
+            self._segs[num] = self._open_file(self._segment_path(num))
+        if self._segs:
+            self._active = max(self._segs)
+            self._f = self._segs[self._active]
+        else:
+            self._new_segment(1)
+        self._load_free()
+        self._load_dictionary()
+
+    def close(self):
+        self._free_deferred()
+        self._save_free()
+        for f in self._segs.itervalues():
+            f.close()
+
+    def _new_segment(self, num):
+        path = self._segment_path(num)
+        with io.open(path, 'wb') as f:
+            f.write(struct.pack("10s90s", self.__version__, '|||||'))
+        f = self._open_file(path)
+        if self._batch:
+            f = BatchFile(f)
+        self._segs[num] = self._f = f
+        self._active = num
+
+    def _segment(self, num):
+        try:
+            return self._segs[num]
+        except KeyError:
+            # started by other storage object on the same files
+            # (like the one of online compaction source)
+            path = self._segment_path(num)
+            if not os.path.exists(path):
+                return None
+            f = self._segs[num] = self._open_file(path)
+            return f
+
+    def _read(self, start, size):
+        segment_size = self.segment_size
+        end = start + size
+        chunks = []
+        # single record is always in one segment, runs of get_multi
+        # may span more of them
+        while start < end:
+            num, offset = divmod(start, segment_size)
+            chunk = min(end, (num + 1) * segment_size) - start
+            f = self._segment(num)
+            data = b''
+            if f is not None:
+                f.seek(offset)
+                data = f.read(chunk)
+            if len(data) < chunk:
+                data += b'\x00' * (chunk - len(data))
+            chunks.append(data)
+            start += chunk
+        return b''.join(chunks)
+
+    def _write(self, start, data):
+        if start is None:
+            size = len(data)
+            if size > self.segment_size - self._header_size:
+                raise StorageException("Record bigger than segment")
+            self._f.seek(0, 2)
+            if self._f.tell() + size > self.segment_size:
+                self._new_segment(self._active + 1)
+                self._f.seek(0, 2)
+            f = self._f
+            start = self._active * self.segment_size + f.tell()
+        else:
+            num, offset = divmod(start, self.segment_size)
+            f = self._segs[num]
+            f.seek(offset)
+        f.write(data)
+        return start
+
+    def _clear_free(self):
+        super(SegmentedStorage, self)._clear_free()
+        self._seg_free = defaultdict(int)
+
+    def _link_free(self, start, size):
+        super(SegmentedStorage, self)._link_free(start, size)
+        self._seg_free[start // self.segment_size] += size
+
+    def _unlink_free(self, start):
+        size = super(SegmentedStorage, self)._unlink_free(start)
+        self._seg_free[start // self.segment_size] -= size
+        return size
+
+    def free(self, start, size):
+        super(SegmentedStorage, self).free(start, size)
+        if not self._batch:
+            self._drop_dead(start // self.segment_size)
+
+    def _data_size(self, num):
+        f = self._segs[num]
+        f.seek(0, 2)
+        return f.tell() - self._header_size
+
+    def _drop_dead(self, num):
+        """
+        Removes segment ``num`` when all its records are free
+        """
+        if num == self._active or num not in self._segs:
+            return
+        if self._seg_free[num] < self._data_size(num):
+            return
+        # free extents are merged, so it's a single one
+        self._unlink_free(num * self.segment_size + self._header_size)
+        del self._seg_free[num]
+        self._segs.pop(num).close()
+        os.unlink(self._segment_path(num))
+
+    def segment_stats(self):
+        """
+        Returns ``{segment number: (data size, free size)}``
+        """
+        return dict((num, (self._data_size(num), self._seg_free.get(num, 0)))
+                    for num in self._segs)
+
+    def _stat(self):
+        stats = []
+        for num, f in sorted(self._segs.iteritems()):
+            stat = os.fstat(f.fileno())
+            stats.append([num, stat.st_size, stat.st_ino])
+        return stats
+
+    def flush(self):
+        for f in self._segs.itervalues():
+            f.flush()
+
+    def fsync(self):
+        for f in self._segs.itervalues():
+            os.fsync(f.fileno())
+
+    def begin_batch(self):
+        if not self._batch:
+            self._batch = True
+            self._free_backup = dict(self._free)
+            for num, f in self._segs.items():
+                self._segs[num] = BatchFile(f)
+            self._f = self._segs[self._active]
+
+    def end_batch(self, commit=True):
+        if self._batch:
+            self._batch = False
+            for num, f in self._segs.items():
+                self._segs[num] = f.release(commit)
+            self._f = self._segs[self._active]
+            self._release_free(commit)
+            if commit:
+                for num in self._segs.keys():
+                    self._drop_dead(num)
+
 
 # classes for public use, done in this way because of
 # generation static files with indexes (_index directory)
@@ -156,3 +754,14 @@ class IU_Storage(object):
 
 class Storage(IU_Storage):
     pass
+
+
+def storage_offset_format(storage_class):
+    """
+    Returns start field format needed by records of ``storage_class``
+    (class or its name, unknown names get :py:class:`IU_Storage` one)
+    """
+    if isinstance(storage_class, basestring):
+        storage_class = globals().get(storage_class, IU_Storage)
+    return getattr(storage_class or IU_Storage, 'offset_format', 'I')
+
@@ -17,16 +17,23 @@
 
 
 from index import Index, IndexException, DocIdNotFound, ElemNotFound
+from index import encode_cursor, decode_cursor
 import struct
 import msgpack
 import os
 import io
 import shutil
-from storage import IU_Storage
+import heapq
+import tempfile
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from operator import itemgetter
+from storage import IU_Storage, SegmentedStorage, storage_offset_format
 # from ipdb import set_trace
 
 from maras.env import menv
 from maras.index import TryReindexException
+from maras.misc import random_hex_32
 
 if menv.get('rlock_obj'):
     from maras import patch
@@ -34,17 +41,9 @@ if menv.get('rlock_obj'):
 
 from maras.rr_cache import cache1lvl, cache2lvl
 
-tree_buffer_size = io.DEFAULT_BUFFER_SIZE
-
-menv['tree_buffer_size'] = tree_buffer_size
-
-
 MODE_FIRST = 0
 MODE_LAST = 1
 
-MOVE_BUFFER_PREV = 0
-MOVE_BUFFER_NEXT = 1
-
 
 class NodeCapacityException(IndexException):
     pass
@@ -54,18 +53,45 @@ class IU_TreeBasedIndex(Index):
 
     custom_header = 'from maras.tree_index import TreeBasedIndex'
 
+    read_ahead = 8  # : leaves read at once by range scans
+
     def __init__(self, db_path, name, key_format='40s', pointer_format='I',
-                 meta_format='40sIIc', node_capacity=10, storage_class=None):
-        if node_capacity < 3:
-            raise NodeCapacityException
+                 meta_format='40sIIc', node_capacity=None, storage_class=None,
+                 use_mmap=False, offset_format=None, compression=None,
+                 page_size=0, leaf_prefix=False):
+        """
+        :param node_capacity: keys in single node or leaf, by default as many as fit in ``page_size`` (or 10 without it)
+        :param page_size: nodes and leaves are padded to multiple of it and start at its boundaries in bucket file (0 disables)
+        :param leaf_prefix: leaves store common prefix of their keys once and only key suffixes in records, so they hold up to ``2 * node_capacity - 1`` records (string ``key_format`` only)
+        :param offset_format: format of node pointers and start, size fields of elements, `Q` lets files grow past 4 GB (by default the one `storage_class` needs, see :py:func:`maras.storage.storage_offset_format`)
+        """
+        if offset_format is None:
+            offset_format = storage_offset_format(storage_class)
+        if offset_format != 'I':
+            # default node pointers and start, size of elements
+            if pointer_format == 'I':
+                pointer_format = offset_format
+            if meta_format.endswith('IIc'):
+                meta_format = meta_format[:-3] + '{0}{0}c'.format(offset_format)
         super(IU_TreeBasedIndex, self).__init__(db_path, name)
-        self.data_start = self._start_ind + 1
-        self.node_capacity = node_capacity
         self.flag_format = 'c'
         self.elements_counter_format = 'h'
         self.pointer_format = pointer_format
         self.key_format = key_format
         self.meta_format = meta_format
+        self.page_size = page_size
+        if leaf_prefix and not key_format.endswith('s'):
+            raise IndexException("leaf_prefix needs string key_format")
+        self.leaf_prefix = leaf_prefix
+        if node_capacity is None:
+            if page_size:
+                node_capacity = self._fit_node_capacity(page_size)
+            else:
+                node_capacity = 10
+        if node_capacity < 3:
+            raise NodeCapacityException
+        self.node_capacity = node_capacity
+        self.use_mmap = use_mmap
         self._count_props()
         if not storage_class:
             storage_class = IU_Storage
@@ -73,6 +99,8 @@ class IU_TreeBasedIndex(Index):
             storage_class = storage_class.__name__
         self.storage_class = storage_class
         self.storage = None
+        self.compression = compression
+        self._ahead = (0, '')  # start and data of last read ahead
         cache = cache1lvl(100)
         twolvl_cache = cache2lvl(150)
         self._find_key = cache(self._find_key)
@@ -80,7 +108,9 @@ class IU_TreeBasedIndex(Index):
 # self._read_single_leaf_record =
 # twolvl_cache(self._read_single_leaf_record)
         self._find_key_in_leaf = twolvl_cache(self._find_key_in_leaf)
-        self._read_single_node_key = twolvl_cache(self._read_single_node_key)
+        blocks_cache = cache1lvl(1000)
+        self._read_leaf = blocks_cache(self._read_leaf)
+        self._read_node = blocks_cache(self._read_node)
         self._find_first_key_occurence_in_node = twolvl_cache(
             self._find_first_key_occurence_in_node)
         self._find_last_key_occurence_in_node = twolvl_cache(
@@ -92,6 +122,32 @@ class IU_TreeBasedIndex(Index):
         self._read_node_nr_of_elements_and_children_flag = cache(
             self._read_node_nr_of_elements_and_children_flag)
 
+    @property
+    def offset_format(self):
+        """
+        Format of pointers to bucket file, saved props decide for opened index
+        """
+        return self.pointer_format
+
+    def _fit_node_capacity(self, page_size):
+        """
+        Biggest node capacity with which both nodes and leaves fit in
+        ``page_size`` (at least 3)
+        """
+        node_heading_size = struct.calcsize(
+            '<' + self.elements_counter_format + self.flag_format +
+            self.pointer_format)
+        node_record_size = struct.calcsize(
+            '<' + self.key_format + self.pointer_format)
+        leaf_heading_size = struct.calcsize(
+            '<' + self.elements_counter_format + self.pointer_format * 2 +
+            self.leaf_prefix_format)
+        leaf_record_size = struct.calcsize(
+            '<' + self.key_format + self.meta_format)
+        return max(min((page_size - node_heading_size) // node_record_size,
+                       (page_size - leaf_heading_size) // leaf_record_size),
+                   3)
+
     def _count_props(self):
         """
         Counts dynamic properties for tree, such as all complex formats
@@ -103,6 +159,7 @@ class IU_TreeBasedIndex(Index):
             + self.pointer_format + (self.key_format +
                                      self.pointer_format) * self.node_capacity
         self.leaf_format = self.elements_counter_format + self.pointer_format * 2\
+            + self.leaf_prefix_format\
             + (self.single_leaf_record_format) * self.node_capacity
         self.leaf_heading_format = self.elements_counter_format + \
             self.pointer_format * 2
@@ -124,10 +181,36 @@ class IU_TreeBasedIndex(Index):
             '<' + self.leaf_heading_format)
         self.node_heading_size = struct.calcsize(
             '<' + self.node_heading_format)
+        self.data_start = self._start_ind + 1
+        self.node_padding = self.leaf_padding = 0
+        if self.page_size:
+            # pad bytes after records, blocks appended at end of file stay aligned
+            self.data_start = -(-self.data_start // self.page_size) * self.page_size
+            self.node_padding = -self.node_size % self.page_size
+            self.leaf_padding = -self.leaf_size % self.page_size
+            self.node_format += '%dx' % self.node_padding
+            self.leaf_format += '%dx' % self.leaf_padding
+            self.node_size += self.node_padding
+            self.leaf_size += self.leaf_padding
+        self.leaf_struct = struct.Struct('<' + self.leaf_format)
+        self.node_struct = struct.Struct('<' + self.node_format)
+        # bytes for prefix length, prefix and records in prefixed leaf
+        self.leaf_space = struct.calcsize('<' + self.leaf_prefix_format) + \
+            self.node_capacity * self.single_leaf_record_size
+
+    @property
+    def leaf_prefix_format(self):
+        """
+        Format of prefix length stored after prefixed leaf heading
+        """
+        return 'H' if self.leaf_prefix else ''
 
     def create_index(self):
         if os.path.isfile(os.path.join(self.db_path, self.name + '_buck')):
             raise IndexException('Already exists')
+        # meta ends with start, size and status fields
+        self._check_start_format(globals()[self.storage_class],
+                                 self.meta_format[-3])
         with io.open(os.path.join(self.db_path, self.name + "_buck"), 'w+b') as f:
             props = dict(name=self.name,
                          flag_format=self.flag_format,
@@ -137,15 +220,23 @@ class IU_TreeBasedIndex(Index):
                          key_format=self.key_format,
                          meta_format=self.meta_format,
                          version=self.__version__,
-                         storage_class=self.storage_class)
+                         storage_class=self.storage_class,
+                         use_mmap=self.use_mmap,
+                         compression=self.compression,
+                         page_size=self.page_size,
+                         leaf_prefix=self.leaf_prefix,
+                         generation=random_hex_32())
             f.write(msgpack.dumps(props))
+        self.generation = props['generation']
         self.buckets = io.open(os.path.join(self.db_path, self.name +
                                             "_buck"), 'r+b', buffering=0)
+        self._map_buckets()
         self._create_storage()
         self.buckets.seek(self._start_ind)
-        self.buckets.write(struct.pack('<c', 'l'))
+        self._write(struct.pack('<c', 'l'))
         self._insert_empty_root()
         self.root_flag = 'l'
+        self._create_bloom()
 
     def destroy(self):
         super(IU_TreeBasedIndex, self).destroy()
@@ -159,7 +250,9 @@ class IU_TreeBasedIndex(Index):
         self.buckets.seek(self._start_ind)
         self.root_flag = struct.unpack('<c', self.buckets.read(1))[0]
         self._fix_params()
+        self._map_buckets()
         self._open_storage()
+        self._open_bloom()
 
     def _insert_empty_root(self):
         self.buckets.seek(self.data_start)
@@ -167,11 +260,12 @@ class IU_TreeBasedIndex(Index):
                            0,
                            0,
                            0)
-        root += self.single_leaf_record_size * self.node_capacity * '\x00'
-        self.buckets.write(root)
+        root += (self.leaf_size - len(root)) * '\x00'
+        self._write(root)
         self.flush()
 
     def insert(self, doc_id, key, start, size, status='o'):
+        self._bloom_add(key)
         nodes_stack, indexes = self._find_leaf_to_insert(key)
         self._insert_new_record_into_leaf(nodes_stack.pop(),
                                           key,
@@ -184,45 +278,425 @@ class IU_TreeBasedIndex(Index):
 
         self._match_doc_id.delete(doc_id)
 
-    def _read_leaf_nr_of_elements_and_neighbours(self, leaf_start):
+    def bulk_load(self, entries, sort_buffer=100000):
+        """
+        Builds tree bottom-up from ``(doc_id, key, start, size)`` entries
+        (optional fifth item is status).
+
+        Entries are sorted by key in runs of ``sort_buffer`` elements
+        (spilled to temporary files when there is more of them), then
+        leaves are written sequentially and node levels above them.
+        Works only on empty index, otherwise entries are just inserted
+        in key order.
+        """
+        if self.root_flag != 'l' or self._read_leaf_nr_of_elements(self.data_start):
+            return super(IU_TreeBasedIndex, self).bulk_load(
+                sorted(entries, key=itemgetter(1)))
+        records, count = self._sort_entries(entries, sort_buffer)
+        if not count:
+            return
+        leaves_nr = -(-count // self.node_capacity)
+        if leaves_nr == 1:
+            first_leaf = self.data_start
+        else:
+            first_leaf = self.data_start + self.node_size
+        if self.leaf_prefix:
+            level = self._write_prefixed_leaves(records, count, first_leaf)
+        else:
+            level = self._write_leaves(records, count, leaves_nr, first_leaf)
+        end = first_leaf + len(level) * self.leaf_size
+        children_flag = 'l'
+        while len(level) > 1:
+            nodes_nr = -(-len(level) // (self.node_capacity + 1))
+            upper = []
+            data = []
+            for children in self._split_evenly(level, nodes_nr):
+                if nodes_nr == 1:
+                    node_start = self.data_start
+                else:
+                    node_start = end + len(data) * self.node_size
+                data.append(self._prepare_node_data(children, children_flag))
+                upper.append((children[0][0], node_start))
+            if nodes_nr == 1:
+                self.buckets.seek(self.data_start)
+            else:
+                self.buckets.seek(end)
+                end += nodes_nr * self.node_size
+            self._write(''.join(data))
+            level = upper
+            children_flag = 'n'
+        self.root_flag = 'l' if leaves_nr == 1 else 'n'
+        self.buckets.seek(self._start_ind)
+        self._write(struct.pack('<c', self.root_flag))
+        self.flush()
+        self._clear_cache()
+        if self.bloom is not None:
+            self._build_bloom()
+
+    def bulk_load_with_storage(self, entries, sort_buffer=100000):
+        return self.bulk_load(self._store_values(entries), sort_buffer)
+
+    def _store_values(self, entries):
+        for doc_id, key, value in entries:
+            if value:
+                start, size = self.storage.insert(value)
+            else:
+                start = 1
+                size = 0
+            yield doc_id, key, start, size
+
+    def _sort_entries(self, entries, sort_buffer):
+        """
+        Returns sorted records iterator and their count. Keys are packed
+        and unpacked to compare them the same way as when stored.
+        """
+        key_struct = struct.Struct('<' + self.key_format)
+        runs = []
+        chunk = []
+        count = 0
+        for entry in entries:
+            if len(entry) > 4:
+                doc_id, key, start, size, status = entry
+            else:
+                doc_id, key, start, size = entry
+                status = 'o'
+            key = key_struct.unpack(key_struct.pack(key))[0]
+            # count keeps equal keys in insert order
+            chunk.append((key, count, doc_id, start, size, status))
+            count += 1
+            if len(chunk) == sort_buffer:
+                runs.append(self._spill_run(chunk))
+                chunk = []
+        chunk.sort()
+        if not runs:
+            return iter(chunk), count
+        runs = [self._read_run(run) for run in runs]
+        runs.append(iter(chunk))
+        return heapq.merge(*runs), count
+
+    def _spill_run(self, chunk):
+        chunk.sort()
+        f = tempfile.TemporaryFile(dir=self.db_path)
+        packer = msgpack.Packer()
+        for record in chunk:
+            f.write(packer.pack(record))
+        f.seek(0)
+        return f
+
+    def _read_run(self, f):
+        with f:
+            for record in msgpack.Unpacker(f, use_list=False):
+                yield record
+
+    def _split_evenly(self, items, parts):
+        base, extra = divmod(len(items), parts)
+        curr = 0
+        for part in xrange(parts):
+            size = base + 1 if part < extra else base
+            yield items[curr:curr + size]
+            curr += size
+
+    def _write_leaves(self, records, count, leaves_nr, first_leaf):
+        """
+        Writes ``leaves_nr`` linked leaves starting at ``first_leaf``,
+        returns list of (first key, leaf start) pairs.
+        """
+        record_struct = struct.Struct('<' + self.single_leaf_record_format)
+        heading_struct = struct.Struct('<' + self.leaf_heading_format)
+        base, extra = divmod(count, leaves_nr)
+        leaves = []
+        data = []
+        self.buckets.seek(first_leaf)
+        for nr in xrange(leaves_nr):
+            leaf_start = first_leaf + nr * self.leaf_size
+            prev_leaf = leaf_start - self.leaf_size if nr else 0
+            next_leaf = leaf_start + self.leaf_size if nr < leaves_nr - 1 else 0
+            size = base + 1 if nr < extra else base
+            leaf = [heading_struct.pack(size, prev_leaf, next_leaf)]
+            for record in islice(records, size):
+                leaf.append(record_struct.pack(record[0], *record[2:]))
+                if len(leaf) == 2:
+                    leaves.append((record[0], leaf_start))
+            leaf.append(((self.node_capacity - size) *
+                         self.single_leaf_record_size + self.leaf_padding) * '\x00')
+            data.append(''.join(leaf))
+            if len(data) == 256:
+                self._write(''.join(data))
+                data = []
+        self._write(''.join(data))
+        return leaves
+
+    def _write_prefixed_leaves(self, records, count, first_leaf):
+        """
+        :py:meth:`_write_leaves` for prefixed leaves, each one gets as many
+        records as fit (but no more than half of them when there is more
+        than one leaf).
+        """
+        if count > self.node_capacity:
+            max_nr = -(-count // 2)
+        else:
+            max_nr = count
+        leaves = []
+        data = []
+        leaf = []
+        self.buckets.seek(first_leaf)
+        for record in records:
+            record = (record[0], ) + tuple(record[2:])
+            if leaf and (len(leaf) == max_nr or not self._prefixed_leaf_fits(
+                    len(leaf) + 1, leaf[0][0], record[0])):
+                leaf_start = first_leaf + len(leaves) * self.leaf_size
+                prev_leaf = leaf_start - self.leaf_size if leaves else 0
+                data.append(self._encode_prefixed_leaf(
+                    leaf, prev_leaf, leaf_start + self.leaf_size))
+                leaves.append((leaf[0][0], leaf_start))
+                leaf = []
+                if len(data) == 256:
+                    self._write(''.join(data))
+                    data = []
+            leaf.append(record)
+        leaf_start = first_leaf + len(leaves) * self.leaf_size
+        prev_leaf = leaf_start - self.leaf_size if leaves else 0
+        data.append(self._encode_prefixed_leaf(leaf, prev_leaf, 0))
+        leaves.append((leaf[0][0], leaf_start))
+        self._write(''.join(data))
+        return leaves
+
+    def _prepare_node_data(self, children, children_flag):
+        node = [struct.pack('<' + self.node_heading_format + self.pointer_format,
+                            len(children) - 1,
+                            children_flag,
+                            children[0][1])]
+        for key, pointer in children[1:]:
+            node.append(struct.pack('<' + self.key_format + self.pointer_format,
+                                    key,
+                                    pointer))
+        node.append(((self.node_capacity - len(children) + 1) *
+                     (self.key_size + self.pointer_size) + self.node_padding) * '\x00')
+        return ''.join(node)
+
+    def _write(self, data):
+        """
+        Writes ``data`` at current position of buckets file, drops all
+        decoded nodes and leaves
+        """
+        self._read_leaf.clear()
+        self._read_node.clear()
+        self._ahead = (0, '')
+        self.buckets.write(data)
+
+    def _read_leaf(self, leaf_start):
+        """
+        Reads whole leaf at once, returns its decoded fields (number of
+        elements, neighbours and then records one after another) and its
+        keys. Leaves are cached until next write.
+        """
+        data = self._read_block(leaf_start, self.leaf_size).ljust(
+            self.leaf_size, '\x00')
+        if self.leaf_prefix:
+            return self._decode_prefixed_leaf(data)
+        fields = self.leaf_struct.unpack(data)
+        return fields, fields[3::5]
+
+    def _read_node(self, node_start):
+        """
+        Like :py:meth:`_read_leaf` for nodes, returns node fields, its keys
+        and pointers
+        """
+        self.buckets.seek(node_start)
+        data = self.buckets.read(self.node_size)
+        fields = self.node_struct.unpack(data.ljust(self.node_size, '\x00'))
+        return fields, fields[3::2], fields[2::2]
+
+    def _decode_prefixed_leaf(self, data):
+        """
+        :py:meth:`_read_leaf` for prefixed leaves, records get full keys
+        back (prefix is checked once, keys differ only in suffixes) and
+        are followed by one empty record like in not full plain leaf
+        """
+        nr, prev_leaf, next_leaf, prefix_len = struct.unpack_from(
+            '<' + self.leaf_heading_format + 'H', data)
+        pos = self.leaf_heading_size + 2
+        prefix = data[pos:pos + prefix_len]
+        records = list(struct.unpack_from(
+            '<' + ('%ds' % (self.key_size - prefix_len) + self.meta_format) * nr,
+            data, pos + prefix_len))
+        keys = [prefix + suffix for suffix in records[0::5]]
+        records[0::5] = keys
+        fields = (nr, prev_leaf, next_leaf) + tuple(records) + \
+            (self.key_size * '\x00', ) + struct.unpack(
+                '<' + self.meta_format, self.meta_size * '\x00')
+        return fields, keys
+
+    def _encode_prefixed_leaf(self, records, prev_leaf, next_leaf):
+        """
+        Returns whole prefixed leaf block with ``records`` (sorted
+        ``(key, doc_id, start, size, status)`` tuples)
+        """
+        keys = [record[0].ljust(self.key_size, '\x00')[:self.key_size]
+                for record in records]
+        prefix = os.path.commonprefix(keys[:1] + keys[-1:])
+        prefix_len = len(prefix)
+        data = [struct.pack('<' + self.leaf_heading_format + 'H',
+                            len(records), prev_leaf, next_leaf, prefix_len),
+                prefix]
+        meta_struct = struct.Struct('<' + self.meta_format)
+        for key, record in zip(keys, records):
+            data.append(key[prefix_len:])
+            data.append(meta_struct.pack(*record[1:]))
+        data = ''.join(data)
+        return data + (self.leaf_size - len(data)) * '\x00'
+
+    def _prefixed_leaf_fits(self, nr, first_key, last_key):
+        """
+        Tells if ``nr`` sorted records from ``first_key`` to ``last_key``
+        fit in prefixed leaf. Leaf holds less than two full leaves of
+        records, so its halves always fit (even without common prefix).
+        """
+        if nr >= 2 * self.node_capacity:
+            return False
+        prefix_len = len(os.path.commonprefix([
+            first_key.ljust(self.key_size, '\x00')[:self.key_size],
+            last_key.ljust(self.key_size, '\x00')[:self.key_size]]))
+        return 2 + prefix_len + nr * (self.single_leaf_record_size -
+                                      prefix_len) <= self.leaf_space
+
+    def _read_block(self, start, size):
+        """
+        Reads ``size`` bytes from ``start`` of bucket file, taken from
+        read ahead data when they are there
+        """
+        ahead_start, ahead = self._ahead
+        pos = start - ahead_start
+        if pos >= 0 and pos + size <= len(ahead):
+            return ahead[pos:pos + size]
+        self.buckets.seek(start)
+        return self.buckets.read(size)
+
+    def _fill_read_ahead(self, leaf_start):
+        """
+        Reads ``read_ahead`` leaves from ``leaf_start`` with single read,
+        unless the leaf is already decoded or read
+        """
+        ahead_start, ahead = self._ahead
+        pos = leaf_start - ahead_start
+        if leaf_start in self._read_leaf.cache or \
+                (pos >= 0 and pos + self.leaf_size <= len(ahead)):
+            return
         self.buckets.seek(leaf_start)
-        data = self.buckets.read(
-            self.elements_counter_size + 2 * self.pointer_size)
-        nr_of_elements, prev_l, next_l = struct.unpack(
-            '<' + self.elements_counter_format + 2 * self.pointer_format,
-            data)
-        return nr_of_elements, prev_l, next_l
+        self._ahead = (leaf_start, self.buckets.read(
+            self.read_ahead * self.leaf_size))
+
+    def _iter_leaf_records(self, leaf_start, key_index):
+        """
+        Yields ``(leaf_start, key_index, record)`` from ``key_index`` of
+        given leaf to the end of leaves linked list. Each leaf is read once
+        as a whole, leaves following each other in bucket file (bulk loaded
+        and compacted trees) are read ahead.
+        """
+        while True:
+            fields = self._read_leaf(leaf_start)[0]
+            nr_of_elements, prev_leaf, next_leaf = fields[:3]
+            for key_index in xrange(key_index, nr_of_elements):
+                pos = 3 + 5 * key_index
+                yield leaf_start, key_index, fields[pos:pos + 5]
+            if not next_leaf:
+                return
+            if next_leaf == leaf_start + self.leaf_size and self.read_ahead > 1:
+                self._fill_read_ahead(next_leaf)
+            leaf_start = next_leaf
+            key_index = 0
+
+    def _scan_leaves(self, leaf_start, key_index, limit, offset, stop=None,
+                     with_cursor=False):
+        """
+        Yields ``(doc_id, key, start, size, status)`` of not deleted
+        records from given position on, skips ``offset`` of them and ends
+        after ``limit`` ones (negative for no limit) or on key for which
+        ``stop`` is true. With ``with_cursor`` yields records together with
+        cursor tokens to resume the scan after them.
+        """
+        if not limit or not leaf_start:
+            return
+        for leaf_start, key_index, record in self._iter_leaf_records(
+                leaf_start, key_index):
+            curr_key, doc_id, start, size, status = record
+            if stop is not None and stop(curr_key):
+                return
+            if status == 'd':
+                continue
+            if offset:
+                offset -= 1
+                continue
+            if with_cursor:
+                yield ((doc_id, curr_key, start, size, status),
+                       encode_cursor('t', self.generation, leaf_start,
+                                     key_index, curr_key, doc_id))
+            else:
+                yield doc_id, curr_key, start, size, status
+            limit -= 1
+            if not limit:
+                return
+
+    def _cursor_position(self, cursor):
+        """
+        Returns leaf and index of record following the one ``cursor`` was
+        made for, ``(0, 0)`` at the end of index. The record is looked for
+        at its position from the cursor (and in the same leaf, records move
+        on inserts), then by its key and doc_id, so cursors survive leaves
+        splits and compaction. If it's gone records with the same key are
+        returned again.
+        """
+        parts = decode_cursor(cursor, 't')
+        if len(parts) != 5:
+            raise IndexException("Invalid cursor")
+        generation, leaf_start, key_index, key, doc_id = parts
+        # leaves are never moved until compaction, except of root leaf
+        if generation == self.generation and \
+                (leaf_start != self.data_start or self.root_flag == 'l'):
+            fields, keys = self._read_leaf(leaf_start)
+            nr_of_elements = fields[0]
+            if key_index < nr_of_elements and keys[key_index] == key and \
+                    fields[4 + 5 * key_index] == doc_id:
+                return leaf_start, key_index + 1
+            for key_index in xrange(bisect_left(keys, key, 0, nr_of_elements),
+                                    nr_of_elements):
+                if keys[key_index] != key:
+                    break
+                if fields[4 + 5 * key_index] == doc_id:
+                    return leaf_start, key_index + 1
+        leaf_start = self._find_leaf_with_first_key_occurence(key)
+        first = found = None
+        while leaf_start:
+            fields, keys = self._read_leaf(leaf_start)
+            for key_index in xrange(bisect_left(keys, key, 0, fields[0]),
+                                    fields[0]):
+                if keys[key_index] != key:
+                    return found or first or (leaf_start, key_index)
+                if first is None:
+                    first = (leaf_start, key_index)
+                if fields[4 + 5 * key_index] == doc_id:
+                    found = (leaf_start, key_index + 1)
+                    if fields[7 + 5 * key_index] != 'd':
+                        return found
+            leaf_start = fields[2]
+        return found or first or (0, 0)
+
+    def _read_leaf_nr_of_elements_and_neighbours(self, leaf_start):
+        return self._read_leaf(leaf_start)[0][:3]
 
     def _read_node_nr_of_elements_and_children_flag(self, start):
-        self.buckets.seek(start)
-        data = self.buckets.read(self.elements_counter_size + self.flag_size)
-        nr_of_elements, children_flag = struct.unpack(
-            '<' + self.elements_counter_format + self.flag_format,
-            data)
-        return nr_of_elements, children_flag
+        return self._read_node(start)[0][:2]
 
     def _read_leaf_nr_of_elements(self, start):
-        self.buckets.seek(start)
-        data = self.buckets.read(self.elements_counter_size)
-        nr_of_elements = struct.unpack(
-            '<' + self.elements_counter_format, data)
-        return nr_of_elements[0]
+        return self._read_leaf(start)[0][0]
 
     def _read_single_node_key(self, node_start, key_index):
-        self.buckets.seek(self._calculate_key_position(
-            node_start, key_index, 'n'))
-        data = self.buckets.read(self.single_node_record_size)
-        flag_left, key, pointer_right = struct.unpack(
-            '<' + self.single_node_record_format, data)
-        return flag_left, key, pointer_right
+        fields, keys, pointers = self._read_node(node_start)
+        return pointers[key_index], keys[key_index], pointers[key_index + 1]
 
     def _read_single_leaf_record(self, leaf_start, key_index):
-        self.buckets.seek(self._calculate_key_position(
-            leaf_start, key_index, 'l'))
-        data = self.buckets.read(self.single_leaf_record_size)
-        key, doc_id, start, size, status = struct.unpack('<' + self.
-                                                         single_leaf_record_format, data)
-        return key, doc_id, start, size, status
+        pos = 3 + 5 * key_index
+        return self._read_leaf(leaf_start)[0][pos:pos + 5]
 
     def _calculate_key_position(self, start, key_index, flag):
         """
@@ -283,75 +757,28 @@ class IU_TreeBasedIndex(Index):
                     curr_key_index = 0
 
     def _update_element(self, leaf_start, key_index, new_data):
+        if self.leaf_prefix:
+            nr, prev_leaf, next_leaf, records = self._read_prefixed_leaf(leaf_start)
+            records[key_index] = (records[key_index][0], ) + tuple(new_data)
+            return self._write_prefixed_leaf(leaf_start, records, prev_leaf, next_leaf)
         self.buckets.seek(self._calculate_key_position(leaf_start, key_index, 'l')
                           + self.key_size)
-        self.buckets.write(struct.pack('<' + self.meta_format,
+        self._write(struct.pack('<' + self.meta_format,
                                        *new_data))
 
 #        self._read_single_leaf_record.delete(leaf_start_position, key_index)
 
     def _delete_element(self, leaf_start, key_index):
+        if self.leaf_prefix:
+            nr, prev_leaf, next_leaf, records = self._read_prefixed_leaf(leaf_start)
+            records[key_index] = records[key_index][:4] + ('d', )
+            return self._write_prefixed_leaf(leaf_start, records, prev_leaf, next_leaf)
         self.buckets.seek(self._calculate_key_position(leaf_start, key_index, 'l')
                           + self.single_leaf_record_size - 1)
-        self.buckets.write(struct.pack('<c', 'd'))
+        self._write(struct.pack('<c', 'd'))
 
 #        self._read_single_leaf_record.delete(leaf_start_position, key_index)
 
-    def _leaf_linear_key_search(self, key, start, start_index, end_index):
-        self.buckets.seek(start)
-        data = self.buckets.read(
-            (end_index - start_index + 1) * self.single_leaf_record_size)
-        curr_key = struct.unpack(
-            '<' + self.key_format, data[:self.key_size])[0]
-        data = data[self.single_leaf_record_size:]
-        curr_index = 0
-        while curr_key != key:
-            curr_index += 1
-            curr_key = struct.unpack(
-                '<' + self.key_format, data[:self.key_size])[0]
-            data = data[self.single_leaf_record_size:]
-        return start_index + curr_index
-
-    def _node_linear_key_search(self, key, start, start_index, end_index):
-        self.buckets.seek(start + self.pointer_size)
-        data = self.buckets.read((end_index - start_index + 1) * (
-            self.key_size + self.pointer_size))
-        curr_key = struct.unpack(
-            '<' + self.key_format, data[:self.key_size])[0]
-        data = data[self.key_size + self.pointer_size:]
-        curr_index = 0
-        while curr_key != key:
-            curr_index += 1
-            curr_key = struct.unpack(
-                '<' + self.key_format, data[:self.key_size])[0]
-            data = data[self.key_size + self.pointer_size:]
-        return start_index + curr_index
-
-    def _next_buffer(self, buffer_start, buffer_end):
-            return buffer_end, buffer_end + tree_buffer_size
-
-    def _prev_buffer(self, buffer_start, buffer_end):
-            return buffer_start - tree_buffer_size, buffer_start
-
-    def _choose_next_candidate_index_in_leaf(self, leaf_start, candidate_start, buffer_start, buffer_end, imin, imax):
-        if buffer_start > candidate_start:
-            move_buffer = MOVE_BUFFER_PREV
-        elif buffer_end < candidate_start + self.single_leaf_record_size:
-            move_buffer = MOVE_BUFFER_NEXT
-        else:
-            move_buffer = None
-        return self._calculate_key_position(leaf_start, (imin + imax) / 2, 'l'), (imin + imax) / 2, move_buffer
-
-    def _choose_next_candidate_index_in_node(self, node_start, candidate_start, buffer_start, buffer_end, imin, imax):
-        if buffer_start > candidate_start:
-            move_buffer = MOVE_BUFFER_PREV
-        elif buffer_end < candidate_start + self.single_node_record_size:
-            (self.pointer_size + self.key_size) - 1
-            move_buffer = MOVE_BUFFER_NEXT
-        else:
-            move_buffer = None
-        return self._calculate_key_position(node_start, (imin + imax) / 2, 'n'), (imin + imax) / 2, move_buffer
-
     def _find_key_in_leaf(self, leaf_start, key, nr_of_elements):
         if nr_of_elements == 1:
             return self._find_key_in_leaf_with_one_element(key, leaf_start)[-5:]
@@ -403,114 +830,35 @@ class IU_TreeBasedIndex(Index):
         """
         Binary search implementation used in all get functions
         """
-        imin, imax = 0, nr_of_elements - 1
-        buffer_start, buffer_end = self._set_buffer_limits()
-        candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_leaf(leaf_start,
-                                                                                                  self._calculate_key_position(leaf_start,
-                                                                                                                               (imin + imax) / 2,
-                                                                                                                               'l'),
-                                                                                                  buffer_start,
-                                                                                                  buffer_end,
-                                                                                                  imin, imax)
-        while imax != imin and imax > imin:
-            curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
-                                                                                                      candidate_index)
-            candidate_start = self._calculate_key_position(
-                leaf_start, candidate_index, 'l')
-            if key < curr_key:
-                if move_buffer == MOVE_BUFFER_PREV:
-                    buffer_start, buffer_end = self._prev_buffer(
-                        buffer_start, buffer_end)
-                else:  # if next chosen element is in current buffer, abort moving to other
-                    move_buffer is None
-                imax = candidate_index - 1
-                candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_leaf(leaf_start,
-                                                                                                          candidate_start,
-                                                                                                          buffer_start,
-                                                                                                          buffer_end,
-                                                                                                          imin, imax)
-            elif key == curr_key:
-                if mode == MODE_LAST:
-                    if move_buffer == MOVE_BUFFER_NEXT:
-                        buffer_start, buffer_end = self._next_buffer(
-                            buffer_start, buffer_end)
-                    else:
-                        move_buffer is None
-                    imin = candidate_index + 1
-                    candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_leaf(leaf_start,
-                                                                                                              candidate_start,
-                                                                                                              buffer_start,
-                                                                                                              buffer_end,
-                                                                                                              imin, imax)
-                else:
-                    if curr_status == 'o':
-                        break
-                    else:
-                        if move_buffer == MOVE_BUFFER_PREV:
-                            buffer_start, buffer_end = self._prev_buffer(
-                                buffer_start, buffer_end)
-                        else:
-                            move_buffer is None
-                        imax = candidate_index
-                        candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_leaf(leaf_start,
-                                                                                                                  candidate_start,
-                                                                                                                  buffer_start,
-                                                                                                                  buffer_end,
-                                                                                                                  imin, imax)
-            else:
-                if move_buffer == MOVE_BUFFER_NEXT:
-                    buffer_start, buffer_end = self._next_buffer(
-                        buffer_start, buffer_end)
-                else:
-                    move_buffer is None
-                imin = candidate_index + 1
-                candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_leaf(leaf_start,
-                                                                                                          candidate_start,
-                                                                                                          buffer_start,
-                                                                                                          buffer_end,
-                                                                                                          imin, imax)
-
-        if imax > imin:
-            chosen_key_position = candidate_index
+        keys = self._read_leaf(leaf_start)[1]
+        if mode == MODE_LAST:
+            key_index = max(bisect_right(keys, key, 0, nr_of_elements) - 1, 0)
         else:
-            chosen_key_position = imax
-        curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
-                                                                                                  chosen_key_position)
-        if key != curr_key:
+            key_index = min(bisect_left(keys, key, 0, nr_of_elements),
+                            nr_of_elements - 1)
+        if key != keys[key_index]:
             if return_closest:  # useful for find all bigger/smaller methods
-                return leaf_start, chosen_key_position
+                return leaf_start, key_index
             else:
                 raise ElemNotFound
-        if doc_id and doc_id == curr_doc_id and curr_status == 'o':
-            return leaf_start, chosen_key_position, curr_doc_id, curr_key, curr_start, curr_size, curr_status
-        else:
-            if mode == MODE_FIRST and imin < chosen_key_position:  # check if there isn't any element with equal key before chosen one
-                matching_record_index = self._leaf_linear_key_search(key,
-                                                                     self._calculate_key_position(leaf_start,
-                                                                                                  imin,
-                                                                                                  'l'),
-                                                                     imin,
-                                                                     chosen_key_position)
-            else:
-                matching_record_index = chosen_key_position
+        curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
+                                                                                                  key_index)
+        if curr_status == 'd' and not return_closest:
+            leaf_start, nr_of_elements, key_index = self._find_existing(key,
+                                                                        key_index,
+                                                                        leaf_start,
+                                                                        nr_of_elements)
             curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
-                                                                                                      matching_record_index)
-            if curr_status == 'd' and not return_closest:
-                leaf_start, nr_of_elements, matching_record_index = self._find_existing(key,
-                                                                                        matching_record_index,
-                                                                                        leaf_start,
-                                                                                        nr_of_elements)
-                curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
-                                                                                                          matching_record_index)
-            if doc_id is not None and doc_id != curr_doc_id:
-                leaf_start, nr_of_elements, matching_record_index = self._match_doc_id(doc_id,
-                                                                                       key,
-                                                                                       matching_record_index,
-                                                                                       leaf_start,
-                                                                                       nr_of_elements)
-                curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
-                                                                                                          matching_record_index)
-            return leaf_start, matching_record_index, curr_doc_id, curr_key, curr_start, curr_size, curr_status
+                                                                                                      key_index)
+        if doc_id is not None and doc_id != curr_doc_id:
+            leaf_start, nr_of_elements, key_index = self._match_doc_id(doc_id,
+                                                                       key,
+                                                                       key_index,
+                                                                       leaf_start,
+                                                                       nr_of_elements)
+            curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
+                                                                                                      key_index)
+        return leaf_start, key_index, curr_doc_id, curr_key, curr_start, curr_size, curr_status
 
     def _find_place_in_leaf(self, key, leaf_start, nr_of_elements):
         if nr_of_elements == 1:
@@ -533,48 +881,9 @@ class IU_TreeBasedIndex(Index):
         """
         Binary search implementation used in insert function
         """
-        imin, imax = 0, nr_of_elements - 1
-        buffer_start, buffer_end = self._set_buffer_limits()
-        candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_leaf(leaf_start,
-                                                                                                  self._calculate_key_position(leaf_start,
-                                                                                                                               (imin + imax) / 2,
-                                                                                                                               'l'),
-                                                                                                  buffer_start,
-                                                                                                  buffer_end,
-                                                                                                  imin, imax)
-        while imax != imin and imax > imin:
-            curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
-                                                                                                      candidate_index)
-            candidate_start = self._calculate_key_position(
-                leaf_start, candidate_index, 'l')
-            if key < curr_key:
-                if move_buffer == MOVE_BUFFER_PREV:
-                    buffer_start, buffer_end = self._prev_buffer(
-                        buffer_start, buffer_end)
-                else:  # if next chosen element is in current buffer, abort moving to other
-                    move_buffer is None
-                imax = candidate_index - 1
-                candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_leaf(leaf_start,
-                                                                                                          candidate_start,
-                                                                                                          buffer_start,
-                                                                                                          buffer_end,
-                                                                                                          imin, imax)
-            else:
-                if move_buffer == MOVE_BUFFER_NEXT:
-                    buffer_start, buffer_end = self._next_buffer(
-                        buffer_start, buffer_end)
-                else:
-                    move_buffer is None
-                imin = candidate_index + 1
-                candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_leaf(leaf_start,
-                                                                                                          candidate_start,
-                                                                                                          buffer_start,
-                                                                                                          buffer_end,
-                                                                                                          imin, imax)
-        if imax < imin and imin < nr_of_elements:
-            chosen_key_position = imin
-        else:
-            chosen_key_position = imax
+        keys = self._read_leaf(leaf_start)[1]
+        chosen_key_position = min(bisect_right(keys, key, 0, nr_of_elements),
+                                  nr_of_elements - 1)
         curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_start,
                                                                                                   chosen_key_position)
         if curr_status == 'd':
@@ -600,11 +909,6 @@ class IU_TreeBasedIndex(Index):
             else:
                 return leaf_start, chosen_key_position + 1, nr_of_elements - chosen_key_position - 1, (nr_of_elements == self.node_capacity), False
 
-    def _set_buffer_limits(self):
-        pos = self.buckets.tell()
-        buffer_start = pos - (pos % tree_buffer_size)
-        return buffer_start, (buffer_start + tree_buffer_size)
-
     def _find_first_key_occurence_in_node(self, node_start, key, nr_of_elements):
         if nr_of_elements == 1:
             return self._find_key_in_node_with_one_element(key, node_start, mode=MODE_FIRST)
@@ -633,98 +937,24 @@ class IU_TreeBasedIndex(Index):
                 raise Exception('Invalid mode declared: set first/last')
 
     def _find_key_in_node_using_binary_search(self, key, node_start, nr_of_elements, mode=None):
-        imin, imax = 0, nr_of_elements - 1
-        buffer_start, buffer_end = self._set_buffer_limits()
-        candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_node(node_start,
-                                                                                                  self._calculate_key_position(node_start,
-                                                                                                                               (imin + imax) / 2,
-                                                                                                                               'n'),
-                                                                                                  buffer_start,
-                                                                                                  buffer_end,
-                                                                                                  imin, imax)
-        while imax != imin and imax > imin:
-            l_pointer, curr_key, r_pointer = self._read_single_node_key(
-                node_start, candidate_index)
-            candidate_start = self._calculate_key_position(
-                node_start, candidate_index, 'n')
-            if key < curr_key:
-                if move_buffer == MOVE_BUFFER_PREV:
-                    buffer_start, buffer_end = self._prev_buffer(
-                        buffer_start, buffer_end)
-                else:  # if next chosen element is in current buffer, abort moving to other
-                    move_buffer is None
-                imax = candidate_index - 1
-                candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_node(node_start,
-                                                                                                          candidate_start,
-                                                                                                          buffer_start,
-                                                                                                          buffer_end,
-                                                                                                          imin, imax)
-            elif key == curr_key:
-                if mode == MODE_LAST:
-                    if move_buffer == MOVE_BUFFER_NEXT:
-                        buffer_start, buffer_end = self._next_buffer(
-                            buffer_start, buffer_end)
-                    else:
-                        move_buffer is None
-                    imin = candidate_index + 1
-                    candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_node(node_start,
-                                                                                                              candidate_start,
-                                                                                                              buffer_start,
-                                                                                                              buffer_end,
-                                                                                                              imin, imax)
-                else:
-                    break
-            else:
-                if move_buffer == MOVE_BUFFER_NEXT:
-                        buffer_start, buffer_end = self._next_buffer(
-                            buffer_start, buffer_end)
-                else:
-                    move_buffer is None
-                imin = candidate_index + 1
-                candidate_start, candidate_index, move_buffer = self._choose_next_candidate_index_in_node(node_start,
-                                                                                                          candidate_start,
-                                                                                                          buffer_start,
-                                                                                                          buffer_end,
-                                                                                                          imin, imax)
-
-        if imax > imin:
-            chosen_key_position = candidate_index
-        elif imax < imin and imin < nr_of_elements:
-            chosen_key_position = imin
-        else:
-            chosen_key_position = imax
-        l_pointer, curr_key, r_pointer = self._read_single_node_key(
-            node_start, chosen_key_position)
-        if mode == MODE_FIRST and imin < chosen_key_position:  # check if there is no elements with equal key before chosen one
-            matching_record_index = self._node_linear_key_search(key,
-                                                                 self._calculate_key_position(node_start,
-                                                                                              imin,
-                                                                                              'n'),
-                                                                 imin,
-                                                                 chosen_key_position)
+        fields, keys, pointers = self._read_node(node_start)
+        if mode == MODE_FIRST:
+            key_index = bisect_left(keys, key, 0, nr_of_elements)
+        elif mode == MODE_LAST:
+            key_index = bisect_right(keys, key, 0, nr_of_elements)
         else:
-            matching_record_index = chosen_key_position
-        l_pointer, curr_key, r_pointer = self._read_single_node_key(
-            node_start, matching_record_index)
-        if key < curr_key:
-            return matching_record_index, l_pointer
-        elif key > curr_key:
-            return matching_record_index, r_pointer
-        else:
-            if mode == MODE_FIRST:
-                return matching_record_index, l_pointer
-            elif mode == MODE_LAST:
-                return matching_record_index, r_pointer
-            else:
-                raise Exception('Invalid mode declared: first/last')
+            raise Exception('Invalid mode declared: first/last')
+        if key_index == nr_of_elements:  # right pointer of last key
+            return key_index - 1, pointers[key_index]
+        return key_index, pointers[key_index]
 
     def _update_leaf_ready_data(self, leaf_start, start_index, new_nr_of_elements, records_to_rewrite):
         self.buckets.seek(leaf_start)
-        self.buckets.write(struct.pack('<h', new_nr_of_elements))
+        self._write(struct.pack('<h', new_nr_of_elements))
         start_position = self._calculate_key_position(
             leaf_start, start_index, 'l')
         self.buckets.seek(start_position)
-        self.buckets.write(
+        self._write(
             struct.pack(
                 '<' + (new_nr_of_elements - start_index) *
                 self.single_leaf_record_format,
@@ -740,7 +970,7 @@ class IU_TreeBasedIndex(Index):
         if nr_of_records_to_rewrite == 0:  # just write at set position
             self.buckets.seek(self._calculate_key_position(
                 leaf_start, new_record_position, 'l'))
-            self.buckets.write(
+            self._write(
                 struct.pack('<' + self.single_leaf_record_format,
                             new_key,
                             new_doc_id,
@@ -767,7 +997,7 @@ class IU_TreeBasedIndex(Index):
                     curr_index += 1
 
             self.buckets.seek(start)
-            self.buckets.write(
+            self._write(
                 struct.pack(
                     '<' + (nr_of_records_to_rewrite +
                            1) * self.single_leaf_record_format,
@@ -780,7 +1010,7 @@ class IU_TreeBasedIndex(Index):
             self.flush()
         self.buckets.seek(leaf_start)
         if not on_deleted:  # when new record replaced deleted one, nr of leaf elements stays the same
-            self.buckets.write(struct.pack('<h', nr_of_elements + 1))
+            self._write(struct.pack('<h', nr_of_elements + 1))
 
         self._read_leaf_nr_of_elements.delete(leaf_start)
         self._read_leaf_nr_of_elements_and_neighbours.delete(leaf_start)
@@ -788,15 +1018,11 @@ class IU_TreeBasedIndex(Index):
 #        self._read_single_leaf_record.delete(leaf_start)
 
     def _read_leaf_neighbours(self, leaf_start):
-        self.buckets.seek(leaf_start + self.elements_counter_size)
-        neihbours_data = self.buckets.read(2 * self.pointer_size)
-        prev_l, next_l = struct.unpack(
-            '<' + 2 * self.pointer_format, neihbours_data)
-        return prev_l, next_l
+        return self._read_leaf(leaf_start)[0][1:3]
 
     def _update_leaf_size_and_pointers(self, leaf_start, new_size, new_prev, new_next):
         self.buckets.seek(leaf_start)
-        self.buckets.write(
+        self._write(
             struct.pack(
                 '<' + self.elements_counter_format + 2 * self.pointer_format,
                 new_size,
@@ -809,7 +1035,7 @@ class IU_TreeBasedIndex(Index):
 
     def _update_leaf_prev_pointer(self, leaf_start, pointer):
         self.buckets.seek(leaf_start + self.elements_counter_size)
-        self.buckets.write(struct.pack('<' + self.pointer_format,
+        self._write(struct.pack('<' + self.pointer_format,
                                        pointer))
 
         self._read_leaf_neighbours.delete(leaf_start)
@@ -817,15 +1043,15 @@ class IU_TreeBasedIndex(Index):
 
     def _update_size(self, start, new_size):
         self.buckets.seek(start)
-        self.buckets.write(struct.pack('<' + self.elements_counter_format,
+        self._write(struct.pack('<' + self.elements_counter_format,
                                        new_size))
 
         self._read_leaf_nr_of_elements.delete(start)
         self._read_leaf_nr_of_elements_and_neighbours.delete(start)
 
     def _create_new_root_from_leaf(self, leaf_start, nr_of_records_to_rewrite, new_leaf_size, old_leaf_size, half_size, new_data):
-        blanks = (self.node_capacity - new_leaf_size) * \
-            self.single_leaf_record_size * '\x00'
+        blanks = ((self.node_capacity - new_leaf_size) *
+                  self.single_leaf_record_size + self.leaf_padding) * '\x00'
         left_leaf_start_position = self.data_start + self.node_size
         right_leaf_start_position = self.data_start + \
             self.node_size + self.leaf_size
@@ -909,13 +1135,15 @@ class IU_TreeBasedIndex(Index):
                 new_data[3],
                 new_data[4],
                 *records_after)
-        left_leaf_data += (self.node_capacity -
-                           old_leaf_size) * self.single_leaf_record_size * '\x00'
+        left_leaf_data += ((self.node_capacity - old_leaf_size) *
+                           self.single_leaf_record_size + self.leaf_padding) * '\x00'
         right_leaf_data += blanks
         data_to_write += left_leaf_data
         data_to_write += right_leaf_data
         self.buckets.seek(self._start_ind)
-        self.buckets.write(struct.pack('<c', 'n') + data_to_write)
+        self._write(struct.pack('<c', 'n'))
+        self.buckets.seek(self.data_start)
+        self._write(data_to_write)
         self.root_flag = 'n'
 
 #            self._read_single_leaf_record.delete(leaf_start)
@@ -942,8 +1170,8 @@ class IU_TreeBasedIndex(Index):
             new_data = [new_key, new_doc_id, new_start, new_size, new_status]
             self._create_new_root_from_leaf(leaf_start, nr_of_records_to_rewrite, new_leaf_size, old_leaf_size, half_size, new_data)
         else:
-            blanks = (self.node_capacity - new_leaf_size) * \
-                self.single_leaf_record_size * '\x00'
+            blanks = ((self.node_capacity - new_leaf_size) *
+                      self.single_leaf_record_size + self.leaf_padding) * '\x00'
             prev_l, next_l = self._read_leaf_neighbours(leaf_start)
             if nr_of_records_to_rewrite > half_size:  # insert key into first half of leaf
                 self.buckets.seek(self._calculate_key_position(leaf_start,
@@ -976,7 +1204,7 @@ class IU_TreeBasedIndex(Index):
                                        *records_to_rewrite[-new_leaf_size * 5:])
                 new_leaf += blanks
                 # write new leaf
-                self.buckets.write(new_leaf)
+                self._write(new_leaf)
                 # update old leaf heading
                 self._update_leaf_size_and_pointers(leaf_start,
                                                     old_leaf_size,
@@ -987,7 +1215,7 @@ class IU_TreeBasedIndex(Index):
                                                                self.node_capacity - nr_of_records_to_rewrite,
                                                                'l'))
                 # write new key and keys after
-                self.buckets.write(
+                self._write(
                     struct.pack(
                         '<' + self.single_leaf_record_format *
                         (nr_of_records_to_rewrite - new_leaf_size + 1),
@@ -1053,7 +1281,7 @@ class IU_TreeBasedIndex(Index):
                     'o',
                     *records_after)
                 new_leaf += blanks
-                self.buckets.write(new_leaf)
+                self._write(new_leaf)
                 self._update_leaf_size_and_pointers(leaf_start,
                                                     old_leaf_size,
                                                     prev_l,
@@ -1107,8 +1335,8 @@ class IU_TreeBasedIndex(Index):
             left_pointer,
             root_key,
             right_pointer)
-        new_root += (self.key_size + self.pointer_size) * (self.
-                                                           node_capacity - 1) * '\x00'
+        new_root += ((self.key_size + self.pointer_size) *
+                     (self.node_capacity - 1) + self.node_padding) * '\x00'
         return new_root
 
     def _create_new_root_from_node(self, node_start, children_flag, nr_of_keys_to_rewrite, new_node_size, old_node_size, new_key, new_pointer):
@@ -1199,17 +1427,16 @@ class IU_TreeBasedIndex(Index):
             new_root = self._prepare_new_root_data(key_moved_to_root,
                                                    new_node_start,
                                                    new_node_start + self.node_size)
-            left_node += (self.node_capacity - old_node_size) * \
-                (self.key_size + self.pointer_size) * '\x00'
+            left_node += ((self.node_capacity - old_node_size) *
+                          (self.key_size + self.pointer_size) + self.node_padding) * '\x00'
             # adding blanks after new node
-            right_node += (self.node_capacity - new_node_size) * \
-                (self.key_size + self.pointer_size) * '\x00'
+            right_node += ((self.node_capacity - new_node_size) *
+                           (self.key_size + self.pointer_size) + self.node_padding) * '\x00'
             self.buckets.seek(0, 2)
-            self.buckets.write(left_node + right_node)
+            self._write(left_node + right_node)
             self.buckets.seek(self.data_start)
-            self.buckets.write(new_root)
+            self._write(new_root)
 
-            self._read_single_node_key.delete(node_start)
             self._read_node_nr_of_elements_and_children_flag.delete(node_start)
             return None
 
@@ -1227,8 +1454,8 @@ class IU_TreeBasedIndex(Index):
         if create_new_root:
             self._create_new_root_from_node(node_start, children_flag, nr_of_keys_to_rewrite, new_node_size, old_node_size, new_key, new_pointer)
         else:
-            blanks = (self.node_capacity - new_node_size) * (
-                self.key_size + self.pointer_size) * '\x00'
+            blanks = ((self.node_capacity - new_node_size) *
+                      (self.key_size + self.pointer_size) + self.node_padding) * '\x00'
             if nr_of_keys_to_rewrite == new_node_size:  # insert key into first half of node
                 # reading second half of node
                 self.buckets.seek(self._calculate_key_position(node_start,
@@ -1252,12 +1479,11 @@ class IU_TreeBasedIndex(Index):
                                        *old_node_data)
                 new_node += blanks
                 # write new node
-                self.buckets.write(new_node)
+                self._write(new_node)
                 # update old node data
                 self._update_size(
                     node_start, old_node_size)
 
-                self._read_single_node_key.delete(node_start)
                 self._read_node_nr_of_elements_and_children_flag.delete(
                     node_start)
 
@@ -1285,14 +1511,14 @@ class IU_TreeBasedIndex(Index):
                                        *old_node_data[-new_node_size * 2:])
                 new_node += blanks
                 # write new node
-                self.buckets.write(new_node)
+                self._write(new_node)
                 self._update_size(
                     node_start, old_node_size)
                 # seek position of new key in first half
                 self.buckets.seek(self._calculate_key_position(node_start, self.node_capacity - nr_of_keys_to_rewrite, 'n')
                                   + self.pointer_size)
                 # write new key and keys after
-                self.buckets.write(
+                self._write(
                     struct.pack(
                         '<' + (self.key_format + self.pointer_format) *
                         (nr_of_keys_to_rewrite - new_node_size),
@@ -1300,7 +1526,6 @@ class IU_TreeBasedIndex(Index):
                         new_pointer,
                         *old_node_data[:-(new_node_size + 1) * 2]))
 
-                self._read_single_node_key.delete(node_start)
                 self._read_node_nr_of_elements_and_children_flag.delete(
                     node_start)
 
@@ -1344,10 +1569,9 @@ class IU_TreeBasedIndex(Index):
                                         *keys_after)
                 new_node += blanks
                 # write new node
-                self.buckets.write(new_node)
+                self._write(new_node)
                 self._update_size(node_start, old_node_size)
 
-                self._read_single_node_key.delete(node_start)
                 self._read_node_nr_of_elements_and_children_flag.delete(
                     node_start)
 
@@ -1355,10 +1579,10 @@ class IU_TreeBasedIndex(Index):
 
     def insert_first_record_into_leaf(self, leaf_start, key, doc_id, start, size, status):
         self.buckets.seek(leaf_start)
-        self.buckets.write(struct.pack('<' + self.elements_counter_format,
+        self._write(struct.pack('<' + self.elements_counter_format,
                                        1))
         self.buckets.seek(leaf_start + self.leaf_heading_size)
-        self.buckets.write(struct.pack('<' + self.single_leaf_record_format,
+        self._write(struct.pack('<' + self.single_leaf_record_format,
                                        key,
                                        doc_id,
                                        start,
@@ -1371,6 +1595,9 @@ class IU_TreeBasedIndex(Index):
         self._read_leaf_nr_of_elements_and_neighbours.delete(leaf_start)
 
     def _insert_new_record_into_leaf(self, leaf_start, key, doc_id, start, size, status, nodes_stack, indexes):
+        if self.leaf_prefix:
+            return self._insert_into_prefixed_leaf(
+                leaf_start, key, doc_id, start, size, status, nodes_stack, indexes)
         nr_of_elements = self._read_leaf_nr_of_elements(leaf_start)
         if nr_of_elements == 0:
             self.insert_first_record_into_leaf(
@@ -1405,10 +1632,77 @@ class IU_TreeBasedIndex(Index):
                 leaf_start, new_record_position, nr_of_elements, nr_of_records_to_rewrite,
                 on_deleted, key, doc_id, start, size, status)
 
+    def _read_prefixed_leaf(self, leaf_start):
+        """
+        Returns number of elements, neighbours and list of records of
+        prefixed leaf
+        """
+        fields = self._read_leaf(leaf_start)[0]
+        nr, prev_leaf, next_leaf = fields[:3]
+        records = [fields[pos:pos + 5] for pos in xrange(3, 3 + 5 * nr, 5)]
+        return nr, prev_leaf, next_leaf, records
+
+    def _write_prefixed_leaf(self, leaf_start, records, prev_leaf, next_leaf):
+        self.buckets.seek(leaf_start)
+        self._write(self._encode_prefixed_leaf(records, prev_leaf, next_leaf))
+        self._prefixed_leaf_changed(leaf_start)
+
+    def _prefixed_leaf_changed(self, leaf_start):
+        # records of rewritten leaf can move
+        self._match_doc_id.clear()
+        self._find_key_in_leaf.delete(leaf_start)
+        self._read_leaf_nr_of_elements.delete(leaf_start)
+        self._read_leaf_neighbours.delete(leaf_start)
+        self._read_leaf_nr_of_elements_and_neighbours.delete(leaf_start)
+
+    def _insert_into_prefixed_leaf(self, leaf_start, key, doc_id, start, size, status, nodes_stack, indexes):
+        """
+        Rewrites prefixed leaf with new record, deleted records are dropped
+        when it doesn't fit, then it's split in halves
+        """
+        nr, prev_leaf, next_leaf, records = self._read_prefixed_leaf(leaf_start)
+        key = key.ljust(self.key_size, '\x00')[:self.key_size]
+        position = bisect_right([record[0] for record in records], key)
+        records.insert(position, (key, doc_id, start, size, status))
+        if not self._prefixed_leaf_fits(len(records), records[0][0], records[-1][0]):
+            records = [record for record in records if record[4] != 'd']
+        if self._prefixed_leaf_fits(len(records), records[0][0], records[-1][0]):
+            self._write_prefixed_leaf(leaf_start, records, prev_leaf, next_leaf)
+            self.flush()
+            return
+        half = len(records) // 2
+        left, right = records[:half], records[half:]
+        if not nodes_stack:  # leaf is a root
+            left_start = self.data_start + self.node_size
+            right_start = left_start + self.leaf_size
+            self.buckets.seek(self._start_ind)
+            self._write(struct.pack('<c', 'n'))
+            self.buckets.seek(self.data_start)
+            self._write(self._prepare_new_root_data(right[0][0], left_start,
+                                                    right_start, 'l') +
+                        self._encode_prefixed_leaf(left, 0, right_start) +
+                        self._encode_prefixed_leaf(right, left_start, 0))
+            self.root_flag = 'n'
+            self._clear_cache()
+        else:
+            self.buckets.seek(0, 2)
+            new_leaf_start = self.buckets.tell()
+            self._write(self._encode_prefixed_leaf(right, leaf_start, next_leaf))
+            self._write_prefixed_leaf(leaf_start, left, prev_leaf, new_leaf_start)
+            if next_leaf:
+                self._update_leaf_prev_pointer(next_leaf, new_leaf_start)
+            self._insert_new_key_into_node(nodes_stack.pop(),
+                                           right[0][0],
+                                           leaf_start,
+                                           new_leaf_start,
+                                           nodes_stack,
+                                           indexes)
+        self.flush()
+
     def _update_node(self, new_key_position, nr_of_keys_to_rewrite, new_key, new_pointer):
         if nr_of_keys_to_rewrite == 0:
             self.buckets.seek(new_key_position)
-            self.buckets.write(
+            self._write(
                 struct.pack('<' + self.key_format + self.pointer_format,
                             new_key,
                             new_pointer))
@@ -1420,7 +1714,7 @@ class IU_TreeBasedIndex(Index):
             keys_to_rewrite = struct.unpack(
                 '<' + nr_of_keys_to_rewrite * (self.key_format + self.pointer_format), data)
             self.buckets.seek(new_key_position)
-            self.buckets.write(
+            self._write(
                 struct.pack(
                     '<' + (nr_of_keys_to_rewrite + 1) *
                     (self.key_format + self.pointer_format),
@@ -1471,7 +1765,6 @@ class IU_TreeBasedIndex(Index):
 
             self._find_first_key_occurence_in_node.delete(node_start)
             self._find_last_key_occurence_in_node.delete(node_start)
-            self._read_single_node_key.delete(node_start)
             self._read_node_nr_of_elements_and_children_flag.delete(node_start)
 
     def _find_leaf_to_insert(self, key):
@@ -1565,14 +1858,16 @@ class IU_TreeBasedIndex(Index):
 
     def update(self, doc_id, key, u_start=0, u_size=0, u_status='o'):
         containing_leaf_start, element_index, old_doc_id, old_key, old_start, old_size, old_status = self._find_key_to_update(key, doc_id)
-        new_data = (old_doc_id, old_start, old_size, old_status)
-        if not u_start:
+        new_data = [old_doc_id, old_start, old_size, old_status]
+        if u_start:
             new_data[1] = u_start
-        if not u_size:
+        if u_size:
             new_data[2] = u_size
-        if not u_status:
+        if u_status:
             new_data[3] = u_status
         self._update_element(containing_leaf_start, element_index, new_data)
+        if new_data[3] == 'd' or new_data[1:3] != [old_start, old_size]:
+            self._free_value(old_start, old_size, old_status)
 
         self._find_key.delete(key)
         self._match_doc_id.delete(doc_id)
@@ -1580,61 +1875,34 @@ class IU_TreeBasedIndex(Index):
         return True
 
     def delete(self, doc_id, key, start=0, size=0):
-        containing_leaf_start, element_index = self._find_key_to_update(
-            key, doc_id)[:2]
+        containing_leaf_start, element_index, old_doc_id, old_key, old_start, old_size, old_status = self._find_key_to_update(key, doc_id)
         self._delete_element(containing_leaf_start, element_index)
+        self._free_value(old_start, old_size, old_status)
 
         self._find_key.delete(key)
         self._match_doc_id.delete(doc_id)
         self._find_key_in_leaf.delete(containing_leaf_start, key)
         return True
 
-    def _find_key_many(self, key, limit=1, offset=0):
-        leaf_with_key = self._find_leaf_with_first_key_occurence(key)
-        nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
-        try:
-            leaf_with_key, key_index = self._find_index_of_first_key_equal(
-                key, leaf_with_key, nr_of_elements)
-            nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
-        except ElemNotFound:
-            leaf_with_key = next_leaf
-            key_index = 0
+    def _find_key_many(self, key, limit=1, offset=0, cursor=None):
+        if cursor:
+            leaf_with_key, key_index = self._cursor_position(cursor)
+        else:
+            leaf_with_key = self._find_leaf_with_first_key_occurence(key)
             nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
-        while offset:
-            if key_index < nr_of_elements:
-                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
-                    leaf_with_key, key_index)
-                if key == curr_key:
-                    if status != 'd':
-                        offset -= 1
-                    key_index += 1
-                else:
-                    return
-            else:
+            try:
+                leaf_with_key, key_index = self._find_index_of_first_key_equal(
+                    key, leaf_with_key, nr_of_elements)
+            except ElemNotFound:
+                leaf_with_key = next_leaf
                 key_index = 0
-                if next_leaf:
-                    leaf_with_key = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
-        while limit:
-            if key_index < nr_of_elements:
-                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
-                    leaf_with_key, key_index)
-                if key == curr_key:
-                    if status != 'd':
-                        yield doc_id, start, size, status
-                        limit -= 1
-                    key_index += 1
-                else:
-                    return
+        for record in self._scan_leaves(
+                leaf_with_key, key_index, limit, offset,
+                lambda curr_key: curr_key != key, cursor is not None):
+            if cursor is None:
+                yield record[:1] + record[2:]
             else:
-                key_index = 0
-                if next_leaf:
-                    leaf_with_key = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
+                yield record[0][:1] + record[0][2:], record[1]
 
     def _find_key_smaller(self, key, limit=1, offset=0):
         leaf_with_key = self._find_leaf_with_first_key_occurence(key)
@@ -1717,90 +1985,44 @@ class IU_TreeBasedIndex(Index):
                 else:
                     return
 
-    def _find_key_bigger(self, key, limit=1, offset=0):
-        leaf_with_key = self._find_leaf_with_last_key_occurence(key)
-        nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
-        try:
-            leaf_with_key, key_index = self._find_index_of_last_key_equal_or_smaller_key(key, leaf_with_key, nr_of_elements)
+    def _find_key_bigger(self, key, limit=1, offset=0, cursor=None):
+        if cursor:
+            leaf_with_key, key_index = self._cursor_position(cursor)
+        else:
+            leaf_with_key = self._find_leaf_with_last_key_occurence(key)
             nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
-        except ElemNotFound:
-            key_index = 0
-        curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
-        if curr_key <= key:
-            key_index += 1
-        while offset:
-            if key_index < nr_of_elements:
-                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
-                    leaf_with_key, key_index)
-                if status != 'd':
-                    offset -= 1
-                key_index += 1
-            else:
+            try:
+                leaf_with_key, key_index = self._find_index_of_last_key_equal_or_smaller_key(key, leaf_with_key, nr_of_elements)
+            except ElemNotFound:
                 key_index = 0
-                if next_leaf:
-                    leaf_with_key = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
-        while limit:
-            if key_index < nr_of_elements:
-                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
-                    leaf_with_key, key_index)
-                if status != 'd':
-                    yield doc_id, curr_key, start, size, status
-                    limit -= 1
+            curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
+            if curr_key <= key:
                 key_index += 1
-            else:
-                key_index = 0
-                if next_leaf:
-                    leaf_with_key = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
+        for record in self._scan_leaves(leaf_with_key, key_index, limit, offset,
+                                        with_cursor=cursor is not None):
+            yield record
 
-    def _find_key_equal_and_bigger(self, key, limit=1, offset=0):
-        leaf_with_key = self._find_leaf_with_first_key_occurence(key)
-        nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
-        leaf_with_key, key_index = self._find_index_of_first_key_equal_or_smaller_key(key, leaf_with_key, nr_of_elements)
-        nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
-        curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
-        if curr_key < key:
-            key_index += 1
-        while offset:
-            if key_index < nr_of_elements:
-                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
-                    leaf_with_key, key_index)
-                if status != 'd':
-                    offset -= 1
-                key_index += 1
-            else:
-                key_index = 0
-                if next_leaf:
-                    leaf_with_key = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
-        while limit:
-            if key_index < nr_of_elements:
-                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
-                    leaf_with_key, key_index)
-                if status != 'd':
-                    yield doc_id, curr_key, start, size, status
-                    limit -= 1
+    def _find_key_equal_and_bigger(self, key, limit=1, offset=0, cursor=None):
+        if cursor:
+            leaf_with_key, key_index = self._cursor_position(cursor)
+        else:
+            leaf_with_key = self._find_leaf_with_first_key_occurence(key)
+            nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
+            leaf_with_key, key_index = self._find_index_of_first_key_equal_or_smaller_key(key, leaf_with_key, nr_of_elements)
+            curr_key = self._read_single_leaf_record(leaf_with_key, key_index)[0]
+            if curr_key < key:
                 key_index += 1
-            else:
-                key_index = 0
-                if next_leaf:
-                    leaf_with_key = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
+        for record in self._scan_leaves(leaf_with_key, key_index, limit, offset,
+                                        with_cursor=cursor is not None):
+            yield record
 
-    def _find_key_between(self, start, end, limit, offset, inclusive_start, inclusive_end):
+    def _find_key_between(self, start, end, limit, offset, inclusive_start, inclusive_end, cursor=None):
         """
         Returns generator containing all keys withing given interval.
         """
-        if inclusive_start:
+        if cursor:
+            leaf_with_key, key_index = self._cursor_position(cursor)
+        elif inclusive_start:
             leaf_with_key = self._find_leaf_with_first_key_occurence(start)
             nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_with_key)
             leaf_with_key, key_index = self._find_index_of_first_key_equal_or_smaller_key(start, leaf_with_key, nr_of_elements)
@@ -1816,43 +2038,29 @@ class IU_TreeBasedIndex(Index):
             curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_with_key, key_index)
             if curr_key <= start:
                 key_index += 1
-        while offset:
-            if key_index < nr_of_elements:
-                curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_with_key, key_index)
-                if curr_status != 'd':
-                    offset -= 1
-                key_index += 1
-            else:
-                key_index = 0
-                if next_leaf:
-                    leaf_with_key = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
-        while limit:
-            if key_index < nr_of_elements:
-                curr_key, curr_doc_id, curr_start, curr_size, curr_status = self._read_single_leaf_record(leaf_with_key, key_index)
-                if curr_key > end or (curr_key == end and not inclusive_end):
-                    return
-                elif curr_status != 'd':
-                    yield curr_doc_id, curr_key, curr_start, curr_size, curr_status
-                    limit -= 1
-                key_index += 1
-            else:
-                key_index = 0
-                if next_leaf:
-                    leaf_with_key = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
+        if inclusive_end:
+            stop = lambda curr_key: curr_key > end
+        else:
+            stop = lambda curr_key: curr_key >= end
+        for record in self._scan_leaves(leaf_with_key, key_index, limit, offset,
+                                        stop, cursor is not None):
+            yield record
 
     def get(self, key):
-        return self._find_key(self.make_key(key))
-
-    def get_many(self, key, limit=1, offset=0):
-        return self._find_key_many(self.make_key(key), limit, offset)
-
-    def get_between(self, start, end, limit=1, offset=0, inclusive_start=True, inclusive_end=True):
+        key = self.make_key(key)
+        if self._bloom_miss(key):
+            raise ElemNotFound
+        return self._find_key(key)
+
+    def get_many(self, key, limit=1, offset=0, cursor=None):
+        key = self.make_key(key)
+        if self._bloom_miss(key):
+            return iter(())
+        return self._find_key_many(key, limit, offset, cursor)
+
+    def get_between(self, start, end, limit=1, offset=0, inclusive_start=True, inclusive_end=True, cursor=None):
+        if start is None and cursor is not None:
+            raise IndexException("Cursors work only in ascending scans")
         if start is None:
             end = self.make_key(end)
             if inclusive_end:
@@ -1862,53 +2070,28 @@ class IU_TreeBasedIndex(Index):
         elif end is None:
             start = self.make_key(start)
             if inclusive_start:
-                return self._find_key_equal_and_bigger(start, limit, offset)
+                return self._find_key_equal_and_bigger(start, limit, offset, cursor)
             else:
-                return self._find_key_bigger(start, limit, offset)
+                return self._find_key_bigger(start, limit, offset, cursor)
         else:
             start = self.make_key(start)
             end = self.make_key(end)
-            return self._find_key_between(start, end, limit, offset, inclusive_start, inclusive_end)
+            return self._find_key_between(start, end, limit, offset, inclusive_start, inclusive_end, cursor)
 
-    def all(self, limit=-1, offset=0):
+    def all(self, limit=-1, offset=0, cursor=None):
         """
         Traverses linked list of all tree leaves and returns generator containing all elements stored in index.
+        With ``cursor`` (token of last returned element or ``''`` to start) yields elements with their tokens.
         """
-        if self.root_flag == 'n':
-            leaf_start = self.data_start + self.node_size
+        if cursor:
+            leaf_start, key_index = self._cursor_position(cursor)
+        elif self.root_flag == 'n':
+            leaf_start, key_index = self.data_start + self.node_size, 0
         else:
-            leaf_start = self.data_start
-        nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(leaf_start)
-        key_index = 0
-        while offset:
-            if key_index < nr_of_elements:
-                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
-                    leaf_start, key_index)
-                if status != 'd':
-                    offset -= 1
-                key_index += 1
-            else:
-                key_index = 0
-                if next_leaf:
-                    leaf_start = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
-        while limit:
-            if key_index < nr_of_elements:
-                curr_key, doc_id, start, size, status = self._read_single_leaf_record(
-                    leaf_start, key_index)
-                if status != 'd':
-                    yield doc_id, curr_key, start, size, status
-                    limit -= 1
-                key_index += 1
-            else:
-                key_index = 0
-                if next_leaf:
-                    leaf_start = next_leaf
-                    nr_of_elements, prev_leaf, next_leaf = self._read_leaf_nr_of_elements_and_neighbours(next_leaf)
-                else:
-                    return
+            leaf_start, key_index = self.data_start, 0
+        for record in self._scan_leaves(leaf_start, key_index, limit, offset,
+                                        with_cursor=cursor is not None):
+            yield record
 
     def make_key(self, key):
         raise NotImplementedError()
@@ -1919,52 +2102,92 @@ class IU_TreeBasedIndex(Index):
     def _open_storage(self):
         s = globals()[self.storage_class]
         if not self.storage:
-            self.storage = s(self.db_path, self.name)
+            self.storage = s(self.db_path, self.name, use_mmap=self.use_mmap,
+                               page_cache=self.page_cache,
+                               compression=self.compression,
+                               positional_files=self.positional_files)
         self.storage.open()
 
     def _create_storage(self):
         s = globals()[self.storage_class]
         if not self.storage:
-            self.storage = s(self.db_path, self.name)
+            self.storage = s(self.db_path, self.name, use_mmap=self.use_mmap,
+                               page_cache=self.page_cache,
+                               compression=self.compression,
+                               positional_files=self.positional_files)
         self.storage.create()
 
-    def compact(self, node_capacity=0):
+    def compact(self, node_capacity=0, offset_format=None, page_size=None):
+        """
+        Rebuilds the tree from live elements, ``node_capacity`` and
+        ``page_size`` set new fan-out and alignment (by default current
+        ones are kept, with only ``page_size`` set capacity is fitted to it)
+        """
+        compact_ind = self._new_compact_index(node_capacity, offset_format,
+                                              page_size)
+        compact_ind.bulk_load(self._compact_entries(compact_ind))
+        compact_ind.close_index()
+        self._swap_compacted(compact_ind)
+        return True
+
+    def _new_compact_index(self, node_capacity=0, offset_format=None,
+                           page_size=None):
+        """
+        Creates empty index to copy live elements to
+        """
+        if page_size is None:
+            page_size = self.page_size
         if not node_capacity:
-            node_capacity = self.node_capacity
+            if page_size != self.page_size:
+                node_capacity = self._fit_node_capacity(page_size) \
+                    if page_size else 10
+            else:
+                node_capacity = self.node_capacity
+        if node_capacity < 3:
+            raise NodeCapacityException
+        if not offset_format:
+            offset_format = self.offset_format
 
         compact_ind = self.__class__(
-            self.db_path, self.name + '_compact', node_capacity=node_capacity)
+            self.db_path, self.name + '_compact', node_capacity=node_capacity,
+            use_mmap=self.use_mmap, offset_format=offset_format)
+        # subclasses can fix constructor arguments
+        compact_ind.node_capacity = node_capacity
+        compact_ind.page_size = page_size
+        compact_ind.leaf_prefix = self.leaf_prefix
+        compact_ind._count_props()
+        # same storage (with its options) as this index
+        compact_ind.storage_class = self.storage_class
+        compact_ind.compression = self.compression
+        compact_ind.storage = self.storage._like(compact_ind.name)
         compact_ind.create_index()
+        return compact_ind
 
-        gen = self.all()
-        while True:
-            try:
-                doc_id, key, start, size, status = gen.next()
-            except StopIteration:
-                break
-            self.storage._f.seek(start)
-            value = self.storage._f.read(size)
-            start_ = compact_ind.storage._f.tell()
-            compact_ind.storage._f.write(value)
-            compact_ind.insert(doc_id, key, start_, size, status)
-
-        compact_ind.close_index()
+    def _swap_compacted(self, compact_ind):
+        """
+        Replaces index files with (closed) ``compact_ind`` ones and
+        reopens the index
+        """
         original_name = self.name
         # os.unlink(os.path.join(self.db_path, self.name + "_buck"))
         self.close_index()
         shutil.move(os.path.join(compact_ind.db_path, compact_ind.
                                  name + "_buck"), os.path.join(self.db_path, self.name + "_buck"))
-        shutil.move(os.path.join(compact_ind.db_path, compact_ind.
-                                 name + "_stor"), os.path.join(self.db_path, self.name + "_stor"))
+        self.storage.destroy()
+        compact_ind.storage.move(self.name)
+        compact_ind._destroy_bloom()
         # self.name = original_name
         self.open_index()  # reload...
         self.name = original_name
         self._save_params(dict(name=original_name))
         self._fix_params()
         self._clear_cache()
-        return True
 
     def _fix_params(self):
+        # indexes created without page_size in props are not aligned
+        self.page_size = 0
+        self.leaf_prefix = False
+        self.generation = ''  # : new for every created (or compacted) bucket file
         super(IU_TreeBasedIndex, self)._fix_params()
         self._count_props()
 
@@ -1973,7 +2196,9 @@ class IU_TreeBasedIndex(Index):
         self._match_doc_id.clear()
 #        self._read_single_leaf_record.clear()
         self._find_key_in_leaf.clear()
-        self._read_single_node_key.clear()
+        self._read_leaf.clear()
+        self._read_node.clear()
+        self._ahead = (0, '')
         self._find_first_key_occurence_in_node.clear()
         self._find_last_key_occurence_in_node.clear()
         self._read_leaf_nr_of_elements.clear()
@@ -1985,6 +2210,13 @@ class IU_TreeBasedIndex(Index):
         super(IU_TreeBasedIndex, self).close_index()
         self._clear_cache()
 
+    def end_batch(self, commit=True):
+        super(IU_TreeBasedIndex, self).end_batch(commit)
+        if not commit:
+            self._clear_cache()
+            self.buckets.seek(self._start_ind)
+            self.root_flag = struct.unpack('<c', self.buckets.read(1))[0]
+
 
 class IU_MultiTreeBasedIndex(IU_TreeBasedIndex):
     """
@@ -1994,6 +2226,8 @@ class IU_MultiTreeBasedIndex(IU_TreeBasedIndex):
     UPDATE operations (will always readd everything)
     """
 
+    shared_values = True
+
     def __init__(self, *args, **kwargs):
         super(IU_MultiTreeBasedIndex, self).__init__(*args, **kwargs)
 
@@ -2028,6 +2262,20 @@ class IU_MultiTreeBasedIndex(IU_TreeBasedIndex):
     def get(self, key):
         return super(IU_MultiTreeBasedIndex, self).get(key)
 
+    def bulk_load(self, entries, sort_buffer=100000):
+        return super(IU_MultiTreeBasedIndex, self).bulk_load(
+            self._split_keys(entries), sort_buffer)
+
+    def _split_keys(self, entries):
+        for entry in entries:
+            key = entry[1]
+            if isinstance(key, (list, tuple)):
+                key = set(key)
+            elif not isinstance(key, set):
+                key = set([key])
+            for curr_key in key:
+                yield (entry[0], curr_key) + tuple(entry[2:])
+
     def make_key_value(self, data):
         raise NotImplementedError()
 
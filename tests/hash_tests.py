@@ -21,12 +21,15 @@ from maras.database import DatabaseException
 from maras.hash_index import HashIndex, UniqueHashIndex
 from maras.index import IndexException
 from maras.misc import random_hex_40
+from maras.migrate import rehash
+from maras.hashing import xxh64_py, default_hash_func
 
 from maras import rr_cache
 
 import pytest
 import os
 import random
+import msgpack
 from hashlib import sha1
 
 try:
@@ -94,6 +97,63 @@ class WithAIndex(HashIndex):
         return sha1(key).digest()
 
 
+class MmapUniqueHashIndex(UniqueHashIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['use_mmap'] = True
+        super(MmapUniqueHashIndex, self).__init__(*args, **kwargs)
+
+
+class MmapCustomHashIndex(HashIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = 'I'
+        kwargs['hash_lim'] = 1
+        kwargs['use_mmap'] = True
+        super(MmapCustomHashIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        d = data.get('test')
+        if d is None:
+            return None
+        if d > 5:
+            k = 1
+        else:
+            k = 0
+        return k, dict(test=d)
+
+    def make_key(self, key):
+        return key
+
+
+class SmallIdIndex(UniqueHashIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['hash_lim'] = 3
+        super(SmallIdIndex, self).__init__(*args, **kwargs)
+
+
+class SmallModIndex(HashIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = 'I'
+        kwargs['hash_lim'] = 1
+        super(SmallModIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        return data['test'] % 50, None
+
+    def make_key(self, key):
+        return key
+
+
+class LegacyIdIndex(UniqueHashIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('hash_func', 'python')
+        super(LegacyIdIndex, self).__init__(*args, **kwargs)
+
+
 class HashIndexTests:
 
     def setup_method(self, method):
@@ -673,3 +733,96 @@ class HashIndexTests:
         assert 1 == db.count(db.get_many, 'custom', 1, limit=1, offset=offset)
 
         db.close()
+
+    def test_mmap_reads(self, tmpdir, inserts):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([MmapUniqueHashIndex(db.path, 'id'),
+                        MmapCustomHashIndex(db.path, 'custom')])
+        db.create()
+        l = []
+        for x in xrange(inserts):
+            c = dict(test=x)
+            db.insert(c)
+            l.append(c)
+        for curr in l[::2]:
+            curr['upd'] = True
+            db.update(curr)
+        db.close()
+        db.open()
+        assert db.indexes_names['id'].use_mmap
+        for curr in l:
+            assert db.get('id', curr['_id']) == curr
+        assert db.count(db.get_many, 'custom', 1, limit=-1) == inserts - 6
+        db.compact()
+        assert db.indexes_names['custom'].use_mmap
+        for curr in l:
+            assert db.get('id', curr['_id']) == curr
+        db.close()
+
+    def test_hash_table_growth(self, tmpdir, inserts):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([SmallIdIndex(db.path, 'id'),
+                        SmallModIndex(db.path, 'mod')])
+        db.create()
+        l = []
+        for x in xrange(inserts * 5):
+            c = dict(test=x)
+            db.insert(c)
+            l.append(c)
+        for curr in l[::3]:
+            curr['test'] += 1
+            db.update(curr)
+        for curr in l[1::3]:
+            db.delete(curr)
+        del l[1::3]
+        for name in ('id', 'mod'):
+            ind = db.indexes_names[name]
+            assert ind.buckets_nr > ind.hash_lim + 1
+            assert ind.load_factor <= ind.max_load
+
+        def check():
+            for curr in l:
+                assert db.get('id', curr['_id'])['test'] == curr['test']
+            for mod in xrange(50):
+                assert db.count(db.get_many, 'mod', mod, limit=-1) == \
+                    len([curr for curr in l if curr['test'] % 50 == mod])
+
+        check()
+        db.close()
+        db.open()
+        check()
+        db.compact()
+        check()
+        db.close()
+
+    def test_xxh64_fallback(self):
+        assert xxh64_py('') == 0xef46db3751d8e999
+        assert xxh64_py('abc') == 0x44bc2cf5ad770999
+
+    def test_rehash_legacy(self, tmpdir, inserts):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([LegacyIdIndex(db.path, 'id'),
+                        CustomHashIndex(db.path, 'custom')])
+        db.create()
+        l = [db.insert(dict(test=x)) for x in xrange(inserts)]
+        assert db.id_ind.hash_func == 'python'
+        assert db.indexes_names['custom'].hash_func == default_hash_func
+        # indexes created before hash_func was stored in props
+        props = db.id_ind._get_props()
+        del props['hash_func']
+        db.id_ind.buckets.seek(0)
+        db.id_ind.buckets.write(msgpack.dumps(props))
+        db.close()
+        db.open()
+        assert db.id_ind.hash_func == 'python'
+        for curr in l:
+            assert db.get('id', curr['_id'])['test'] is not None
+        db.close()
+        rehash(db.path)
+        db.open()
+        assert db.id_ind.hash_func == default_hash_func
+        assert db.id_ind._get_props()['hash_func'] == default_hash_func
+        for curr in l:
+            assert db.get('id', curr['_id'])['_rev'] == curr['_rev']
+        assert db.count(db.get_many, 'custom', 1, limit=-1) == inserts - 6
+        db.close()
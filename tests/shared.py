@@ -22,6 +22,12 @@ from maras.hash_index import HashIndex, UniqueHashIndex, MultiHashIndex
 from maras.index import IndexException, TryReindexException, IndexNotFoundException, IndexPreconditionsException
 
 from maras.tree_index import TreeBasedIndex, MultiTreeBasedIndex
+from maras.storage import SegmentedStorage, StorageException
+from maras.batch_file import BatchFile
+from maras.compression import MARKER
+from maras.lazy import LazyDocument
+from maras.online_compaction import OnlineCompaction
+from maras.migrate import widen_offsets
 
 from maras.debug_stuff import database_step_by_step
 
@@ -139,6 +145,138 @@ class Simple_TreeIndex(TreeBasedIndex):
         return key
 
 
+class Segmented_TreeIndex(TreeBasedIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['node_capacity'] = 100
+        kwargs['key_format'] = 'I'
+        kwargs['storage_class'] = 'SegmentedStorage'
+        super(Segmented_TreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        t_val = data.get('t')
+        if t_val is not None:
+            return t_val, {'t': t_val}
+        return None
+
+    def make_key(self, key):
+        return key
+
+
+class Segmented_UniqueHashIndex(UniqueHashIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['storage_class'] = 'SegmentedStorage'
+        super(Segmented_UniqueHashIndex, self).__init__(*args, **kwargs)
+
+
+class Paged_TreeIndex(TreeBasedIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = 'I'
+        kwargs['page_size'] = 512
+        super(Paged_TreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        t_val = data.get('t')
+        if t_val is not None:
+            return t_val, None
+        return None
+
+    def make_key(self, key):
+        return key
+
+
+class Prefixed_TreeIndex(TreeBasedIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = '16s'
+        kwargs['node_capacity'] = 10
+        kwargs['leaf_prefix'] = True
+        super(Prefixed_TreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        t_val = data.get('t')
+        if t_val is not None:
+            return 'user/%011d' % t_val, None
+        return None
+
+    def make_key(self, key):
+        return 'user/%011d' % key
+
+
+class Bloom_HashIndex(HashIndex):
+
+    bloom_bits = 10
+    bloom_min_capacity = 16
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = 'I'
+        super(Bloom_HashIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        t_val = data.get('t')
+        if t_val is not None:
+            return t_val, None
+        return None
+
+    def make_key(self, key):
+        return key
+
+
+class Bloom_TreeIndex(TreeBasedIndex):
+
+    bloom_bits = 10
+    bloom_min_capacity = 16
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = 'I'
+        super(Bloom_TreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        t_val = data.get('t')
+        if t_val is not None:
+            return t_val, None
+        return None
+
+    def make_key(self, key):
+        return key
+
+
+class Covering_TreeIndex(TreeBasedIndex):
+
+    included_fields = ('name', 'x')
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = 'I'
+        super(Covering_TreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        t_val = data.get('t')
+        if t_val is not None:
+            return t_val, self.include_fields(data)
+        return None
+
+    def make_key(self, key):
+        return key
+
+
+class ListValue_TreeIndex(TreeBasedIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = 'I'
+        super(ListValue_TreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        t_val = data.get('t')
+        if t_val is not None:
+            return t_val, [t_val, data.get('text')]
+        return None
+
+    def make_key(self, key):
+        return key
+
+
 class WithRun_Index(HashIndex):
 
     def __init__(self, *args, **kwargs):
@@ -1069,3 +1207,976 @@ x * 10, None
 
         with pytest.raises(DatabaseException):
             db.revert_index('test_revert', reindex=True)  # second restore
+
+    def test_batch(self, tmpdir, monkeypatch):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = []
+        with db.batch():
+            for x in xrange(500):
+                c = dict(a=x % 10, t=x)
+                db.insert(c)
+                l.append(c)
+            for c in l[::5]:
+                c['upd'] = True
+                db.update(c)
+            assert db.get('id', l[5]['_id']) == l[5]
+            assert db.count(db.all, 'tree') == 500
+        for c in l:
+            assert db.get('id', c['_id']) == c
+        assert db.count(db.get_many, 'run', 3, limit=-1) == 50
+        assert db.count(db.get_many, 'tree', start=100, end=199, limit=-1) == 100
+
+        with pytest.raises(ZeroDivisionError):
+            with db.batch():
+                for x in xrange(500, 600):
+                    db.insert(dict(a=1, t=x))
+                db.delete(l[0])
+                1 / 0
+        assert db.count(db.all, 'id') == 500
+        assert db.count(db.all, 'tree') == 500
+        assert db.get('id', l[0]['_id'])['_rev'] == l[0]['_rev']
+
+        with db.batch(fsync=True):
+            db.insert(dict(a=1, t=1000))
+        db.close()
+        db.open()
+        assert db.count(db.all, 'id') == 501
+        assert db.get('tree', 1000)['key'] == 1000
+
+        # failed write back of one index doesn't leave others buffering
+        id_ind = db.indexes_names['id']
+        end_batch = id_ind.end_batch
+
+        def failing(commit=True):
+            end_batch(commit)
+            raise IOError("No space left on device")
+        monkeypatch.setattr(id_ind, 'end_batch', failing)
+        with pytest.raises(IOError):
+            with db.batch():
+                for x in xrange(1001, 1011):
+                    db.insert(dict(a=1, t=x))
+        monkeypatch.undo()
+        for index in db.indexes:
+            assert not isinstance(index.buckets, BatchFile)
+            assert not isinstance(index.storage._f, BatchFile)
+        db.insert(dict(a=1, t=1011))
+        db.close()
+        db.open()
+        assert db.count(db.all, 'id') == 512
+        assert db.count(db.get_many, 'tree', start=1001, end=1011, limit=-1) == 11
+        db.close()
+
+    def test_page_cache(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'),
+                      page_cache_size=16 * 4096)
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = []
+        for x in xrange(1000):
+            c = dict(a=x % 10, t=x, x=x)
+            db.insert(c)
+            l.append(c)
+        for c in l[::3]:
+            c['x'] = 0
+            db.update(c)
+        for c in l[1::3]:
+            db.delete(c)
+        del l[1::3]
+
+        def check():
+            for c in l:
+                assert db.get('id', c['_id']) == c
+                assert db.get('tree', c['t'], with_doc=True)['doc'] == c
+            for a in xrange(10):
+                assert db.run('run', 'sum', a) == \
+                    sum(c['x'] for c in l if c['a'] == a)
+
+        check()
+        stats = db.page_cache.stats()
+        assert stats['hits'] and stats['misses'] and stats['evictions']
+        assert stats['pages'] <= 16
+        db.close()
+        assert not db.page_cache.stats()['pages']
+        db.open()
+        check()
+        db.reindex()
+        db.compact()
+        check()
+        db.close()
+
+    def test_get_multi(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = []
+        for x in xrange(300):
+            c = dict(a=x, t=x, x='x' * (x % 7))
+            db.insert(c)
+            l.append(c)
+        for c in l[::4]:
+            c['upd'] = True
+            db.update(c)
+        db.delete(l[1])
+
+        ids = [c['_id'] for c in reversed(l)] + ['a' * 32, l[5]['_id']]
+        res = db.get_multi('id', ids)
+        assert len(res) == len(ids)
+        assert res[:-2] == [db.get('id', _id) if _id != l[1]['_id']
+                            else None for _id in ids[:-2]]
+        assert res[-2] is None
+        assert res[-1] == l[5]
+
+        keys = range(0, 300, 3) + [1, 1000]
+        res = db.get_multi('tree', keys, with_doc=True)
+        for key, data in zip(keys, res):
+            if key in (1, 1000):
+                assert data is None
+            else:
+                assert data == db.get('tree', key, with_doc=True)
+                assert data['doc'] == l[key]
+
+        res = db.get_multi('run', [7, 8], with_doc=True)
+        assert [data['doc'] for data in res] == [l[7], l[8]]
+        res = db.get_multi('run', [7, 1], with_storage=False)
+        assert res[0] == {'_id': l[7]['_id'], 'key': db.get('run', 7)['key']}
+        assert res[1] is None
+        assert db.get_multi('id', []) == []
+        db.close()
+
+    def test_insert_many(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = [dict(a=x % 10, t=(x * 7) % 300, x=x) for x in xrange(300)]
+        l.append(dict(_id='a' * 40, a=1, t=1000, x=0))
+        l.append(dict(a=None, t=None))
+        res = db.insert_many(iter(l))
+        assert res == [{'_id': c['_id'], '_rev': c['_rev']} for c in l]
+        assert res[300]['_id'] == 'a' * 40
+        for c in l:
+            assert db.get('id', c['_id']) == c
+        assert db.count(db.all, 'tree') == 301
+        assert [d['key'] for d in db.all('tree')][:300] == range(300)
+        assert db.get('tree', 7, with_doc=True)['doc'] == l[1]
+        assert db.run('run', 'sum', 3) == sum(xrange(3, 300, 10))
+
+        # tree is not empty now
+        more = db.insert_many(dict(a=1, t=t) for t in xrange(599, 299, -1))
+        assert len(more) == 300
+        assert [d['key'] for d in db.all('tree')][:600] == range(600)
+        assert db.count(db.get_many, 'run', 1, limit=-1) == 331
+
+        with pytest.raises(PreconditionsException):
+            db.insert_many([dict(a=1, t=2000), l[0]])
+        assert db.count(db.all, 'id') == 602
+        with pytest.raises(ZeroDivisionError):
+            with db.batch():
+                db.insert_many([dict(a=1, t=2000)])
+                1 / 0
+        assert db.count(db.all, 'id') == 602
+        assert db.insert_many([]) == []
+        db.close()
+
+    def test_compact_online(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = []
+        for x in xrange(300):
+            c = dict(a=x % 10, t=x, x=x)
+            db.insert(c)
+            l.append(c)
+        for c in l[::3]:
+            db.delete(c)
+        del l[::3]
+        for c in l * 3:
+            c['x'] += 1
+            db.update(c)
+
+        def check():
+            assert db.count(db.all, 'id') == len(l)
+            assert db.count(db.all, 'tree') == len(l)
+            for c in l:
+                assert db.get('id', c['_id']) == c
+                assert db.get('tree', c['t'], with_doc=True)['doc'] == c
+            for a in xrange(10):
+                assert db.run('run', 'sum', a) == \
+                    sum(c['x'] for c in l if c['a'] == a)
+
+        # writes between every step land in side log
+        steps = [OnlineCompaction(index) for index in db.indexes]
+        for i, step in enumerate(('start', 'copy', 'catch_up', 'finish')):
+            for comp in steps:
+                getattr(comp, step)()
+            for x in xrange(1000 + i * 100, 1030 + i * 100):
+                c = dict(a=x % 10, t=x, x=x)
+                db.insert(c)
+                l.append(c)
+            for c in l[:20]:
+                c['x'] += 1
+                db.update(c)
+            for c in l[-50:-40]:
+                db.delete(c)
+            del l[-50:-40]
+            l.extend(db.get('id', c['_id']) for c in db.insert_many(
+                dict(a=1, t=2000 + i * 100 + x, x=x) for x in xrange(5)))
+            check()
+        assert not [f for f in os.listdir(db.path) if 'compact' in f or 'snap' in f]
+
+        db.compact(online=True)
+        check()
+        db.close()
+        db.open()
+        check()
+        db.close()
+
+    def test_storage_reuse(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = [dict(a=x % 10, t=x, x=x) for x in xrange(100)]
+        for c in l:
+            db.insert(c)
+
+        def check():
+            assert db.count(db.all, 'id') == len(l)
+            for c in l:
+                assert db.get('id', c['_id']) == c
+                assert db.get('tree', c['t'], with_doc=True)['doc'] == c
+            for a in xrange(10):
+                assert db.run('run', 'sum', a) == \
+                    sum(c['x'] for c in l if c['a'] == a)
+
+        sizes = dict((name, os.path.getsize(os.path.join(db.path, name + '_stor')))
+                     for name in ('id', 'run', 'tree'))
+        for i in xrange(10):
+            for c in l:
+                c['x'] += 1
+                db.update(c)
+        for c in l[::2]:
+            db.delete(c)
+        del l[::2]
+        for x in xrange(50):
+            c = dict(a=x % 10, t=100 + x, x=x)
+            db.insert(c)
+            l.append(c)
+        check()
+        # records of the same size, old space is enough for all of them
+        for name, size in sizes.iteritems():
+            assert os.path.getsize(os.path.join(db.path, name + '_stor')) <= size * 1.5
+
+        for c in l[:10]:
+            db.delete(c)
+        del l[:10]
+        storage = db.indexes_names['id'].storage
+        free = storage.free_space
+        assert free > 0
+        with pytest.raises(ZeroDivisionError):
+            with db.batch():
+                for c in l[:10]:
+                    db.update(dict(c, x=-1))
+                1 / 0
+        assert storage.free_space == free
+        check()
+
+        db.close()
+        db.open()
+        storage = db.indexes_names['id'].storage
+        assert storage.free_space == free
+        assert not os.path.exists(os.path.join(db.path, 'id_stor_free'))
+        check()
+        db.close()
+
+    def test_segmented_storage(self, tmpdir, monkeypatch):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([Segmented_UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Segmented_TreeIndex(db.path, 'tree')])
+        # segment size is stored with storage on create
+        monkeypatch.setattr(SegmentedStorage, 'segment_size', 2048)
+        db.create()
+        monkeypatch.undo()
+        # segment numbers only grow, starts need 64 bits
+        assert db.indexes_names['id'].entry_line_format.endswith('QQcQ')
+        assert db.indexes_names['tree'].meta_format.endswith('QQc')
+        for ind in (Segmented_TreeIndex(db.path, 'narrow', offset_format='I'),
+                    Segmented_UniqueHashIndex(db.path, 'narrow', offset_format='I')):
+            with pytest.raises(IndexException):
+                ind.create_index()
+            assert not os.path.exists(os.path.join(db.path, 'narrow_buck'))
+        l = [dict(a=x % 10, t=x, x=x, s='a' * 20) for x in xrange(300)]
+        for c in l:
+            db.insert(c)
+
+        def segments():
+            return sorted(int(f.rsplit('_', 1)[1]) for f in os.listdir(db.path)
+                          if f.startswith('id_stor_') and f[-1].isdigit())
+
+        def check():
+            assert db.count(db.all, 'id') == len(l)
+            for c in l:
+                assert db.get('id', c['_id']) == c
+                assert db.get('tree', c['t'], with_doc=True)['doc'] == c
+            assert db.get_multi('id', [c['_id'] for c in l]) == l
+            for a in xrange(10):
+                assert db.run('run', 'sum', a) == \
+                    sum(c['x'] for c in l if c['a'] == a)
+
+        check()
+        nums = segments()
+        assert len(nums) > 5
+        assert os.path.getsize(os.path.join(db.path, 'id_stor')) == 100
+        # first segments have only deleted records now
+        for c in l[:100]:
+            db.delete(c)
+        del l[:100]
+        assert segments()[0] == 2
+        assert segments()[-1] == nums[-1]
+        check()
+
+        with pytest.raises(ZeroDivisionError):
+            with db.batch():
+                for c in l:
+                    db.delete(dict(c))
+                1 / 0
+        check()
+
+        db.close()
+        db.open()
+        check()
+        for name in ('id', 'tree'):
+            storage = db.indexes_names[name].storage
+            assert isinstance(storage, SegmentedStorage)
+            assert storage.segment_size == 2048
+        db.compact()
+        assert segments()[0] == 1
+        assert db.indexes_names['id'].storage.segment_size == 2048
+        check()
+        db.compact(online=True)
+        check()
+        db.close()
+
+    def test_widen_offsets(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = []
+        for x in xrange(100):
+            c = dict(a=x % 10, t=x, x=x)
+            db.insert(c)
+            l.append(c)
+
+        def check():
+            assert db.count(db.all, 'id') == len(l)
+            for c in l:
+                assert db.get('id', c['_id']) == c
+                assert db.get('tree', c['t'], with_doc=True)['doc'] == c
+            for a in xrange(10):
+                assert db.run('run', 'sum', a) == \
+                    sum(c['x'] for c in l if c['a'] == a)
+
+        assert [ind.offset_format for ind in db.indexes] == ['I'] * 3
+        db.close()
+        widen_offsets(db.path)
+        db.open()
+        # detected from props
+        assert [ind.offset_format for ind in db.indexes] == ['Q'] * 3
+        assert db.id_ind.entry_line_format == '<40s8sQQcQ'
+        assert db.indexes_names['tree'].meta_format == '40sQQc'
+        check()
+        for c in l[:20]:
+            c['x'] += 1
+            db.update(c)
+        for c in l[-20:]:
+            db.delete(c)
+        del l[-20:]
+        for x in xrange(200, 250):
+            c = dict(a=x % 10, t=x, x=x)
+            db.insert(c)
+            l.append(c)
+        check()
+
+        # elements pointing past 4 GB
+        run, tree = db.indexes_names['run'], db.indexes_names['tree']
+        run.insert('b' * 40, 1000, 5 << 32, 1 << 33)
+        tree.insert('b' * 40, 1000, 5 << 32, 1 << 33)
+        assert run.get(1000)[2:4] == (5 << 32, 1 << 33)
+        assert tree.get(1000)[2:4] == (5 << 32, 1 << 33)
+        run.delete('b' * 40, 1000)
+        tree.delete('b' * 40, 1000)
+
+        db.compact()
+        assert [ind.offset_format for ind in db.indexes] == ['Q'] * 3
+        check()
+        db.close()
+
+    def test_compression(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Segmented_TreeIndex(db.path, 'tree')])
+        # stored in props
+        db.indexes[0].compression = 'zlib'
+        db.indexes[2].compression = 'zlib'
+        db.create()
+        l = []
+        for x in xrange(100):
+            c = dict(a=x % 10, t=x, x=x, text='lorem ipsum dolor ' * 20)
+            db.insert(c)
+            l.append(c)
+
+        def check():
+            assert db.count(db.all, 'id') == len(l)
+            for c in l:
+                assert db.get('id', c['_id']) == c
+                assert db.get('tree', c['t'], with_doc=True)['doc'] == c
+            assert db.get_multi('id', [c['_id'] for c in l]) == l
+            for a in xrange(10):
+                assert db.run('run', 'sum', a) == \
+                    sum(c['x'] for c in l if c['a'] == a)
+
+        def raw(c):
+            doc_id, rev, start, size, status = db.id_ind.get(c['_id'])
+            return db.id_ind.storage._read(start, size)
+
+        check()
+        assert raw(l[0])[:2] == MARKER + 'z'
+        assert os.path.getsize(os.path.join(db.path, 'id_stor')) < 100 * 100
+        for c in l[:20]:
+            c['x'] += 1
+            db.update(c)
+        check()
+
+        with pytest.raises(StorageException):
+            db.train_dictionary('run')
+        db.train_dictionary('id')
+        with pytest.raises(StorageException):
+            db.train_dictionary('id')
+        # too small for compression without dictionary
+        for x in xrange(100, 120):
+            c = dict(a=x % 10, t=x, x=x, text='lorem ipsum dolor ' * 3)
+            db.insert(c)
+            l.append(c)
+        assert raw(l[-1])[:2] == MARKER + 'Z'
+        assert raw(l[0])[:2] == MARKER + 'z'
+        check()
+
+        db.close()
+        db.open()
+        check()
+        db.compact()
+        assert raw(l[-1])[:2] == MARKER + 'Z'
+        check()
+        db.close()
+
+    def test_lazy(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        WithRun_Index(db.path, 'run'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.indexes[0].compression = 'zlib'
+        db.create()
+        l = []
+        for x in xrange(50):
+            c = dict(a=x % 10, t=x, x=x, nested=dict(l=range(x)), text='abc' * x)
+            db.insert(c)
+            l.append(c)
+
+        d = db.get('id', l[7]['_id'], lazy=True)
+        assert isinstance(d, LazyDocument)
+        assert d['x'] == 7 and d['_id'] == l[7]['_id']
+        assert d.get('nope') is None and 'nope' not in d
+        assert d._data is None  # not decoded yet
+        assert d == l[7] and dict(d) == l[7]
+        assert sorted(d.keys()) == sorted(l[7].keys())
+
+        assert [curr['_id'] for curr in db.all('id', lazy=True) if curr['a'] == 3] == \
+            [curr['_id'] for curr in db.all('id') if curr['a'] == 3]
+        res = list(db.get_many('tree', start=10, end=19, with_doc=True, lazy=True))
+        assert [curr['doc'] for curr in res] == l[10:20]
+        assert isinstance(res[0]['doc'], LazyDocument)
+        assert db.get_multi('id', [c['_id'] for c in l], lazy=True) == l
+        assert db.get('tree', 5, with_doc=True, lazy=True)['doc']['nested'] == \
+            dict(l=range(5))
+
+        # lazy documents can be stored back
+        d = db.get('id', l[3]['_id'], lazy=True)
+        d['x'] = 100
+        db.update(d)
+        l[3].update(x=100, _rev=d['_rev'])
+        assert db.get('id', l[3]['_id']) == l[3]
+        assert db.run('run', 'sum', 3) == sum(c['x'] for c in l if c['a'] == 3)
+        d = db.get('id', l[4]['_id'], lazy=True)
+        db.delete(d)
+        with pytest.raises(RecordDeleted):
+            db.get('id', l[4]['_id'])
+        db.close()
+
+    def test_lazy_list_values(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        ListValue_TreeIndex(db.path, 'lst')])
+        db.indexes[1].compression = 'zlib'
+        db.create()
+        l = []
+        for x in xrange(30):
+            c = dict(t=x, text='abc' * x)
+            db.insert(c)
+            l.append(c)
+        # values which aren't dicts are decoded whole, under `value`
+        for lazy in (False, True):
+            res = db.get('lst', 25, lazy=lazy)
+            assert res == dict(value=[25, 'abc' * 25], key=25, _id=l[25]['_id'])
+            res = list(db.get_many('lst', start=3, end=5, lazy=lazy))
+            assert [curr['value'] for curr in res] == \
+                [[x, 'abc' * x] for x in xrange(3, 6)]
+            res = list(db.all('lst', lazy=lazy, with_doc=True))
+            assert [curr['value'] for curr in res] == \
+                [[x, 'abc' * x] for x in xrange(30)]
+            assert [curr['doc']['t'] for curr in res] == range(30)
+            res = db.get_multi('lst', [7, 28], lazy=lazy)
+            assert [curr['value'] for curr in res] == [[7, 'abc' * 7], [28, 'abc' * 28]]
+        db.close()
+
+    def test_fields(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.indexes[0].compression = 'zlib'
+        db.create()
+        l = []
+        for x in xrange(30):
+            c = dict(a=x % 5, t=x, x=x, nested=dict(l=range(x)), text='abc' * x)
+            db.insert(c)
+            l.append(c)
+
+        d = db.get('id', l[7]['_id'], fields=['x', 'nope'])
+        assert d == dict(x=7, _id=l[7]['_id'], _rev=l[7]['_rev'])
+        assert db.get('id', l[7]['_id'], fields=[]) == \
+            dict(_id=l[7]['_id'], _rev=l[7]['_rev'])
+        assert [curr['x'] for curr in db.all('id', fields=('x', ))] == \
+            [curr['x'] for curr in db.all('id')]
+        assert all(sorted(curr) == ['_id', '_rev', 'text']
+                   for curr in db.all('id', fields=['text']))
+
+        res = list(db.get_many('tree', start=10, end=19, with_doc=True,
+                               fields=['x', 'nested']))
+        assert [curr['doc'] for curr in res] == \
+            [dict(x=c['x'], nested=c['nested'], _id=c['_id'], _rev=c['_rev'])
+             for c in l[10:20]]
+        res = list(db.get_many('tree', 3, limit=-1, with_doc=True, fields=['a']))
+        assert [curr['doc']['a'] for curr in res] == [3]
+        res = db.get('tree', 5, with_doc=True, fields=['a'])
+        assert res['doc'] == dict(a=0, _id=l[5]['_id'], _rev=l[5]['_rev'])
+        assert res['key'] == 5
+        res = list(db.all('tree', with_doc=True, fields=['x']))
+        assert sorted(curr['doc']['x'] for curr in res) == range(30)
+        assert db.get_multi('id', [c['_id'] for c in l], fields=['t']) == \
+            [dict(t=c['t'], _id=c['_id'], _rev=c['_rev']) for c in l]
+
+        # index values which aren't dicts are decoded whole
+        storage = db.indexes_names['tree'].storage
+        for value in ([1, 'x'], 'x', 5, None):
+            assert storage.data_from(storage.data_to(value), fields=['x']) == value
+        db.close()
+
+    def test_hash_scan(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.indexes[0].scan_entries = 7
+        db.create()
+        l = []
+        for x in xrange(100):
+            c = dict(t=x, x=x)
+            db.insert(c)
+            l.append(c)
+        for c in l[5:30] + l[64:71]:
+            db.delete(dict(c))
+        live = [c['_id'] for c in l[:5] + l[30:64] + l[71:]]
+
+        ind = db.indexes_names['id']
+        assert [curr[0] for curr in ind.all()] == live
+        assert [curr['_id'] for curr in db.all('id')] == live
+        batches = list(ind.all_batches())
+        assert all(0 < len(batch) <= 7 for batch in batches)
+        assert [curr for batch in batches for curr in batch] == list(ind.all())
+        for offset, limit in ((0, 1), (3, 10), (5, -1), (33, 8), (50, 100), (68, 5), (69, -1)):
+            assert [curr['_id'] for curr in db.all('id', limit=limit, offset=offset)] == \
+                (live[offset:offset + limit] if limit > 0 else live[offset:])
+        assert list(ind.all(limit=0)) == []
+        assert ind.count() == len(live) == db.count(db.all, 'id')
+        assert db.count(db.all, 'id', 10) == 10
+        assert db.count(db.all, 'tree') == len(live)
+        db.close()
+
+    def test_tree_blocks(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = []
+        for x in xrange(500):
+            c = dict(t=(x * 7) % 500)
+            db.insert(c)
+            l.append(c)
+
+        ind = db.indexes_names['tree']
+        assert ind.root_flag == 'n'
+        fields, keys, pointers = ind._read_node(ind.data_start)
+        nr_of_elements = fields[0]
+        assert list(keys[:nr_of_elements]) == sorted(keys[:nr_of_elements])
+        assert ind._read_single_node_key(ind.data_start, 0) == \
+            (pointers[0], keys[0], pointers[1])
+        # decoded blocks are served from cache until next write
+        assert ind._read_node(ind.data_start) is ind._read_node(ind.data_start)
+        for x in xrange(0, 500, 7):
+            assert db.get('tree', x)['key'] == x
+        assert ind._read_leaf.cache
+        l[0]['t'] = 1000
+        db.update(l[0])
+        assert not ind._read_leaf.cache
+        assert db.get('tree', 1000)['_id'] == l[0]['_id']
+        with pytest.raises(RecordNotFound):
+            db.get('tree', 0)
+        assert [curr['key'] for curr in db.get_many('tree', start=490, limit=-1)] == \
+            range(490, 500) + [1000]
+        db.close()
+
+    def test_tree_page_size(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Paged_TreeIndex(db.path, 'paged')])
+        db.create()
+        ind = db.indexes_names['paged']
+        assert ind.node_capacity == 9  # 53 bytes records
+        assert ind.node_size == ind.leaf_size == 512 == ind.data_start
+        l = []
+        for x in xrange(300):
+            c = dict(t=(x * 13) % 300)
+            db.insert(c)
+            l.append(c)
+        for c in l[::3]:
+            db.delete(dict(c))
+        live = sorted(c['t'] for c in l[1::3] + l[2::3])
+        buck = os.path.join(db.path, 'paged_buck')
+        assert os.path.getsize(buck) % 512 == 0
+        assert [curr['key'] for curr in db.all('paged')] == live
+
+        db.compact_index('paged', node_capacity=30)
+        assert ind.node_capacity == 30 and ind.page_size == 512
+        assert ind.node_size == 512 and ind.leaf_size == 2048
+        assert os.path.getsize(buck) % 512 == 0
+        assert [curr['key'] for curr in db.get_many('paged', start=100, end=200, limit=-1)] == \
+            [k for k in live if 100 <= k <= 200]
+        db.compact_index('paged', page_size=4096)
+        assert ind.node_capacity == 77 and ind.data_start == 4096
+        db.close()
+        db.open()
+        ind = db.indexes_names['paged']
+        assert ind.node_capacity == 77 and ind.page_size == 4096
+        assert [curr['key'] for curr in db.all('paged')] == live
+        db.close()
+
+    def test_tree_leaf_prefix(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Prefixed_TreeIndex(db.path, 'prefixed')])
+        db.create()
+        ind = db.indexes_names['prefixed']
+        l = []
+        for x in xrange(200):
+            c = dict(t=(x * 7) % 200)
+            db.insert(c)
+            l.append(c)
+        for c in l[::4]:
+            db.delete(dict(c))
+        for c in l[1::4]:
+            c['t'] += 1000
+            db.update(c)
+        live = sorted(c['t'] for c in l if c not in l[::4])
+
+        def check():
+            assert [int(curr['key'][5:]) for curr in db.all('prefixed')] == live
+            assert [int(curr['key'][5:]) for curr in db.get_many('prefixed', start=50, end=150, limit=-1)] == \
+                [k for k in live if 50 <= k <= 150]
+            for k in live[::10]:
+                assert db.get('prefixed', k, with_doc=True)['doc']['t'] == k
+
+        check()
+        db.compact_index('prefixed')
+        assert ind.leaf_prefix
+        check()
+        # packed leaves keep more records than node_capacity
+        nr, prev_leaf, next_leaf = ind._read_leaf_nr_of_elements_and_neighbours(
+            ind._find_leaf_with_first_key_occurence(ind.make_key(live[0])))
+        assert nr > ind.node_capacity
+        db.close()
+        db.open()
+        assert db.indexes_names['prefixed'].leaf_prefix
+        check()
+        db.close()
+
+    def test_tree_read_ahead(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = []
+        for x in xrange(1000):
+            c = dict(t=(x * 7) % 1000)
+            db.insert(c)
+            l.append(c)
+        for x in xrange(150):
+            db.insert(dict(t=5000))
+        for c in l[::5]:
+            db.delete(dict(c))
+        live = sorted(c['t'] for c in l[1::5] + l[2::5] + l[3::5] + l[4::5])
+        live_all = live + [5000] * 150
+        db.compact_index('tree')
+        ind = db.indexes_names['tree']
+        ind._clear_cache()
+        ind.read_ahead = 16
+        db.read_batch = 7
+
+        assert [curr['key'] for curr in db.all('tree')] == live_all
+        # leaves after the first one are read ahead
+        assert ind._ahead[0] == ind.data_start + ind.node_size + ind.leaf_size
+        assert [curr['key'] for curr in db.all('tree', limit=150, offset=50)] == \
+            live_all[50:200]
+        assert [curr['key'] for curr in db.get_many('tree', start=100, end=800, limit=250, offset=60)] == \
+            [k for k in live if 100 <= k <= 800][60:310]
+        assert [curr['key'] for curr in db.get_many('tree', start=100, limit=-1, offset=700, inclusive_start=False)] == \
+            [k for k in live_all if k > 100][700:]
+        assert len(list(db.get_many('tree', 5000, limit=-1, offset=90))) == 60
+        assert all(curr['doc']['t'] == curr['key']
+                   for curr in db.get_many('tree', start=300, end=400, limit=-1, with_doc=True))
+        assert all('value' not in curr for curr in db.all('tree', with_storage=False))
+        db.close()
+
+    def test_bloom_filter(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Bloom_HashIndex(db.path, 'bh'),
+                        Bloom_TreeIndex(db.path, 'bt')])
+        db.create()
+        for x in xrange(500):
+            db.insert(dict(t=x * 2))
+
+        def check():
+            lookups = []
+            for name in ('bh', 'bt'):
+                ind = db.indexes_names[name]
+                assert ind.bloom.capacity >= ind.bloom.count >= 500
+                find_key = ind._find_key
+
+                def counted(key, find_key=find_key):
+                    lookups.append(key)
+                    return find_key(key)
+                ind._find_key = counted
+                try:
+                    for x in xrange(0, 1000, 2):
+                        assert db.get(name, x)['key'] == x
+                    for x in xrange(1, 1000, 2):
+                        with pytest.raises(RecordNotFound):
+                            db.get(name, x)
+                        assert list(db.get_many(name, x, limit=-1)) == []
+                finally:
+                    ind._find_key = find_key
+            # found keys and few false positives
+            assert 1000 <= len(lookups) < 1100
+
+        check()
+        db.close()
+        assert os.path.exists(os.path.join(db.path, 'bh_bloom'))
+        db.open()
+        assert not os.path.exists(os.path.join(db.path, 'bh_bloom'))
+        check()
+        db.compact_index('bh')
+        db.compact_index('bt')
+        assert not os.path.exists(os.path.join(db.path, 'bh_compact_bloom'))
+        check()
+        db.close()
+        # not saved filter (like after crash) is built again
+        os.unlink(os.path.join(db.path, 'bt_bloom'))
+        db.open()
+        check()
+        db.close()
+
+    def test_covering_index(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Covering_TreeIndex(db.path, 'cover')])
+        db.create()
+        l = []
+        for x in xrange(50):
+            c = dict(t=x, x=x * 2, name='n%d' % x, other='o' * x)
+            db.insert(c)
+            l.append(c)
+        l[3]['name'] = 'changed'
+        db.update(l[3])
+        id_ind = db.indexes_names['id']
+        lookups = []
+        find_key = id_ind._find_key
+
+        def counted(key):
+            lookups.append(key)
+            return find_key(key)
+        id_ind._find_key = counted
+        try:
+            res = list(db.get_many('cover', start=0, end=9, with_doc=True,
+                                   fields=['x', 'name']))
+            assert [curr['doc'] for curr in res] == \
+                [dict(x=c['x'], name=c['name'], _id=c['_id']) for c in l[:10]]
+            assert res[0]['x'] == 0 and 'other' not in res[0]
+            res = list(db.all('cover', with_doc=True, with_storage=False,
+                              fields=['name']))
+            assert [curr['doc']['name'] for curr in res] == [c['name'] for c in l]
+            assert all('value' not in curr for curr in res)
+            assert db.get('cover', 3, with_doc=True, fields=['name'])['doc'] == \
+                dict(name='changed', _id=l[3]['_id'])
+            assert [curr['doc'] for curr in db.get_multi('cover', [1, 2], with_doc=True, fields=['x'])] == \
+                [dict(x=2, _id=l[1]['_id']), dict(x=4, _id=l[2]['_id'])]
+            assert lookups == []
+            # other fields need the document
+            res = list(db.get_many('cover', start=0, end=9, with_doc=True,
+                                   fields=['x', 'other']))
+            assert [curr['doc']['other'] for curr in res] == [c['other'] for c in l[:10]]
+            assert len(lookups) == 10
+        finally:
+            id_ind._find_key = find_key
+        db.close()
+
+    def test_with_doc_windows(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        l = []
+        for x in xrange(40):
+            c = dict(t=(x * 7) % 40, x=x)
+            db.insert(c)
+            l.append(c)
+        l.sort(key=lambda c: c['t'])
+        db.read_batch = 8
+        storage = db.indexes_names['id'].storage
+        calls = []
+        get_multi = storage.get_multi
+
+        def counted(positions, *args, **kwargs):
+            calls.append(len(positions))
+            return get_multi(positions, *args, **kwargs)
+        storage.get_multi = counted
+        try:
+            res = list(db.get_many('tree', start=0, end=39, limit=-1, with_doc=True))
+            assert [curr['doc'] for curr in res] == l
+            assert calls == [8] * 5
+            del calls[:]
+            res = list(db.all('tree', with_doc=True, offset=5, limit=10))
+            assert [curr['doc']['x'] for curr in res] == [c['x'] for c in l[5:15]]
+            assert calls == [8, 2]
+        finally:
+            storage.get_multi = get_multi
+        db.close()
+
+    def test_cursors(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 'tree'),
+                        CustomHashIndex(db.path, 'custom')])
+        db.create()
+        for x in xrange(300):
+            db.insert(dict(t=x % 30, test=x % 10, x=x))
+
+        def pages(method, *args, **kwargs):
+            res = []
+            cursor = ''
+            while True:
+                page = list(method(*args, cursor=cursor, **kwargs))
+                if not page:
+                    return res
+                res.extend(curr['_id'] for curr in page)
+                cursor = page[-1]['_cursor']
+
+        for args, kwargs in ((('tree', 5), {}),
+                             (('tree',), dict(start=5, end=20)),
+                             (('tree',), dict(start=5, end=20, inclusive_start=False, inclusive_end=False)),
+                             (('tree',), dict(start=25, end=None)),
+                             (('tree',), dict(start=25, end=None, inclusive_start=False)),
+                             (('custom', 1), {})):
+            expected = [curr['_id'] for curr in db.get_many(*args, limit=-1, **kwargs)]
+            assert expected
+            assert pages(db.get_many, *args, limit=7, **kwargs) == expected
+        for index_name in ('id', 'tree', 'custom'):
+            assert pages(db.all, index_name, limit=50) == \
+                [curr['_id'] for curr in db.all(index_name)]
+        assert '_cursor' not in next(db.all('tree'))
+
+        # inserts and deletes between pages don't repeat or skip records
+        page = list(db.get_many('tree', start=10, end=12, limit=15, with_doc=True, cursor=''))
+        seen = [curr['doc']['x'] for curr in page]
+        for x in xrange(300, 330):
+            db.insert(dict(t=x % 30, test=x % 10, x=x))
+        db.delete(page[-1]['doc'])
+        rest = db.get_many('tree', start=10, end=12, limit=-1, with_doc=True,
+                           cursor=page[-1]['_cursor'])
+        seen.extend(curr['doc']['x'] for curr in rest)
+        # 310 went before the cursor
+        assert sorted(seen) == [x for x in xrange(330) if x % 30 in (10, 11, 12) and x != 310]
+
+        with pytest.raises(IndexException):
+            list(db.all('tree', cursor='garbage'))
+        with pytest.raises(IndexException):
+            list(db.all('id', cursor=page[-1]['_cursor']))
+        with pytest.raises(IndexException):
+            list(db.get_many('tree', start=None, end=10, cursor=''))
+
+        # hash cursors are positions in bucket file, tree ones find the record
+        hash_page = list(db.all('id', limit=20, cursor=''))
+        tree_page = list(db.all('tree', limit=20, cursor=''))
+        expected = [curr['_id'] for curr in db.all('tree')][20:]
+        db.compact_index('id')
+        db.compact_index('tree')
+        with pytest.raises(IndexException):
+            list(db.all('id', cursor=hash_page[-1]['_cursor']))
+        assert [curr['_id'] for curr in db.all('tree', cursor=tree_page[-1]['_cursor'])] == expected
+        db.close()
+
+    def test_storage_reuse_during_scan(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.create()
+        l = [dict(x=x, body='%05d' % x) for x in xrange(200)]
+        for c in l:
+            db.insert(c)
+        docs = dict((c['_id'], dict(c)) for c in l)
+        storage = db.indexes_names['id'].storage
+        it = db.all('id')
+        seen = [next(it) for x in xrange(10)]
+        ids = set(curr['_id'] for curr in seen)
+        for c in [c for c in l if c['_id'] not in ids][:50]:
+            db.delete(c)
+        assert storage.free_space == 0  # deferred while scan is open
+        for x in xrange(50):
+            db.insert(dict(x=-x, body='n%04d' % x))
+        seen.extend(it)
+        for curr in seen:
+            if curr['_id'] in docs:
+                assert curr['body'] == docs[curr['_id']]['body']
+        assert storage.free_space > 0
+        db.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011-2013 Codernity (http://codernity.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from maras.database import Database
+from maras.database_rw_thread_safe import RWThreadSafeDatabase
+from maras.positional_file import PositionalFile
+from maras.rw_lock import RWLock
+from maras.rr_cache import cache1lvl, cache2lvl
+
+from shared import DB_Tests, Simple_TreeIndex
+from maras.hash_index import UniqueHashIndex
+from hash_tests import HashIndexTests
+from tree_tests import TreeIndexTests
+from test_db_thread_safe import Test_Threads
+
+from threading import Thread, Event
+import os
+import random
+import sys
+import pytest
+
+
+class Test_Database(DB_Tests):
+
+    _db = RWThreadSafeDatabase
+
+
+class Test_HashIndex(HashIndexTests):
+
+    _db = RWThreadSafeDatabase
+
+
+class Test_TreeIndex(TreeIndexTests):
+
+    _db = RWThreadSafeDatabase
+
+
+class Test_Threads(Test_Threads):
+
+    _db = RWThreadSafeDatabase
+
+    def test_rw_lock(self):
+        lock = RWLock()
+        inside = Event()
+        release = Event()
+
+        def reader():
+            with lock.shared:
+                inside.set()
+                release.wait(5)
+        th = Thread(target=reader)
+        th.start()
+        assert inside.wait(5)
+        # readers share the lock, writer waits for them
+        with lock.shared:
+            with lock.shared:
+                pass
+            with pytest.raises(RuntimeError):
+                lock.acquire()
+        got = []
+
+        def writer():
+            got.append(lock.acquire())
+            with lock.shared:  # writer can read too
+                got.append(True)
+            lock.release()
+        th_writer = Thread(target=writer)
+        th_writer.start()
+        th_writer.join(0.1)
+        assert got == []
+        release.set()
+        th_writer.join(5)
+        assert got == [True, True]
+        th.join()
+
+    def test_concurrent_reads(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        for x in xrange(500):
+            db.insert(dict(t=x))
+        errors = []
+
+        def reader(offset):
+            try:
+                for x in xrange(offset, 494, 7):
+                    assert db.get('tree', x, with_doc=True)['doc']['t'] == x
+                    res = db.get_many('tree', start=x, end=x + 5, limit=-1, with_doc=True)
+                    assert [curr['doc']['t'] for curr in res] == range(x, x + 6)
+            except Exception as e:
+                errors.append(e)
+
+        def writer():
+            try:
+                for x in xrange(500, 600):
+                    db.insert(dict(t=x))
+            except Exception as e:
+                errors.append(e)
+        ths = [Thread(target=reader, args=(x, )) for x in xrange(7)]
+        ths.append(Thread(target=writer))
+        for th in ths:
+            th.start()
+        for th in ths:
+            th.join()
+        assert errors == []
+        assert [curr['key'] for curr in db.all('tree')] == range(600)
+        db.close()
+
+    def test_rr_cache_threads(self):
+        # caches of indexes (locked ones in threads modes) are filled by
+        # many readers at once
+        @cache1lvl(20)
+        def one(key):
+            return key * 2
+
+        @cache2lvl(20)
+        def two(key, inner_key):
+            return key, inner_key
+        errors = []
+
+        def reader(seed):
+            rnd = random.Random(seed)
+            try:
+                for x in xrange(3000):
+                    key = rnd.randrange(50)
+                    assert one(key) == key * 2
+                    assert two(key % 7, key) == (key % 7, key)
+            except Exception as e:
+                errors.append(e)
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            ths = [Thread(target=reader, args=(x, )) for x in xrange(8)]
+            for th in ths:
+                th.start()
+            for th in ths:
+                th.join()
+        finally:
+            sys.setcheckinterval(interval)
+        assert errors == []
+        assert len(one.cache) <= 20
+        assert two.cache_size == sum(len(curr) for curr in two.cache.values()) <= 20
+
+    def test_positional_files_scope(self, tmpdir):
+        # only readers-writer databases wrap their files
+        db = self._db(os.path.join(str(tmpdir), 'rw'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        plain = Database(os.path.join(str(tmpdir), 'plain'))
+        plain.set_indexes([UniqueHashIndex(plain.path, 'id'),
+                           Simple_TreeIndex(plain.path, 'tree')])
+        plain.create()
+        for x in xrange(10):
+            db.insert(dict(t=x))
+            plain.insert(dict(t=x))
+        for ind in db.indexes:
+            assert isinstance(ind.buckets, PositionalFile)
+            assert isinstance(ind.storage._f, PositionalFile)
+        for ind in plain.indexes:
+            assert not isinstance(ind.buckets, PositionalFile)
+            assert not isinstance(ind.storage._f, PositionalFile)
+        db.compact_index('id')
+        assert isinstance(db.id_ind.buckets, PositionalFile)
+        assert isinstance(db.id_ind.storage._f, PositionalFile)
+        assert [curr['key'] for curr in plain.all('tree')] == range(10)
+        db.close()
+        plain.close()
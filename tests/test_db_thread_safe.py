@@ -17,7 +17,8 @@
 
 
 from maras.database_thread_safe import ThreadSafeDatabase
-from shared import DB_Tests, WithAIndex
+from shared import DB_Tests, WithAIndex, Simple_TreeIndex
+from maras.hash_index import UniqueHashIndex
 from hash_tests import HashIndexTests
 from tree_tests import TreeIndexTests
 
@@ -100,3 +101,25 @@ class Test_Threads(object):
 
         assert db.count(db.all, 'with_a', with_doc=True) == 1
         assert db.count(db.all, 'id') == 1
+
+    def test_compact_online(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id'),
+                        Simple_TreeIndex(db.path, 'tree')])
+        db.create()
+        for x in xrange(2000):
+            db.insert(dict(t=x))
+        for doc in list(db.all('tree', with_doc=True))[::2]:
+            db.delete(doc['doc'])
+        compactor = Thread(target=db.compact, kwargs={'online': True})
+        compactor.start()
+        x = 2000
+        while compactor.is_alive() or x < 2100:
+            db.insert(dict(t=x))
+            assert db.get('tree', x, with_doc=True)['doc']['t'] == x
+            x += 1
+        compactor.join()
+        keys = range(1, 2000, 2) + range(2000, x)
+        assert [doc['key'] for doc in db.all('tree')] == keys
+        assert sorted(doc['t'] for doc in db.all('id')) == keys
+        db.close()
@@ -80,6 +80,24 @@ class EvenCapacityTreeIndex(TreeBasedIndex):
         return key
 
 
+class MmapTreeIndex(TreeBasedIndex):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['node_capacity'] = 13
+        kwargs['key_format'] = 'I'
+        kwargs['use_mmap'] = True
+        super(MmapTreeIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        a_val = data.get('a')
+        if a_val is not None:
+            return a_val, None
+        return None
+
+    def make_key(self, key):
+        return key
+
+
 def sort_by_key(list):
 
     def _comp(a, b):
@@ -1373,3 +1391,68 @@ class TreeIndexTests:
         db.insert(dict(a=2))
         assert 20 == db.count(db.get_many, 'tree', 1, limit=-1)
         db.close()
+
+    def test_mmap_reads(self, tmpdir):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        id = UniqueHashIndex(db.path, 'id')
+        tree = MmapTreeIndex(db.path, 'tree')
+        db.set_indexes([id, tree])
+        db.create()
+        inserted = {}
+        updated = {}
+        self.random_database_usage(db, 200, inserted, updated)
+        db.close()
+        db.open()
+        assert db.indexes_names['tree'].use_mmap
+        assert len(inserted) == db.count(db.all, 'tree')
+        for doc in inserted.itervalues():
+            assert db.get('tree', doc['a'])['key'] == doc['a']
+        db.close()
+
+    def test_bulk_load(self, tmpdir, inserts):
+        db = self._db(os.path.join(str(tmpdir), 'db'))
+        db.set_indexes([UniqueHashIndex(db.path, 'id')])
+        db.create()
+        for x in xrange(inserts * 5):
+            db.insert(dict(a=random.randint(1, 100),
+                           cstm=random.randint(1, 1000)))
+        docs = list(db.all('id'))
+        db.add_index(SimpleTreeIndex(db.path, 'tree'))
+        db.add_index(CustomTreeIndex(db.path, 'custom'))
+        db.reindex_index('tree')
+        db.reindex_index('custom')
+        tree = db.indexes_names['tree']
+        assert tree.root_flag == 'n'
+        keys = [curr['key'] for curr in db.all('tree')]
+        assert keys == sorted(doc['a'] for doc in docs)
+        for key in xrange(1, 101):
+            assert db.count(db.get_many, 'tree', key, limit=-1) == \
+                keys.count(key)
+        assert db.count(db.get_many, 'tree', start=10, end=20,
+                        limit=-1) == \
+            len([key for key in keys if 10 <= key <= 20])
+        for doc in docs:
+            got = db.get('custom', doc['cstm'], with_doc=True)
+            assert got['key'] == doc['cstm'] - doc['cstm'] % 10
+            assert got['cstm'] - got['cstm'] % 10 == got['key']
+
+        # inserts into packed tree
+        for x in xrange(inserts):
+            doc = dict(a=random.randint(1, 100))
+            db.insert(doc)
+            assert db.get('tree', doc['a'])['key'] == doc['a']
+        db.close()
+        db.open()
+        keys = [curr['key'] for curr in db.all('tree')]
+        assert keys == sorted(keys)
+        assert len(keys) == inserts * 6
+
+        # external sort, multiple runs merged
+        tree = db.indexes_names['tree']
+        tree.destroy()
+        tree.create_index()
+        tree.bulk_load(((doc['_id'], doc['a'], 1, 0) for doc in docs),
+                       sort_buffer=50)
+        assert [curr['key'] for curr in db.all('tree')] == \
+            sorted(doc['a'] for doc in docs)
+        db.close()